@@ -0,0 +1,423 @@
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from collections.abc import Callable
+from dataclasses import (
+    asdict,
+    dataclass,
+)
+from typing import Any
+
+from flask import Flask
+from sqlalchemy import (
+    create_engine,
+    event,
+    func,
+    insert,
+    select,
+    update,
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+
+from .config import basedir
+from .core.database import configure_sqlite
+from .core.extensions import db
+from .models import (
+    Category,
+    Comment,
+    Post,
+    unread_comments,
+)
+from .pagination import encode_cursor
+
+# quantities given to 'fake_dataset', the datasets are generated once per seed and kept in the data directory
+DATASETS: dict[str, dict[str, int]] = {
+    'small': dict(category=10, post=200, comment=2_000, reply=500),
+    'posts-10k': dict(category=30, post=10_000, comment=50_000, reply=10_000),
+    'comments-1m': dict(category=30, post=10_000, comment=800_000, reply=200_000),
+}
+
+# run in a fresh interpreter, so nothing is imported yet; the marker separates the imports of greybook from the interpreter startup
+_STARTUP_SCRIPT = """
+import json, sys, time
+sys.stderr.write('greybook-start\\n')
+sys.stderr.flush()
+start = time.perf_counter()
+import greybook
+imported = time.perf_counter()
+app = greybook.create_app(sys.argv[1])
+print(json.dumps(dict(imported=imported - start, created=time.perf_counter() - imported, startup=app.extensions['greybook_startup'])))
+"""
+
+
+def _imports_by_package(importtime_log: str) -> dict[str, float]:
+    # '-X importtime' lines are 'import time: <self us> | <cumulative us> | <indented module>', summing the self times does not count a module twice
+    seconds: dict[str, float] = defaultdict(float)
+    lines: list[str] = importtime_log.splitlines()
+    for line in lines[lines.index('greybook-start') + 1 :]:
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, _, module = line.removeprefix('import time:').split('|')
+        seconds[module.strip().partition('.')[0]] += int(self_time) / 1_000_000
+    return seconds
+
+
+def _startup_phases(config_name: str) -> dict[str, float]:
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', _STARTUP_SCRIPT, config_name], capture_output=True, text=True, cwd=basedir, check=True)
+    timings: dict = json.loads(result.stdout.splitlines()[-1])
+    phases: dict[str, float] = {'import': timings['imported']}
+    phases.update((f'import {package}', seconds) for package, seconds in _imports_by_package(result.stderr).items())
+    phases['create_app'] = timings['created']
+    phases.update((f'create_app {step}', seconds) for step, seconds in timings['startup'].items())
+    return phases
+
+
+def measure_startup(config_name: str, runs: int = 5) -> dict[str, float]:
+    """
+    Measure the cold start of the application, each run in a new Python process.
+
+    Parameters
+    ----------
+    config_name : str
+        Configuration of the measured application.
+    runs : int, optional
+        Quantity of measured processes, by default 5.
+
+    Returns
+    -------
+    dict[str, float]
+        The median seconds of every phase: 'import' split by imported package, then 'create_app' split by registration step.
+    """
+    measured: list[dict[str, float]] = [_startup_phases(config_name) for _ in range(runs)]
+    return {phase: statistics.median(phases.get(phase, 0.0) for phases in measured) for phase in measured[0]}
+
+
+def create_bench_app(page_cache: bool = False) -> Flask:
+    """
+    Create a testing application to benchmark, its database is in memory so the disk is not measured.
+
+    Parameters
+    ----------
+    page_cache : bool, optional
+        Keep the cache of the rendered pages, by default False so the views are measured.
+    """
+    from . import create_app
+
+    app: Flask = create_app('testing')
+    # the budgets raise in testing, a benchmark reports the queries instead
+    app.config['GREYBOOK_QUERY_BUDGETS'] = {}
+    if not page_cache:
+        app.extensions.pop('greybook_page_cache', None)
+    return app
+
+
+def load_dataset(app: Flask, name: str, seed: int = 0, data_dir: str = os.path.join(basedir, '.cache', 'bench'), workers: int = 0, echo: Callable[[str], Any] = print) -> str:
+    """
+    Fill the in-memory database of a testing application with a benchmark dataset.
+    - The dataset is generated on the first use, then copied from its SQLite file with the backup API.
+
+    Parameters
+    ----------
+    app : Flask
+        Application created with the testing configuration.
+    name : str
+        Name of the dataset, see 'DATASETS'.
+    seed : int, optional
+        Seed of the generated data, by default 0.
+    data_dir : str, optional
+        Directory of the dataset files, by default '.cache/bench'.
+    workers : int, optional
+        Quantity of processes generating a missing dataset, by default 0.
+    echo : Callable[[str], Any], optional
+        Called with the progress messages, by default print.
+
+    Returns
+    -------
+    str
+        Path of the dataset file.
+    """
+    from .fakes import fake_dataset
+
+    path: str = os.path.join(data_dir, f'{name}-{seed}.db')
+    with app.app_context():
+        # the in-memory database has a single connection, shared by every session of the application
+        database: sqlite3.Connection = db.engine.raw_connection().driver_connection  # type: ignore
+        if os.path.exists(path):
+            with sqlite3.connect(path) as source:
+                source.backup(database)
+            echo(f'Loaded the {name} dataset from {path}.')
+            return path
+        fake_dataset(**DATASETS[name], seed=seed, workers=workers, echo=echo)
+        os.makedirs(data_dir, exist_ok=True)
+        with sqlite3.connect(f'{path}.tmp') as target:
+            database.backup(target)
+        os.replace(f'{path}.tmp', path)
+        echo(f'Saved the {name} dataset to {path}.')
+    return path
+
+
+@dataclass(frozen=True, slots=True)
+class EndpointResult:
+    requests: int
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    mean_ms: float
+    # median quantity of queries per request
+    queries: int
+    # peak of the memory allocated by Python during one request, measured apart from the timed requests
+    peak_memory_kb: float
+
+
+def _endpoints(app: Flask) -> list[tuple[str, bool, Callable[[int], tuple[str, dict | None]]]]:
+    # (name, as the admin, iteration -> (URL, form data of a POST or None))
+    with app.app_context():
+        posts: int = db.session.scalar(select(func.count(Post.id))) or 0
+        # the last page reached with an offset, deeper pages are only reached with cursors
+        deep_page: int = max(1, min(app.config['GREYBOOK_NUMBERED_PAGES'], -(-posts // app.config['GREYBOOK_POSTS_PER_PAGE'])))
+        middle: Post | None = db.session.scalar(select(Post).order_by(Post.created_time.desc(), Post.id.desc()).offset(posts // 2).limit(1))
+        with app.test_request_context():
+            cursor: str | None = encode_cursor(middle) if middle is not None else None
+        category_id: int | None = db.session.scalar(select(Category.id).order_by(Category.id.desc()).limit(1))
+        post_id: int | None = db.session.scalar(select(Post.id).order_by(Post.comment_count.desc(), Post.id).limit(1))
+        unread_ids: list[int] = list(db.session.scalars(select(Comment.id).where(unread_comments).order_by(Comment.id)))
+
+    def approve(iteration: int) -> tuple[str, dict | None]:
+        return '/admin/comment/bulk', dict(action='approve', scope='selected', ids=unread_ids[iteration * 10 : iteration * 10 + 10])
+
+    def comment(iteration: int) -> tuple[str, dict | None]:
+        return f'/post/{post_id}', dict(author='Bench', email='bench@example.com', site='', body=f'Benchmark comment {iteration}.')
+
+    return [
+        ('index', False, lambda iteration: ('/', None)),
+        ('deep_page', False, lambda iteration: (f'/?page={deep_page}', None)),
+        ('deep_cursor', False, lambda iteration: (f'/?cursor={cursor}', None)),
+        ('category', False, lambda iteration: (f'/category/{category_id}', None)),
+        ('post', False, lambda iteration: (f'/post/{post_id}', None)),
+        ('search', False, lambda iteration: ('/search?q=the', None)),
+        ('manage_comments', True, lambda iteration: ('/admin/comment/manage?filter=unread', None)),
+        ('approve_comments', True, approve),
+        ('comment', False, comment),
+    ]
+
+
+def benchmark_endpoints(app: Flask, requests: int = 50, warmup: int = 5, admin_password: str = 'greybook') -> dict[str, EndpointResult]:
+    """
+    Drive the main endpoints through the test client and measure them.
+
+    Parameters
+    ----------
+    app : Flask
+        Application holding a dataset, see 'load_dataset'.
+    requests : int, optional
+        Quantity of timed requests per endpoint, by default 50.
+    warmup : int, optional
+        Quantity of requests sent first to fill the caches, by default 5.
+    admin_password : str, optional
+        Password of the admin account of the dataset, by default 'greybook'.
+
+    Returns
+    -------
+    dict[str, EndpointResult]
+        The result of every endpoint, in the order they were measured.
+    """
+    visitor = app.test_client()
+    admin = app.test_client()
+    admin.post('/auth/login', data=dict(username='admin', password=admin_password))
+    queries: list[int] = [0]
+
+    def count(*args) -> None:
+        queries[0] += 1
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', count)
+    results: dict[str, EndpointResult] = {}
+    try:
+        for name, as_admin, request in _endpoints(app):
+            client = admin if as_admin else visitor
+            durations: list[float] = []
+            query_counts: list[int] = []
+
+            def send(iteration: int) -> float:
+                url, data = request(iteration)
+                queries[0] = 0
+                start: float = time.perf_counter()
+                response = client.get(url) if data is None else client.post(url, data=data)
+                duration: float = time.perf_counter() - start
+                if response.status_code >= 400:
+                    raise RuntimeError(f'{name} answered {response.status_code} to {url}')
+                return duration
+
+            for iteration in range(warmup):
+                send(iteration)
+            for iteration in range(warmup, warmup + requests):
+                durations.append(send(iteration))
+                query_counts.append(queries[0])
+            tracemalloc.start()
+            try:
+                send(warmup + requests)
+                peak: int = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+            percentiles: list[float] = statistics.quantiles(durations, n=100, method='inclusive') if len(durations) > 1 else durations * 99
+            results[name] = EndpointResult(
+                requests=requests,
+                p50_ms=percentiles[49] * 1000,
+                p95_ms=percentiles[94] * 1000,
+                p99_ms=percentiles[98] * 1000,
+                mean_ms=statistics.fmean(durations) * 1000,
+                queries=round(statistics.median(query_counts)),
+                peak_memory_kb=peak / 1024,
+            )
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    return results
+
+
+def results_document(dataset: str, seed: int, results: dict[str, EndpointResult]) -> dict:
+    """
+    Returns
+    -------
+    dict
+        The results with their context, as written to the JSON file.
+    """
+    return dict(
+        dataset=dataset,
+        seed=seed,
+        python=platform.python_version(),
+        created=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        endpoints={name: asdict(result) for name, result in results.items()},
+    )
+
+
+def compare_results(results: dict, baseline: dict, tolerance: float = 0.25, slack_ms: float = 1.0) -> list[str]:
+    """
+    Compare benchmark results with a baseline of the same dataset.
+
+    Parameters
+    ----------
+    results : dict
+        Results, see 'results_document'.
+    baseline : dict
+        Baseline results.
+    tolerance : float, optional
+        Allowed relative increase of the p95 latency, by default 0.25.
+    slack_ms : float, optional
+        Allowed absolute increase of the p95 latency, so the fastest endpoints do not fail on noise, by default 1.0.
+
+    Returns
+    -------
+    list[str]
+        The regressions: slower p95 latencies and more queries than the baseline.
+    """
+    if (results['dataset'], results['seed']) != (baseline['dataset'], baseline['seed']):
+        raise ValueError(f'The baseline was measured on the {baseline["dataset"]} dataset with seed {baseline["seed"]}.')
+    regressions: list[str] = []
+    for name, result in results['endpoints'].items():
+        if (base := baseline['endpoints'].get(name)) is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance) + slack_ms:
+            regressions.append(f'{name}: p95 latency {result["p95_ms"]:.1f}ms, baseline {base["p95_ms"]:.1f}ms')
+        if result['queries'] > base['queries']:
+            regressions.append(f'{name}: {result["queries"]} queries, baseline {base["queries"]}')
+    return regressions
+
+
+@dataclass(frozen=True, slots=True)
+class ConcurrencyResult:
+    reads_per_second: float
+    writes_per_second: float
+    # transactions that failed with "database is locked"
+    locked_errors: int
+
+
+def _read_loop(engine: Engine, stop: threading.Event, counts: dict[str, int], lock: threading.Lock) -> None:
+    reads: int = 0
+    with engine.connect() as connection:
+        while not stop.is_set():
+            # the index page: the latest posts and their comment counts
+            post_ids: list[int] = list(connection.scalars(select(Post.id).order_by(Post.created_time.desc()).limit(10)))
+            connection.execute(select(Comment.post_id, func.count(Comment.id)).where(Comment.post_id.in_(post_ids)).group_by(Comment.post_id)).all()
+            connection.commit()
+            reads += 1
+    with lock:
+        counts['reads'] += reads
+
+
+def _write_loop(engine: Engine, stop: threading.Event, counts: dict[str, int], lock: threading.Lock, posts: int, begin: str) -> None:
+    writes: int = 0
+    locked: int = 0
+    with engine.connect() as connection:
+        connection.execution_options(greybook_begin=begin)
+        while not stop.is_set():
+            # a comment POST: the post is read, then the comment is inserted and the counter of the post updated
+            post_id: int = writes % posts + 1
+            try:
+                connection.scalar(select(Post.comment_count).where(Post.id == post_id))
+                connection.execute(insert(Comment.__table__).values(author='Bench', email='bench@example.com', body='Concurrent comment.', post_id=post_id))
+                connection.execute(update(Post).where(Post.id == post_id).values(comment_count=Post.comment_count + 1))
+                connection.commit()
+                writes += 1
+            except OperationalError as error:
+                if 'locked' not in str(error):
+                    raise
+                connection.rollback()
+                locked += 1
+    with lock:
+        counts['writes'] += writes
+        counts['locked'] += locked
+
+
+def measure_sqlite_concurrency(dataset_path: str, tuned: bool, pragmas: dict[str, str | int], readers: int = 8, writers: int = 2, seconds: float = 5.0) -> ConcurrencyResult:
+    """
+    Run concurrent readers and writers on a copy of a dataset file.
+
+    Parameters
+    ----------
+    dataset_path : str
+        SQLite dataset, see 'load_dataset'.
+    tuned : bool
+        Apply the pragmas and begin the writes with 'BEGIN IMMEDIATE', see 'configure_sqlite', otherwise the driver defaults are used.
+    pragmas : dict[str, str | int]
+        Pragmas of the tuned run, see 'GREYBOOK_SQLITE_PRAGMAS'.
+    readers : int, optional
+        Quantity of reading threads, by default 8.
+    writers : int, optional
+        Quantity of writing threads, by default 2.
+    seconds : float, optional
+        Duration of the run, by default 5.0.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path: str = os.path.join(directory, 'bench.db')
+        shutil.copyfile(dataset_path, path)
+        engine: Engine = create_engine(f'sqlite:///{path}', pool_size=readers + writers)
+        if tuned:
+            configure_sqlite(engine, pragmas)
+        with engine.connect() as connection:
+            posts: int = connection.scalar(select(func.count(Post.id))) or 1
+        stop = threading.Event()
+        lock = threading.Lock()
+        counts: dict[str, int] = dict(reads=0, writes=0, locked=0)
+        threads: list[threading.Thread] = [threading.Thread(target=_read_loop, args=(engine, stop, counts, lock)) for _ in range(readers)]
+        threads += [threading.Thread(target=_write_loop, args=(engine, stop, counts, lock, posts, 'IMMEDIATE' if tuned else '')) for _ in range(writers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        engine.dispose()
+    return ConcurrencyResult(reads_per_second=counts['reads'] / seconds, writes_per_second=counts['writes'] / seconds, locked_errors=counts['locked'])
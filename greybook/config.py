@@ -11,13 +11,40 @@ else:
     prefix = 'sqlite:////'
 
 
+def read_only_sqlite_uri(uri: str) -> str | None:
+    """
+    Returns
+    -------
+    str | None
+        The URI of a read-only connection to the same SQLite file, None if the database is not a SQLite file.
+    """
+    if not uri.startswith('sqlite:///') or ':memory:' in uri:
+        return None
+    return f'sqlite:///file:{uri.removeprefix("sqlite:///")}?mode=ro&uri=true'
+
+
 class BaseConfig:
     SECRET_KEY = os.getenv('SECRET_KEY', 'dev key')
 
     DEBUG_TB_INTERCEPT_REDIRECTS = False
     DEBUG_TB_ENABLED = False
 
-    SQLALCHEMY_RECORD_QUERIES = True
+    # Flask-SQLAlchemy records every statement for the debug toolbar, Greybook records its own query stats, see GREYBOOK_QUERY_SAMPLE_RATE
+    SQLALCHEMY_RECORD_QUERIES = False
+    # set on every SQLite connection: WAL lets the readers run during a write, NORMAL only syncs at the checkpoints in WAL mode,
+    # busy_timeout (ms) makes the writers wait for the lock instead of failing, cache_size is in KiB when negative
+    GREYBOOK_SQLITE_PRAGMAS: dict[str, str | int] = {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'busy_timeout': 5000,
+        'cache_size': -64 * 1024,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'memory',
+    }
+    # requests other than GET, HEAD and OPTIONS take the SQLite write lock when they begin, so they wait for it instead of failing
+    GREYBOOK_SQLITE_IMMEDIATE_WRITES = True
+    # database of the GET requests of the blog, a replica or a read-only connection, None reads from the primary database
+    GREYBOOK_READ_DATABASE_URI = os.getenv('GREYBOOK_READ_DATABASE_URI')
 
     CKEDITOR_ENABLE_CSRF = True
     CKEDITOR_FILE_UPLOADER = 'admin.upload_image'
@@ -30,30 +57,104 @@ class BaseConfig:
     MAIL_DEFAULT_SENDER = f'Greybook <{MAIL_USERNAME}>'
 
     GREYBOOK_ADMIN_EMAIL = os.getenv('GREYBOOK_ADMIN_EMAIL')
+    # quantity of reverse proxies in front of the application, e.g. 1 for nginx, their X-Forwarded-* headers give the client address
+    # stored with the comments, without it every comment gets the address of the proxy and the IP moderation matches all of them
+    GREYBOOK_TRUSTED_PROXIES = int(os.getenv('GREYBOOK_TRUSTED_PROXIES', 0))
+    # 'text' or 'json', one JSON object per line
+    GREYBOOK_LOG_FORMAT = os.getenv('GREYBOOK_LOG_FORMAT', 'text')
+    # an error is emailed to the admin at most once per interval, and at most GREYBOOK_ERROR_MAIL_LIMIT error emails are sent per interval
+    GREYBOOK_ERROR_MAIL_INTERVAL = 600
+    GREYBOOK_ERROR_MAIL_LIMIT = 10
+    # the logged-in admin is cached by each process, a change made in another process is seen after this many seconds
+    GREYBOOK_USER_CACHE_TTL = 30
+    # 'immediate' sends one email per new comment, 'digest' one email per window listing the posts with new comments
+    GREYBOOK_COMMENT_NOTIFICATION = os.getenv('GREYBOOK_COMMENT_NOTIFICATION', 'immediate')
+    GREYBOOK_DIGEST_WINDOW = 600
+    # emails are queued in the outbox table and sent by a pool of threads, 0 workers leaves them to 'flask outbox drain'
+    GREYBOOK_OUTBOX_WORKERS = 2
+    GREYBOOK_OUTBOX_BATCH_SIZE = 20
+    GREYBOOK_OUTBOX_POLL_INTERVAL = 30
+    GREYBOOK_OUTBOX_MAX_ATTEMPTS = 8
+    GREYBOOK_OUTBOX_RETRY_DELAY = 30
+    GREYBOOK_OUTBOX_BREAKER_THRESHOLD = 3
+    GREYBOOK_OUTBOX_BREAKER_COOLDOWN = 60
     GREYBOOK_POSTS_PER_PAGE = 10
     GREYBOOK_MANAGE_POST_PER_PAGE = 15
     GREYBOOK_COMMENT_PER_PAGE = 15
+    # show the comments of a post as reply trees instead of by date
+    GREYBOOK_COMMENT_THREADED = False
+    GREYBOOK_SEARCH_RESULTS_PER_PAGE = 20
+    # listings use numbered pages up to this page and keyset cursors beyond it
+    GREYBOOK_NUMBERED_PAGES = 10
     # ('theme name', 'display name')
     GREYBOOK_THEMES = {'default': 'Default', 'perfect_blue': 'Perfect Blue'}
+    # compiled templates are stored here and shared by the workers, 'flask compile-templates' fills it before they start
+    GREYBOOK_TEMPLATE_CACHE_DIR = os.getenv('GREYBOOK_TEMPLATE_CACHE_DIR', os.path.join(basedir, '.cache', 'templates'))
     GREYBOOK_SLOW_QUERY_THRESHOLD = 1
+    # fraction of the requests whose statements are recorded for the N+1 detection, the query count and time are recorded for every request
+    GREYBOOK_QUERY_SAMPLE_RATE = float(os.getenv('GREYBOOK_QUERY_SAMPLE_RATE', 1.0))
+    # send the database, rendering and total time of every request in the 'Server-Timing' header, it tells every visitor
+    # how slow the queries are, so it is only enabled in development and testing
+    GREYBOOK_SERVER_TIMING = False
+    # a statement executed more times than this in one request is logged as a probable N+1 query
+    GREYBOOK_REPEATED_QUERY_THRESHOLD = 10
+    # endpoint -> maximum quantity of queries per request, exceeding it raises in testing and logs a warning otherwise
+    GREYBOOK_QUERY_BUDGETS: dict[str, int] = {
+        'blog.index': 15,
+        'blog.show_category': 15,
+        'blog.show_post': 25,
+        'blog.search': 10,
+        'admin.manage_posts': 10,
+        'admin.manage_comments': 10,
+    }
+    # rendered pages of anonymous visitors, GREYBOOK_PAGE_CACHE_DIR adds a tier shared between workers
+    GREYBOOK_PAGE_CACHE = True
+    GREYBOOK_PAGE_CACHE_SIZE = 500
+    GREYBOOK_PAGE_CACHE_DIR = os.getenv('GREYBOOK_PAGE_CACHE_DIR')
+    # maximum quantity of pages written to GREYBOOK_PAGE_CACHE_DIR per version of the pages
+    GREYBOOK_PAGE_CACHE_DISK_SIZE = 5000
 
     GREYBOOK_UPLOAD_PATH = os.getenv('GREYBOOK_UPLOAD_PATH', os.path.join(basedir, 'uploads'))
     GREYBOOK_ALLOWED_IMAGE_EXTENSIONS = ['png', 'jpg', 'jpeg', 'gif']
+    # uploaded images get resized variants of these widths, generated by a pool of GREYBOOK_IMAGE_WORKERS processes, 0 resizes in the request
+    GREYBOOK_IMAGE_WIDTHS = (480, 960, 1600)
+    GREYBOOK_IMAGE_VARIANT_FORMAT = 'webp'
+    GREYBOOK_IMAGE_WORKERS = 2
+    # cache lifetime of uploads not named after their content, content-addressed uploads are immutable
+    GREYBOOK_UPLOAD_MAX_AGE = 24 * 60 * 60
+    # 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache, lighttpd) let the front proxy send the uploads, None sends them from Python
+    GREYBOOK_UPLOAD_OFFLOAD = os.getenv('GREYBOOK_UPLOAD_OFFLOAD')
+    # internal location of the upload folder in the proxy, for 'x-accel-redirect'
+    GREYBOOK_UPLOAD_ACCEL_PREFIX = '/_uploads/'
 
 
 class DevelopmentConfig(BaseConfig):
+    SQLALCHEMY_RECORD_QUERIES = True
+    GREYBOOK_SERVER_TIMING = True
     SQLALCHEMY_DATABASE_URI = prefix + os.path.join(basedir, 'data-dev.db')
 
 
 class TestingConfig(BaseConfig):
     TESTING = True
     WTF_CSRF_ENABLED = False
+    GREYBOOK_OUTBOX_WORKERS = 0
+    GREYBOOK_IMAGE_WORKERS = 0
+    GREYBOOK_TEMPLATE_CACHE_DIR = None
+    GREYBOOK_SERVER_TIMING = True
 
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'  # in-memory database
 
 
 class ProductionConfig(BaseConfig):
+    GREYBOOK_QUERY_SAMPLE_RATE = float(os.getenv('GREYBOOK_QUERY_SAMPLE_RATE', 0.05))
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', prefix + os.path.join(basedir, 'data.db'))
+    GREYBOOK_READ_DATABASE_URI = os.getenv('GREYBOOK_READ_DATABASE_URI', read_only_sqlite_uri(SQLALCHEMY_DATABASE_URI))
+    # one connection per thread of a worker, e.g. 'gunicorn --threads 8', the overflow absorbs the outbox and image threads
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.getenv('GREYBOOK_DB_POOL_SIZE', 8)),
+        'max_overflow': int(os.getenv('GREYBOOK_DB_MAX_OVERFLOW', 4)),
+        'pool_timeout': 10,
+    }
 
 
 type ConfigName = Literal['development', 'testing', 'production']
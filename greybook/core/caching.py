@@ -0,0 +1,385 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from collections.abc import (
+    Callable,
+    Iterable,
+)
+from contextlib import suppress
+from dataclasses import dataclass
+from datetime import datetime
+from functools import wraps
+from threading import Lock
+from typing import Any
+from urllib.parse import urlencode
+
+from flask import (
+    Flask,
+    current_app,
+    g,
+    make_response,
+    request,
+    session,
+)
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy import (
+    Connection,
+    event,
+    func,
+    insert,
+    inspect,
+    select,
+    update,
+)
+from sqlalchemy.orm import (
+    ORMExecuteState,
+    Session,
+)
+
+from ..models import (
+    Admin,
+    CacheVersion,
+    Category,
+    Comment,
+    Link,
+    Post,
+)
+from .extensions import db
+
+# model class -> (cache namespace invalidated when rows of the model change, predicate of the flushed instances that invalidate it or None for all)
+_watched_models: dict[type, list[tuple[str, Callable[[Any], bool] | None]]] = {}
+
+
+def watch(*models: type, namespace: str, when: Callable[[Any], bool] | None = None) -> None:
+    """
+    Invalidate the cache namespace whenever rows of the given models are written.
+
+    Parameters
+    ----------
+    *models : type
+        Model classes to watch.
+    namespace : str
+        Cache namespace whose version is bumped on writes.
+    when : Callable[[Any], bool] | None, optional
+        Called with every flushed instance, which only invalidates the namespace if it returns True, by default None.
+        Bulk statements always invalidate it.
+    """
+    for model in models:
+        _watched_models.setdefault(model, []).append((namespace, when))
+
+
+def _namespaces_of(instances: Iterable[object]) -> set[str]:
+    namespaces: set[str] = set()
+    for instance in instances:
+        for model, watches in _watched_models.items():
+            if isinstance(instance, model):
+                namespaces.update(namespace for namespace, when in watches if when is None or when(instance))
+    return namespaces
+
+
+def bump_versions(connection: Connection, namespaces: Iterable[str]) -> None:
+    """
+    Increase the shared version counters, in the transaction of the given connection.
+    - If the transaction is rolled back, the counters are rolled back with it.
+
+    Parameters
+    ----------
+    connection : Connection
+        Connection of the transaction that writes the watched rows.
+    namespaces : Iterable[str]
+        Cache namespaces to invalidate.
+    """
+    for namespace in sorted(namespaces):
+        result = connection.execute(update(CacheVersion).where(CacheVersion.namespace == namespace).values(version=CacheVersion.version + 1))
+        if not result.rowcount:
+            connection.execute(insert(CacheVersion).values(namespace=namespace, version=1))
+
+
+def get_version(session: Session, namespace: str) -> int:
+    """
+    Returns
+    -------
+    int
+        The current version of the cache namespace, 0 if it has never been bumped.
+    """
+    return session.scalar(select(CacheVersion.version).where(CacheVersion.namespace == namespace)) or 0
+
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_flushed(session: Session, flush_context) -> None:
+    dirty: list[object] = [instance for instance in session.dirty if session.is_modified(instance)]
+    namespaces: set[str] = _namespaces_of([*session.new, *dirty, *session.deleted])
+    if namespaces:
+        bump_versions(session.connection(), namespaces)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _invalidate_bulk_executed(orm_execute_state: ORMExecuteState) -> None:
+    # bulk INSERT / UPDATE / DELETE statements never go through the flush
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None:
+        return
+    namespaces: set[str] = set()
+    for model, watches in _watched_models.items():
+        if issubclass(mapper.class_, model):
+            namespaces.update(namespace for namespace, _ in watches)
+    if namespaces:
+        bump_versions(orm_execute_state.session.connection(), namespaces)
+
+
+class VersionedCache:
+    """
+    In-process cache of a value that is rebuilt when the shared version of its namespace changes.
+    - Checking the cache costs one primary key lookup, rebuilding it calls the loader.
+    - The loader runs in its own session, so the cached ORM objects are detached and must be merged into the request session with 'load=False' before use.
+    - Values loaded from uncommitted writes are tagged with the uncommitted version, so they are rebuilt if that transaction is rolled back.
+    """
+
+    def __init__(self, namespace: str, loader: Callable[[Session], Any]) -> None:
+        self.namespace: str = namespace
+        self.loader: Callable[[Session], Any] = loader
+        self._entry: tuple[int, Any] | None = None
+        self._lock = Lock()
+
+    def get(self) -> Any:
+        """
+        Returns
+        -------
+        Any
+            The cached value, rebuilt first if the shared version has changed.
+        """
+        version: int = get_version(db.session, self.namespace)
+        entry: tuple[int, Any] | None = self._entry
+        if entry is None or entry[0] != version:
+            with self._lock:
+                entry = self._entry
+                if entry is None or entry[0] != version:
+                    entry = self._entry = self._load()
+        return entry[1]
+
+    def clear(self) -> None:
+        self._entry = None
+
+    def _load(self) -> tuple[int, Any]:
+        # joins the transaction of the request session without ending it, so the version and the data are read consistently
+        with Session(bind=db.session.connection(), expire_on_commit=False) as session:
+            version: int = get_version(session, self.namespace)
+            value: Any = self.loader(session)
+        return version, value
+
+
+PAGES_NAMESPACE = 'pages'
+
+
+def _is_shown_comment(comment: Comment) -> bool:
+    # the public pages only show reviewed comments, so a spam wave of new comments keeps the cached pages until they are reviewed
+    history = inspect(comment).attrs.reviewed.history
+    return comment.reviewed is True or any(history.deleted)
+
+
+watch(Admin, Category, Link, Post, namespace=PAGES_NAMESPACE)
+watch(Comment, namespace=PAGES_NAMESPACE, when=_is_shown_comment)
+
+# stands for the CSRF token of the visitor in cached pages, which are shared between sessions
+_CSRF_PLACEHOLDER = b'__greybook_csrf_token__'
+
+
+@dataclass(frozen=True, slots=True)
+class CachedPage:
+    version: int
+    body: bytes
+    mimetype: str
+    # pages holding a CSRF token differ per visitor, so they are not validated with an ETag
+    etag: str | None
+    last_modified: datetime | None
+
+
+class PageCache:
+    """
+    Bounded LRU cache of rendered pages, with an optional on-disk tier shared between worker processes.
+    - Entries are stored with the version of the 'pages' namespace they were rendered at, and are discarded once it changes.
+    - On disk, each version has its own directory of at most 'max_disk_entries' entries, the older ones are removed when a newer version is written.
+    - Entry files are a JSON header line followed by the body, reading them never runs code.
+    """
+
+    def __init__(self, max_entries: int, directory: str | None = None, max_disk_entries: int = 5000) -> None:
+        self.max_entries: int = max_entries
+        self.directory: str | None = directory
+        self.max_disk_entries: int = max_disk_entries
+        self._entries: OrderedDict[str, CachedPage] = OrderedDict()
+        self._lock = Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str, version: int) -> str:
+        return os.path.join(self.directory, str(version), hashlib.sha1(key.encode()).hexdigest())  # type: ignore
+
+    def get(self, key: str, version: int) -> CachedPage | None:
+        with self._lock:
+            page: CachedPage | None = self._entries.get(key)
+            if page is not None:
+                if page.version == version:
+                    self._entries.move_to_end(key)
+                    return page
+                del self._entries[key]
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key, version), 'rb') as f:
+                header: dict = json.loads(f.readline())
+                body: bytes = f.read()
+            last_modified: datetime | None = datetime.fromisoformat(header['last_modified']) if header['last_modified'] else None
+            page = CachedPage(version=version, body=body, mimetype=header['mimetype'], etag=header['etag'], last_modified=last_modified)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        self._remember(key, page)
+        return page
+
+    def set(self, key: str, page: CachedPage) -> None:
+        self._remember(key, page)
+        if self.directory is None:
+            return
+        version_directory: str = os.path.join(self.directory, str(page.version))
+        if not os.path.isdir(version_directory) and not self._start_version(page.version):
+            return
+        try:
+            if len(os.listdir(version_directory)) >= self.max_disk_entries:
+                return
+            header: dict = dict(mimetype=page.mimetype, etag=page.etag, last_modified=page.last_modified.isoformat() if page.last_modified else None)
+            # written to a temporary file first, so other workers never read a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=version_directory, prefix='.')
+        except OSError:
+            # another worker removed the directory when it wrote a newer version
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(header).encode() + b'\n' + page.body)
+            os.replace(tmp_path, self._path(key, page.version))
+        except OSError:
+            with suppress(OSError):
+                os.remove(tmp_path)
+
+    def _start_version(self, version: int) -> bool:
+        # removes the entries of the older versions, and those of the previous file layout, unless a newer version was already written
+        for name in os.listdir(self.directory):  # type: ignore
+            if name.isdigit() and int(name) > version:
+                return False
+        for name in os.listdir(self.directory):  # type: ignore
+            path: str = os.path.join(self.directory, name)  # type: ignore
+            if name.isdigit() and int(name) < version:
+                shutil.rmtree(path, ignore_errors=True)
+            elif not name.isdigit():
+                with suppress(OSError):
+                    os.remove(path)
+        os.makedirs(os.path.join(self.directory, str(version)), exist_ok=True)  # type: ignore
+        return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def _remember(self, key: str, page: CachedPage) -> None:
+        with self._lock:
+            self._entries[key] = page
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def _last_modified() -> datetime | None:
+    times: list[datetime] = [time for time in (db.session.scalar(select(func.max(Post.updated_time))), db.session.scalar(select(func.max(Comment.reviewed_time)).filter_by(reviewed=True))) if time is not None]
+    return max(times) if times else None
+
+
+def _render_page(view: Callable, version: int, *args, **kwargs) -> CachedPage | Any:
+    response = make_response(view(*args, **kwargs))
+    if response.status_code != 200 or response.mimetype != 'text/html' or '_flashes' in session:
+        return response
+    body: bytes = response.get_data()
+    etag: str | None = hashlib.sha1(body).hexdigest()
+    token: str | None = g.get('csrf_token')
+    if token and token.encode() in body:
+        body = body.replace(token.encode(), _CSRF_PLACEHOLDER)
+        etag = None
+    return CachedPage(version=version, body=body, mimetype=response.mimetype, etag=etag, last_modified=_last_modified())  # type: ignore
+
+
+def _page_response(page: CachedPage, cache_state: str):
+    if page.etag is not None and request.if_none_match.contains(page.etag):
+        response = current_app.response_class(status=304)
+    else:
+        body: bytes = page.body if page.etag is not None else page.body.replace(_CSRF_PLACEHOLDER, generate_csrf().encode())
+        response = current_app.response_class(body, mimetype=page.mimetype)
+    if page.etag is not None:
+        response.set_etag(page.etag)
+        response.cache_control.no_cache = True
+    if page.last_modified is not None:
+        response.last_modified = page.last_modified
+    response.vary.add('Cookie')
+    response.headers['X-Greybook-Cache'] = cache_state
+    return response
+
+
+def _page_key(args: dict[str, type]) -> str | None:
+    # the query arguments are converted, so '?page=01' and '?page=1' share an entry, other arguments are not cached at all
+    values: dict[str, Any] = {}
+    for name in request.args:
+        raw_values: list[str] = request.args.getlist(name)
+        if name not in args or len(raw_values) != 1:
+            return None
+        try:
+            values[name] = args[name](raw_values[0])
+        except ValueError:
+            return None
+    theme: str = request.cookies.get('theme', 'default')
+    if theme not in current_app.config['GREYBOOK_THEMES']:
+        theme = 'default'
+    return f'{theme}:{request.path}?{urlencode(sorted(values.items()))}'
+
+
+def cache_page(view: Callable | None = None, *, args: dict[str, type] | None = None) -> Callable:
+    """
+    Serve the view from the page cache for anonymous visitors.
+    - Pages are keyed on the path, the allowed query arguments and the theme cookie, and only cached for GET requests without pending flashed messages.
+    - Requests with other query arguments are not cached, so the entries are bounded by the pages of the blog.
+    - Cached pages are sent with a strong ETag and answered with 304 when the client already has them.
+
+    Parameters
+    ----------
+    args : dict[str, type] | None, optional
+        Query argument name -> type of the arguments the view reads, e.g. {'page': int}, by default None.
+    """
+    if view is None:
+        return lambda view: cache_page(view, args=args)
+    allowed_args: dict[str, type] = args or {}
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        page_cache: PageCache | None = current_app.extensions.get('greybook_page_cache')
+        key: str | None = _page_key(allowed_args) if page_cache is not None else None
+        if key is None or request.method not in ('GET', 'HEAD') or '_flashes' in session or current_user.is_authenticated:
+            return view(*args, **kwargs)
+
+        version: int = get_version(db.session, PAGES_NAMESPACE)
+        page: CachedPage | None = page_cache.get(key, version)
+        if page is not None:
+            return _page_response(page, 'HIT')
+
+        rendered: CachedPage | Any = _render_page(view, version, *args, **kwargs)
+        if not isinstance(rendered, CachedPage):
+            return rendered
+        page_cache.set(key, rendered)
+        return _page_response(rendered, 'MISS')
+
+    return wrapper
+
+
+def register_cache_handlers(app: Flask) -> None:
+    if app.config['GREYBOOK_PAGE_CACHE']:
+        app.extensions['greybook_page_cache'] = PageCache(app.config['GREYBOOK_PAGE_CACHE_SIZE'], app.config['GREYBOOK_PAGE_CACHE_DIR'], app.config['GREYBOOK_PAGE_CACHE_DISK_SIZE'])
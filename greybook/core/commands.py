@@ -1,5 +1,5 @@
+import json
 import os
-from calendar import c
 
 import click
 from flask import (
@@ -8,18 +8,21 @@ from flask import (
 )
 from sqlalchemy import select
 
-from ..fakes import (
-    fake_admin,
-    fake_categories,
-    fake_comments,
-    fake_links,
-    fake_posts,
-    fake_replies,
-)
+from ..config import basedir
 from ..models import (
     Admin,
     Category,
+    Post,
+    rebuild_comment_paths as rebuild_paths,
+    refresh_comment_counters,
+)
+from ..search import rebuild_search_index as rebuild_index
+from ..uploads import (
+    collect_unused_uploads,
+    index_post_images,
+    registry_is_missing,
 )
+from ..utils import summarize_html
 from .extensions import db
 
 
@@ -75,38 +78,218 @@ def register_commands(app: Flask) -> None:
             click.echo('Created the upload folder.')
         click.echo('Initialized the blog.')
 
+    @app.cli.command()
+    def rebuild_counters() -> None:
+        """Recompute the denormalized comment counters."""
+        refresh_comment_counters(db.session.connection())
+        db.session.commit()
+        click.echo('Rebuilt the comment counters.')
+
+    @app.cli.command()
+    def rebuild_comment_paths() -> None:
+        """Recompute the materialized reply paths of the comments."""
+        count: int = rebuild_paths(db.session.connection())
+        db.session.commit()
+        click.echo(f'Rebuilt the paths of {count} comments.')
+
+    @app.cli.command()
+    @click.option('--chunk-size', default=500, help='Quantity of posts loaded at a time, default is 500.')
+    def backfill_post_summaries(chunk_size: int) -> None:
+        """Recompute the excerpt, word count and reading time of every post."""
+        last_id: int = 0
+        count: int = 0
+        while posts := db.session.scalars(select(Post).where(Post.id > last_id).order_by(Post.id).limit(chunk_size)).all():
+            for post in posts:
+                post.excerpt, post.word_count, post.reading_time = summarize_html(post.body or '')  # type: ignore
+            last_id = posts[-1].id  # type: ignore
+            count += len(posts)
+            db.session.commit()
+        click.echo(f'Backfilled {count} post summaries.')
+
+    @app.cli.command()
+    @click.option('--chunk-size', default=1000, help='Quantity of rows indexed at a time, default is 1000.')
+    def rebuild_search_index(chunk_size: int) -> None:
+        """Rebuild the full-text search index of posts and comments."""
+        posts, comments = rebuild_index(chunk_size)
+        click.echo(f'Indexed {posts} posts and {comments} comments.')
+
+    @app.cli.group()
+    def outbox() -> None:
+        """Manage the email outbox."""
+
+    @outbox.command()
+    def drain() -> None:
+        """Send every due email of the outbox."""
+        sent, failed = current_app.extensions['greybook_outbox'].drain()
+        click.echo(f'Sent {sent} emails, {failed} failed.')
+        if current_app.extensions['greybook_outbox'].breaker.is_open:
+            click.echo('The SMTP server is unavailable, stopped sending.')
+
+    @app.cli.group()
+    def uploads() -> None:
+        """Manage the uploaded images."""
+
+    @uploads.command('index')
+    @click.option('--chunk-size', default=500, help='Quantity of posts loaded at a time, default is 500.')
+    def index_uploads(chunk_size: int) -> None:
+        """Register the uploaded images used by the existing posts."""
+        count: int = index_post_images(chunk_size)
+        click.echo(f'Registered {count} post images.')
+
+    @uploads.command()
+    @click.option('--grace-hours', default=24.0, help='Keep the files modified in the last hours, default is 24.')
+    @click.option('--batch-size', default=500, help='Quantity of files looked up at a time, default is 500.')
+    @click.option('--dry-run', is_flag=True, help='Only list the unused files.')
+    def gc(grace_hours: float, batch_size: int, dry_run: bool) -> None:
+        """Remove the uploaded images no post uses."""
+        if registry_is_missing():
+            raise click.ClickException("The images of the existing posts are not registered, run 'flask uploads index' first.")
+        scanned, removed = collect_unused_uploads(current_app.config['GREYBOOK_UPLOAD_PATH'], grace_hours * 60 * 60, batch_size, dry_run)
+        for filename in removed:
+            click.echo(filename)
+        click.echo(f'{"Found" if dry_run else "Removed"} {len(removed)} unused files of {scanned}.')
+
     @app.cli.command()
     @click.option('--category', default=10, help='Quantity of categories, default is 10.')
     @click.option('--post', default=50, help='Quantity of posts, default is 50.')
     @click.option('--comment', default=200, help='Quantity of comments, default is 200.')
     @click.option('--reply', default=50, help='Quantity of replies, default is 50.')
+    @click.option('--seed', default=0, help='Seed of the generated data, the same seed and quantities give the same data, default is 0.')
+    @click.option('--chunk-size', default=1000, help='Quantity of rows generated and inserted at a time, default is 1000.')
+    @click.option('--workers', default=0, help='Quantity of processes generating the rows, default is 0 generates them in this process.')
     def fake(
         category: int,
         post: int,
         comment: int,
         reply: int,
+        seed: int,
+        chunk_size: int,
+        workers: int,
     ) -> None:
         """Generate fake data."""
-        db.drop_all()
-        db.create_all()
-        click.echo('Initialized the database...')
+        # Faker is slow to import, so it is only loaded by this command
+        from ..fakes import fake_dataset
 
-        fake_admin()
-        click.echo('Generated the administrator.')
+        fake_dataset(category, post, comment, reply, seed, chunk_size, workers, echo=click.echo)
+        click.echo('Finished generating fake data.')
 
-        fake_categories(category)
-        click.echo(f'Generated {category} categories.')
+    @app.cli.command()
+    def compile_templates() -> None:
+        """Compile every template into the bytecode cache."""
+        if current_app.config['GREYBOOK_TEMPLATE_CACHE_DIR'] is None:
+            raise click.ClickException('GREYBOOK_TEMPLATE_CACHE_DIR is not set.')
+        names: list[str] = current_app.jinja_env.list_templates(extensions=['html'])
+        for name in names:
+            current_app.jinja_env.get_template(name)
+        click.echo(f'Compiled {len(names)} templates into {current_app.config["GREYBOOK_TEMPLATE_CACHE_DIR"]}.')
 
-        fake_posts(post)
-        click.echo(f'Generated {post} posts.')
+    @app.cli.command()
+    @click.option('--checkpoint', type=click.Choice(['passive', 'full', 'restart', 'truncate']), default='truncate', help='Mode of the WAL checkpoint, default is truncate.')
+    def optimize_db(checkpoint: str) -> None:
+        """Refresh the SQLite query planner statistics and checkpoint the WAL, run it periodically, e.g. hourly from cron."""
+        if db.engine.dialect.name != 'sqlite':
+            raise click.ClickException('optimize-db only supports SQLite.')
+        # the driver connection runs the pragmas outside of a transaction, a checkpoint can not complete inside one
+        connection = db.engine.raw_connection()
+        try:
+            connection.driver_connection.execute('PRAGMA optimize')  # type: ignore
+            busy, log_pages, checkpointed = connection.driver_connection.execute(f'PRAGMA wal_checkpoint({checkpoint.upper()})').fetchone()  # type: ignore
+        finally:
+            connection.close()
+        if log_pages < 0:
+            click.echo('Optimized the database, it is not in WAL mode.')
+        else:
+            click.echo(f'Optimized the database, checkpointed {checkpointed} of {log_pages} WAL pages{" (busy, retry later)" if busy else ""}.')
 
-        fake_comments(comment)
-        click.echo(f'Generated {comment} comments.')
+    @app.cli.group()
+    def bench() -> None:
+        """Measure the performance of the application."""
 
-        fake_replies(reply)
-        click.echo(f'Generated {reply} replies.')
+    @bench.command()
+    @click.option('--config', 'config_name', default='production', help='Configuration of the measured application, default is production.')
+    @click.option('--runs', default=5, help='Quantity of measured processes, default is 5.')
+    @click.option('--top', default=10, help='Quantity of imported packages listed, default is 10.')
+    def startup(config_name: str, runs: int, top: int) -> None:
+        """Report the import and app factory time of a cold start, split by phase."""
+        from ..bench import measure_startup
 
-        fake_links()
-        click.echo('Generated links.')
+        phases: dict[str, float] = measure_startup(config_name, runs)
+        packages: list[tuple[str, float]] = sorted(((phase, seconds) for phase, seconds in phases.items() if phase.startswith('import ')), key=lambda item: item[1], reverse=True)
+        click.echo(f'Cold start of the {config_name} application, median of {runs} runs:')
+        click.echo(f'{"import greybook":<42}{phases["import"] * 1000:>9.1f} ms')
+        for phase, seconds in packages[:top]:
+            click.echo(f'  {phase:<40}{seconds * 1000:>9.1f} ms')
+        click.echo(f'  {"other packages":<40}{sum(seconds for _, seconds in packages[top:]) * 1000:>9.1f} ms')
+        click.echo(f'{"create_app":<42}{phases["create_app"] * 1000:>9.1f} ms')
+        for phase, seconds in phases.items():
+            if phase.startswith('create_app '):
+                click.echo(f'  {phase.removeprefix("create_app "):<40}{seconds * 1000:>9.1f} ms')
+        click.echo(f'{"total":<42}{(phases["import"] + phases["create_app"]) * 1000:>9.1f} ms')
 
-        click.echo('Finished generating fake data.')
+    @bench.command()
+    @click.option('--dataset', default='small', help='Dataset to load, one of small, posts-10k and comments-1m, default is small.')
+    @click.option('--seed', default=0, help='Seed of the dataset, default is 0.')
+    @click.option('--requests', default=50, help='Quantity of timed requests per endpoint, default is 50.')
+    @click.option('--warmup', default=5, help='Quantity of requests sent before the timed ones, default is 5.')
+    @click.option('--output', type=click.Path(dir_okay=False), help='JSON file to write the results into.')
+    @click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='JSON results to compare with, regressions make the command fail.')
+    @click.option('--tolerance', default=0.25, help='Allowed relative increase of the p95 latencies, default is 0.25.')
+    @click.option('--data-dir', default=os.path.join(basedir, '.cache', 'bench'), help='Directory of the generated datasets, default is .cache/bench.')
+    @click.option('--workers', default=0, help='Quantity of processes generating a missing dataset, default is 0.')
+    @click.option('--page-cache', is_flag=True, help='Keep the cache of the rendered pages.')
+    def endpoints(dataset: str, seed: int, requests: int, warmup: int, output: str | None, baseline: str | None, tolerance: float, data_dir: str, workers: int, page_cache: bool) -> None:
+        """Measure the latency, queries and memory of the main endpoints on a seeded dataset."""
+        from ..bench import (
+            DATASETS,
+            benchmark_endpoints,
+            compare_results,
+            create_bench_app,
+            load_dataset,
+            results_document,
+        )
+
+        if dataset not in DATASETS:
+            raise click.BadParameter(f'choose from {", ".join(DATASETS)}.', param_hint='--dataset')
+        bench_app = create_bench_app(page_cache)
+        load_dataset(bench_app, dataset, seed, data_dir, workers, echo=click.echo)
+        results = results_document(dataset, seed, benchmark_endpoints(bench_app, requests, warmup))
+        click.echo(f'{"endpoint":<20}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"queries":>9}{"peak KiB":>10}')
+        for name, result in results['endpoints'].items():
+            click.echo(f'{name:<20}{result["p50_ms"]:>10.1f}{result["p95_ms"]:>10.1f}{result["p99_ms"]:>10.1f}{result["queries"]:>9}{result["peak_memory_kb"]:>10.0f}')
+        if output:
+            with open(output, 'w') as file:
+                json.dump(results, file, indent=2)
+            click.echo(f'Wrote the results to {output}.')
+        if baseline:
+            with open(baseline) as file:
+                try:
+                    regressions: list[str] = compare_results(results, json.load(file), tolerance)
+                except ValueError as error:
+                    raise click.ClickException(str(error)) from error
+            if regressions:
+                raise click.ClickException('Regressions against the baseline:\n' + '\n'.join(regressions))
+            click.echo('No regression against the baseline.')
+
+    @bench.command()
+    @click.option('--dataset', default='small', help='Dataset to copy, one of small, posts-10k and comments-1m, default is small.')
+    @click.option('--readers', default=8, help='Quantity of reading threads, default is 8.')
+    @click.option('--writers', default=2, help='Quantity of writing threads, default is 2.')
+    @click.option('--seconds', default=5.0, help='Duration of each run, default is 5.')
+    @click.option('--data-dir', default=os.path.join(basedir, '.cache', 'bench'), help='Directory of the generated datasets, default is .cache/bench.')
+    def sqlite(dataset: str, readers: int, writers: int, seconds: float, data_dir: str) -> None:
+        """Compare the concurrent read and write throughput of SQLite with the driver defaults and with GREYBOOK_SQLITE_PRAGMAS."""
+        from ..bench import (
+            DATASETS,
+            create_bench_app,
+            load_dataset,
+            measure_sqlite_concurrency,
+        )
+
+        if dataset not in DATASETS:
+            raise click.BadParameter(f'choose from {", ".join(DATASETS)}.', param_hint='--dataset')
+        path: str = load_dataset(create_bench_app(), dataset, data_dir=data_dir, echo=click.echo)
+        click.echo(f'{readers} readers and {writers} writers for {seconds:g}s each:')
+        click.echo(f'{"":<10}{"reads/s":>10}{"writes/s":>10}{"locked":>8}')
+        for label, tuned in (('default', False), ('tuned', True)):
+            result = measure_sqlite_concurrency(path, tuned, current_app.config['GREYBOOK_SQLITE_PRAGMAS'], readers, writers, seconds)
+            click.echo(f'{label:<10}{result.reads_per_second:>10.0f}{result.writes_per_second:>10.0f}{result.locked_errors:>8}')
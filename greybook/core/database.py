@@ -0,0 +1,119 @@
+from collections.abc import (
+    Callable,
+    Mapping,
+)
+from typing import Literal
+
+from flask import (
+    Flask,
+    current_app,
+    g,
+    has_request_context,
+    request,
+    session,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import (
+    Connection,
+    Engine,
+)
+
+from .extensions import db
+
+# methods of the requests that only read, the others begin their transactions as writers
+_READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# blueprints whose read-only requests use the 'read' bind
+_READ_BLUEPRINTS = ('blog',)
+
+type DatabaseRoute = Literal['primary', 'read']
+
+
+def use_database(route: DatabaseRoute) -> Callable[[Callable], Callable]:
+    """
+    Choose the database of a view, whatever its blueprint and the request method.
+    - Apply it under 'cache_page', the wrapper keeps the choice.
+
+    Parameters
+    ----------
+    route : DatabaseRoute
+        'primary' for the views that write or must see the latest writes, 'read' for the views that only read.
+    """
+
+    def decorator(view: Callable) -> Callable:
+        view.database_route = route  # type: ignore
+        return view
+
+    return decorator
+
+
+def _database_route() -> DatabaseRoute:
+    view: Callable | None = current_app.view_functions.get(request.endpoint) if request.endpoint else None
+    if (route := getattr(view, 'database_route', None)) is not None:
+        return route
+    # a logged-in admin reads the primary database, so the pages show the changes just made, whatever the replica lag
+    if request.method in _READ_METHODS and request.blueprint in _READ_BLUEPRINTS and '_user_id' not in session:
+        return 'read'
+    return 'primary'
+
+
+def configure_sqlite(engine: Engine, pragmas: Mapping[str, str | int], immediate_writes: bool = True) -> None:
+    """
+    Set the pragmas of every new connection of a SQLite engine, and take the write lock at the start of the write transactions.
+    - pysqlite begins its transactions itself, on the first write, this hands them to the 'begin' event.
+    - A transaction that reads then writes can not wait for the lock in WAL mode: it fails with "database is locked" as soon as another
+      connection committed in between. 'BEGIN IMMEDIATE' takes the lock first, so it waits for up to 'busy_timeout' instead.
+
+    Parameters
+    ----------
+    engine : Engine
+        SQLite engine.
+    pragmas : Mapping[str, str | int]
+        Pragma name -> value, e.g. {'journal_mode': 'wal'}.
+    immediate_writes : bool, optional
+        Begin the transactions of the unsafe requests, and of the connections with the 'greybook_begin' execution option set
+        to 'IMMEDIATE', with 'BEGIN IMMEDIATE', by default True.
+    """
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record) -> None:
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection: Connection) -> None:
+        dbapi_connection = connection.connection.driver_connection
+        # the single connection of an in-memory database may already be in the transaction of another session
+        if dbapi_connection.in_transaction:  # type: ignore
+            return
+        mode: str = connection.get_execution_options().get('greybook_begin', '')
+        if not mode and immediate_writes and has_request_context() and request.method not in _READ_METHODS:
+            mode = 'IMMEDIATE'
+        # sent by the driver, so it is not counted with the statements of the request
+        dbapi_connection.execute(f'BEGIN {mode}'.rstrip())  # type: ignore
+
+
+def register_database(app: Flask) -> None:
+    with app.app_context():
+        engines: dict[str | None, Engine] = dict(db.engines)
+    for bind_key, engine in engines.items():
+        if engine.dialect.name != 'sqlite':
+            continue
+        if bind_key == 'read':
+            # the journal mode is set by the primary connections, the read ones refuse to write even to a writable replica file
+            pragmas: dict[str, str | int] = {name: value for name, value in app.config['GREYBOOK_SQLITE_PRAGMAS'].items() if name != 'journal_mode'}
+            configure_sqlite(engine, {**pragmas, 'query_only': 1}, immediate_writes=False)
+        else:
+            configure_sqlite(engine, app.config['GREYBOOK_SQLITE_PRAGMAS'], app.config['GREYBOOK_SQLITE_IMMEDIATE_WRITES'])
+
+    if 'read' not in engines:
+        return
+
+    @app.before_request
+    def route_database() -> None:
+        g.database_route = _database_route()
+        if g.database_route == 'read':
+            # nothing is written in a read-only request, so the queries never flush first
+            db.session.autoflush = False
@@ -1,48 +1,111 @@
+import time
+from typing import Any
+
 import click
-from flask import Flask
+from flask import (
+    Flask,
+    current_app,
+    g,
+    has_request_context,
+)
 from flask_bootstrap import Bootstrap5
 from flask_ckeditor import CKEditor
-from flask_debugtoolbar import DebugToolbarExtension
 from flask_login import LoginManager
 from flask_mailman import Mail
-from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as BindSession
 from flask_wtf import CSRFProtect
+from sqlalchemy.engine import (
+    Connection,
+    Engine,
+)
+from sqlalchemy.orm import Session
+
+
+class RoutingSession(BindSession):
+    """
+    Session sending the reads of the read-only requests to the 'read' bind, see 'register_database'.
+    - The flushes and the INSERT, UPDATE and DELETE statements always use the primary engine.
+    """
+
+    def get_bind(self, mapper: Any | None = None, clause: Any | None = None, bind: Engine | Connection | None = None, **kwargs: Any) -> Engine | Connection:
+        if bind is None and not self._flushing and not getattr(clause, 'is_dml', False) and has_request_context() and g.get('database_route') == 'read':
+            read_engine: Engine | None = self._db.engines.get('read')
+            if read_engine is not None:
+                return read_engine
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
 
 extensions: list = [
     bootstrap := Bootstrap5(),
     ckeditor := CKEditor(),
     csrf := CSRFProtect(),
-    debugtoolbar := DebugToolbarExtension(),
-    db := SQLAlchemy(),
+    db := SQLAlchemy(session_options={'class_': RoutingSession}),
     login_manager := LoginManager(),
     mail := Mail(),
-    migrate := Migrate(),
 ]
 
 
 def register_extensions(app: Flask) -> None:
+    # the engines are created by 'init_app', the read-only one is an extra bind without models
+    if app.config['GREYBOOK_READ_DATABASE_URI']:
+        app.config['SQLALCHEMY_BINDS'] = {**app.config.get('SQLALCHEMY_BINDS', {}), 'read': app.config['GREYBOOK_READ_DATABASE_URI']}
     for extension in extensions:
-        match extension:
-            case Migrate():
-                extension.init_app(app, db=db)
-            case _:
-                extension.init_app(app)
+        extension.init_app(app)
+    # the debug toolbar and Flask-Migrate (Alembic) are the slowest imports, they are only loaded where they are used
+    if app.debug and app.config['DEBUG_TB_ENABLED']:
+        from flask_debugtoolbar import DebugToolbarExtension
+
+        DebugToolbarExtension(app)
+    # an application created by the 'flask' command runs in a click context, one created by a WSGI server does not
+    if click.get_current_context(silent=True) is not None:
+        from flask_migrate import Migrate
+
+        Migrate(app, db)
+    # session user id -> (expiry, detached admin), shared by the requests of the process for 'GREYBOOK_USER_CACHE_TTL' seconds
+    app.extensions['greybook_users'] = {}
+
+
+def forget_user(id: str | None = None) -> None:
+    """
+    Drop a cached user, or every cached user if no id is given.
+
+    Parameters
+    ----------
+    id : str | None, optional
+        Session user id, see 'Admin.get_id'.
+    """
+    users: dict[str, tuple[float, Any]] = current_app.extensions['greybook_users']
+    if id is None:
+        users.clear()
+    else:
+        users.pop(id, None)
 
 
 @login_manager.user_loader
 def load_user(id: str):
-    match id:
-        case int():
-            click.echo(f'id is int: {id}')
-        case str():
-            click.echo(f'id is str: {id}')
-        case _:
-            click.echo(f'id is not int or str: {id}')
+    """
+    Load the admin of a session id, from the process cache if it is still fresh.
+    - The id carries the session version of the admin, so a password change invalidates the sessions and remember cookies.
+    - Other processes may keep a changed admin for up to 'GREYBOOK_USER_CACHE_TTL' seconds.
+    """
     from ..models import Admin
 
-    user = db.session.get(Admin, int(id))
-    return user
+    users: dict[str, tuple[float, Any]] = current_app.extensions['greybook_users']
+    now: float = time.monotonic()
+    entry: tuple[float, Any] | None = users.get(id)
+    if entry is None or entry[0] < now:
+        admin_id, _, version = id.partition(':')
+        if not admin_id.isdigit():
+            return None
+        # loaded in its own session, so the cached admin is detached and can be shared by the requests
+        with Session(bind=db.session.connection(), expire_on_commit=False) as session:
+            admin = session.get(Admin, int(admin_id))
+        if admin is None or str(admin.session_version) != version:
+            forget_user(id)
+            return None
+        entry = users[id] = (now + current_app.config['GREYBOOK_USER_CACHE_TTL'], admin)
+    return db.session.merge(entry[1], load=False)
 
 
 login_manager.login_view = 'auth.login'  # type: ignore
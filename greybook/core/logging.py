@@ -1,43 +1,161 @@
+import atexit
+import copy
+import json
 import os
+import time
+from collections import (
+    defaultdict,
+    deque,
+)
 from logging import (
     DEBUG,
     ERROR,
     INFO,
+    Filter,
     Formatter,
+    LogRecord,
 )
 from logging.handlers import (
+    QueueHandler,
+    QueueListener,
     RotatingFileHandler,
     SMTPHandler,
 )
+from queue import SimpleQueue
 
-from flask import request
+from flask import (
+    has_request_context,
+    request,
+)
 from flask.logging import default_handler
 
 from ..config import basedir
 
 
+class RequestContextFilter(Filter):
+    """
+    Copy the request details into the records in the request thread, the handlers format them in the listener thread.
+    """
+
+    def filter(self, record: LogRecord) -> bool:
+        record.url = request.url if has_request_context() else None
+        record.remote_addr = request.remote_addr if has_request_context() else None
+        # errors are told apart by the line that raised them, the logging call of an unhandled exception is always the same
+        if record.exc_info and record.exc_info[2] is not None:
+            traceback = record.exc_info[2]
+            while traceback.tb_next is not None:
+                traceback = traceback.tb_next
+            record.fingerprint = (record.exc_info[0].__name__, traceback.tb_frame.f_code.co_filename, traceback.tb_lineno)  # type: ignore
+        else:
+            record.fingerprint = (record.pathname, record.lineno)
+        return True
+
+
+class RequestQueueHandler(QueueHandler):
+    def prepare(self, record: LogRecord) -> LogRecord:
+        # the message and the traceback are rendered now, their arguments and frames must not be kept alive by the queue
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = Formatter().formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+
+class RequestFormatter(Formatter):
+    def format(self, record: LogRecord) -> str:
+        message: str = super().format(record)
+        if suppressed := getattr(record, 'suppressed', 0):
+            message += f'\n\n{suppressed} similar errors were not emailed.'
+        return message
+
+
+class JsonFormatter(Formatter):
+    """
+    Format records as one JSON object per line.
+    """
+
+    def format(self, record: LogRecord) -> str:
+        entry: dict = dict(time=self.formatTime(record), level=record.levelname, logger=record.name, module=record.module, message=record.getMessage())
+        if getattr(record, 'url', None) is not None:
+            entry.update(url=record.url, remote_addr=record.remote_addr)  # type: ignore
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class ErrorMailFilter(Filter):
+    """
+    Rate limit the error emails, run by the listener thread.
+    - An error is emailed at most once per interval, the next email of the error tells how many were skipped.
+    - At most 'limit' emails are sent per interval, whatever the errors.
+    """
+
+    def __init__(self, interval: float, limit: int) -> None:
+        super().__init__()
+        self.interval: float = interval
+        self.limit: int = limit
+        self._last_sent: dict[tuple, float] = {}
+        self._suppressed: dict[tuple, int] = defaultdict(int)
+        self._sent_times: deque[float] = deque()
+
+    def filter(self, record: LogRecord) -> bool:
+        now: float = time.monotonic()
+        while self._sent_times and self._sent_times[0] <= now - self.interval:
+            self._sent_times.popleft()
+        fingerprint: tuple = getattr(record, 'fingerprint', (record.pathname, record.lineno))
+        last_sent: float | None = self._last_sent.get(fingerprint)
+        if (last_sent is not None and now - last_sent < self.interval) or len(self._sent_times) >= self.limit:
+            self._suppressed[fingerprint] += 1
+            return False
+        self._last_sent[fingerprint] = now
+        self._sent_times.append(now)
+        record.suppressed = self._suppressed.pop(fingerprint, 0)
+        return True
+
+
 def register_logging(app) -> None:
-    class RequestFormatter(Formatter):
-        def format(self, record):
-            record.url = request.url
-            record.remote_addr = request.remote_addr
-            return super().format(record)
+    # 'app.logger' is shared by the applications of the process, so the queue of a previous application is replaced
+    for handler in [handler for handler in app.logger.handlers if isinstance(handler, RequestQueueHandler)]:
+        app.logger.removeHandler(handler)
+        handler.listener.stop()  # type: ignore
+        atexit.unregister(handler.listener.stop)  # type: ignore
 
+    if app.debug:
+        app.logger.setLevel(DEBUG)
+        app.logger.addHandler(default_handler)
+        return
+
+    # the tests read the records with pytest, they write no log file and start no listener thread
+    if app.testing:
+        return
+
+    # the handlers are only built where they are used
     request_formatter = RequestFormatter('[%(asctime)s] %(remote_addr)s requested %(url)s\n' '%(levelname)s in %(module)s: %(message)s')
 
-    formatter = Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    formatter = JsonFormatter() if app.config['GREYBOOK_LOG_FORMAT'] == 'json' else Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
+    os.makedirs(os.path.join(basedir, 'logs'), exist_ok=True)
     file_handler = RotatingFileHandler(os.path.join(basedir, 'logs/greybook.log'), maxBytes=10 * 1024 * 1024, backupCount=10)
     file_handler.setFormatter(formatter)
     file_handler.setLevel(INFO)
 
-    mail_handler = SMTPHandler(mailhost=app.config['MAIL_SERVER'], fromaddr=app.config['MAIL_USERNAME'], toaddrs=['ADMIN_EMAIL'], subject='Greybook Application Error', credentials=(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD']))
-    mail_handler.setLevel(ERROR)
-    mail_handler.setFormatter(request_formatter)
+    handlers: list = [file_handler]
+    if app.config['MAIL_SERVER'] and app.config['GREYBOOK_ADMIN_EMAIL']:
+        mail_handler = SMTPHandler(mailhost=app.config['MAIL_SERVER'], fromaddr=app.config['MAIL_USERNAME'], toaddrs=[app.config['GREYBOOK_ADMIN_EMAIL']], subject='Greybook Application Error', credentials=(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD']))
+        mail_handler.setLevel(ERROR)
+        mail_handler.setFormatter(request_formatter)
+        mail_handler.addFilter(ErrorMailFilter(app.config['GREYBOOK_ERROR_MAIL_INTERVAL'], app.config['GREYBOOK_ERROR_MAIL_LIMIT']))
+        handlers.append(mail_handler)
 
-    if not app.debug:
-        app.logger.addHandler(mail_handler)
-        app.logger.addHandler(file_handler)
-    else:
-        app.logger.setLevel(DEBUG)
-        app.logger.addHandler(default_handler)
+    # the request thread only puts the records in the queue, the disk and SMTP writes are done by the listener thread
+    log_queue: SimpleQueue = SimpleQueue()
+    queue_handler = RequestQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    queue_handler.listener = listener
+    app.logger.addHandler(queue_handler)
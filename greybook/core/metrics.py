@@ -0,0 +1,128 @@
+import time
+from bisect import bisect_left
+from collections.abc import Sequence
+from threading import Lock
+
+from flask import (
+    Flask,
+    Response,
+    abort,
+    before_render_template,
+    g,
+    request,
+    request_started,
+    template_rendered,
+)
+from flask_login import current_user
+
+from .request import QueryStats
+
+_DURATION_BUCKETS: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_QUERY_BUCKETS: tuple[float, ...] = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+_LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+
+class Histogram:
+    """
+    Prometheus histogram of one metric, with one series per label value.
+    """
+
+    def __init__(self, name: str, help: str, label: str, buckets: Sequence[float]) -> None:
+        self.name: str = name
+        self.help: str = help
+        self.label: str = label
+        self.buckets: tuple[float, ...] = tuple(buckets)
+        # label value -> (count per bucket, the last one for +Inf, sum)
+        self._series: dict[str, tuple[list[int], list[float]]] = {}
+        self._lock = Lock()
+
+    def observe(self, label_value: str, value: float) -> None:
+        with self._lock:
+            counts, total = self._series.setdefault(label_value, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def render(self) -> list[str]:
+        """
+        Returns
+        -------
+        list[str]
+            The lines of the histogram in the Prometheus text format, with cumulative buckets.
+        """
+        lines: list[str] = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((label_value, list(counts), total[0]) for label_value, (counts, total) in self._series.items())
+        for label_value, counts, total in series:
+            label: str = f'{self.label}="{_escape_label(label_value)}"'
+            cumulative: int = 0
+            for bound, count in zip((*(f'{bucket:g}' for bucket in self.buckets), '+Inf'), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label}}} {total:g}')
+            lines.append(f'{self.name}_count{{{label}}} {cumulative}')
+        return lines
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """
+    Latency, query and template histograms aggregated in memory, each worker process exposes its own.
+    """
+
+    def __init__(self) -> None:
+        self.request_duration = Histogram('greybook_request_duration_seconds', 'Time spent handling requests.', 'endpoint', _DURATION_BUCKETS)
+        self.request_queries = Histogram('greybook_request_queries', 'Queries executed by requests.', 'endpoint', _QUERY_BUCKETS)
+        self.template_duration = Histogram('greybook_template_render_seconds', 'Time spent rendering templates.', 'template', _DURATION_BUCKETS)
+
+    def render(self) -> str:
+        return '\n'.join([*self.request_duration.render(), *self.request_queries.render(), *self.template_duration.render()]) + '\n'
+
+
+def _start_request(app: Flask, **extra) -> None:
+    g.request_start_time = time.perf_counter()
+
+
+def _start_render(app: Flask, template, context, **extra) -> None:
+    g.setdefault('render_start_times', []).append(time.perf_counter())
+
+
+def _end_render(app: Flask, template, context, **extra) -> None:
+    # nested renders, e.g. 'render_template' called from a template, are only counted once in the request total
+    start_times: list[float] = g.setdefault('render_start_times', [])
+    if not start_times:
+        return
+    duration: float = time.perf_counter() - start_times.pop()
+    if not start_times:
+        g.render_duration = g.get('render_duration', 0.0) + duration
+    app.extensions['greybook_metrics'].template_duration.observe(template.name or '<template>', duration)
+
+
+def register_metrics(app: Flask) -> None:
+    metrics = app.extensions['greybook_metrics'] = Metrics()
+    request_started.connect(_start_request, app)
+    before_render_template.connect(_start_render, app)
+    template_rendered.connect(_end_render, app)
+
+    @app.after_request
+    def record_metrics(response: Response) -> Response:
+        if 'request_start_time' not in g:
+            return response
+        duration: float = time.perf_counter() - g.request_start_time
+        stats: QueryStats = g.get('query_stats') or QueryStats()
+        endpoint: str = request.endpoint or '<unmatched>'
+        metrics.request_duration.observe(endpoint, duration)
+        metrics.request_queries.observe(endpoint, stats.count)
+        if app.config['GREYBOOK_SERVER_TIMING']:
+            response.headers['Server-Timing'] = f'db;dur={stats.duration * 1000:.1f};desc="{stats.count} queries", render;dur={g.get("render_duration", 0.0) * 1000:.1f}, total;dur={duration * 1000:.1f}'
+        return response
+
+    @app.route('/metrics')
+    def show_metrics() -> Response:
+        # a request relayed by a local proxy carries 'X-Forwarded-For', so it is not taken for a local one
+        is_local: bool = request.remote_addr in _LOCAL_ADDRESSES and 'X-Forwarded-For' not in request.headers
+        if not is_local and not current_user.is_authenticated:
+            abort(404)
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
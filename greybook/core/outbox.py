@@ -0,0 +1,268 @@
+import random
+import smtplib
+import time
+from datetime import timedelta
+from threading import (
+    Event,
+    Lock,
+    Thread,
+)
+
+from flask import (
+    Flask,
+    current_app,
+)
+from flask_mailman import EmailMessage
+from sqlalchemy import (
+    event,
+    select,
+    update,
+)
+from sqlalchemy.orm import Session
+
+from ..models import (
+    OutboxMessage,
+    utcnow,
+)
+from .extensions import (
+    db,
+    mail,
+)
+
+# session.info key set when a message is queued, so the commit wakes the sender
+_PENDING_KEY = 'greybook_outbox_pending'
+# a claimed message is retried by another sender if it is not sent within the lease
+_LEASE = timedelta(minutes=5)
+# errors of a single message, the SMTP connection stays usable for the rest of the batch
+_MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+def queue_mail(subject: str, body: str, to: str) -> OutboxMessage:
+    """
+    Add an HTML email to the outbox, it is sent after the current transaction is committed.
+
+    Parameters
+    ----------
+    subject : str
+        Email subject.
+    body : str
+        Email HTML body.
+    to : str
+        Email recipient.
+
+    Returns
+    -------
+    OutboxMessage
+        The queued message, added to the session.
+    """
+    message = OutboxMessage(subject=subject, body=body, to=to)  # type: ignore
+    db.session.add(message)
+    db.session.info[_PENDING_KEY] = True
+    return message
+
+
+def queue_digest(key: str, subject: str, to: str, window: timedelta) -> OutboxMessage:
+    """
+    Get the pending digest email of a key, or queue a new one sent once the window is over.
+
+    Parameters
+    ----------
+    key : str
+        Kind of the digest.
+    subject : str
+        Email subject of a new digest.
+    to : str
+        Email recipient.
+    window : timedelta
+        Delay between the creation of a digest and its sending.
+
+    Returns
+    -------
+    OutboxMessage
+        The digest message, whose body is left to the caller.
+    """
+    now = utcnow()
+    # a digest is only updated before it is due, so a sender never claims it while it is changed
+    message: OutboxMessage | None = db.session.scalar(select(OutboxMessage).where(OutboxMessage.digest_key == key, OutboxMessage.to == to, OutboxMessage.attempts == 0, OutboxMessage.created_time > now - window).order_by(OutboxMessage.id.desc()).limit(1))
+    if message is None:
+        message = queue_mail(subject, '', to)
+        message.digest_key = key  # type: ignore
+        message.created_time = now  # type: ignore
+        message.next_attempt_time = now + window  # type: ignore
+    return message
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_sender(session: Session) -> None:
+    if session.info.pop(_PENDING_KEY, False) and (sender := current_app.extensions.get('greybook_outbox')) is not None:
+        sender.wake()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_pending(session: Session, previous_transaction) -> None:
+    session.info.pop(_PENDING_KEY, None)
+
+
+class CircuitBreaker:
+    """
+    Stop contacting the SMTP server for 'cooldown' seconds after 'threshold' consecutive connection failures.
+    - Once the cooldown is over, one more failure opens the breaker again, one success closes it.
+    """
+
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self.threshold: int = threshold
+        self.cooldown: float = cooldown
+        self._failures: int = 0
+        self._opened_until: float = 0.0
+        self._lock = Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return time.monotonic() < self._opened_until
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_until = 0.0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                self._opened_until = time.monotonic() + self.cooldown
+
+
+class OutboxSender:
+    """
+    Bounded pool of threads sending the outbox, each batch of messages through one SMTP connection.
+    - The threads are started by the first commit that queues a message, and then poll the outbox every 'GREYBOOK_OUTBOX_POLL_INTERVAL' seconds.
+    - Messages are claimed with a lease, so several processes can send the same outbox without sending a message twice.
+    - A failed message is retried with exponential backoff and given up after 'GREYBOOK_OUTBOX_MAX_ATTEMPTS' attempts.
+    """
+
+    def __init__(self, app: Flask) -> None:
+        self.app: Flask = app
+        self.workers: int = app.config['GREYBOOK_OUTBOX_WORKERS']
+        self.batch_size: int = app.config['GREYBOOK_OUTBOX_BATCH_SIZE']
+        self.poll_interval: float = app.config['GREYBOOK_OUTBOX_POLL_INTERVAL']
+        self.max_attempts: int = app.config['GREYBOOK_OUTBOX_MAX_ATTEMPTS']
+        self.retry_delay: float = app.config['GREYBOOK_OUTBOX_RETRY_DELAY']
+        self.breaker = CircuitBreaker(app.config['GREYBOOK_OUTBOX_BREAKER_THRESHOLD'], app.config['GREYBOOK_OUTBOX_BREAKER_COOLDOWN'])
+        self._wakeup = Event()
+        self._threads: list[Thread] = []
+        self._lock = Lock()
+
+    def wake(self) -> None:
+        """
+        Start the sender threads if needed and make one of them check the outbox.
+        """
+        if not self.workers:
+            return
+        with self._lock:
+            if not self._threads:
+                self._threads = [Thread(target=self._run, name=f'greybook-outbox-{i}', daemon=True) for i in range(self.workers)]
+                for thread in self._threads:
+                    thread.start()
+        self._wakeup.set()
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            with self.app.app_context():
+                try:
+                    self.drain()
+                except Exception:
+                    self.app.logger.exception('Failed to send the outbox.')
+                finally:
+                    db.session.remove()
+
+    def drain(self) -> tuple[int, int]:
+        """
+        Send batches of due messages until none is left or the circuit breaker opens.
+
+        Returns
+        -------
+        tuple[int, int]
+            The quantity of sent messages and of messages scheduled for a retry or given up.
+        """
+        sent: int = 0
+        failed: int = 0
+        while True:
+            batch_sent, batch_failed = self.send_batch()
+            if not batch_sent and not batch_failed:
+                return sent, failed
+            sent += batch_sent
+            failed += batch_failed
+
+    def _claim(self) -> list[OutboxMessage]:
+        now = utcnow()
+        ids: list[int] = list(db.session.scalars(select(OutboxMessage.id).where(OutboxMessage.next_attempt_time <= now).order_by(OutboxMessage.next_attempt_time).limit(self.batch_size)))
+        claimed: list[int] = []
+        for id in ids:
+            # the condition fails if another sender claimed the message first
+            result = db.session.execute(update(OutboxMessage).where(OutboxMessage.id == id, OutboxMessage.next_attempt_time <= now).values(next_attempt_time=now + _LEASE))
+            if result.rowcount:  # type: ignore
+                claimed.append(id)
+        db.session.commit()
+        return list(db.session.scalars(select(OutboxMessage).where(OutboxMessage.id.in_(claimed)).order_by(OutboxMessage.id)))
+
+    def _fail(self, message: OutboxMessage, error: Exception) -> None:
+        message.attempts += 1  # type: ignore
+        message.last_error = repr(error)  # type: ignore
+        if message.attempts >= self.max_attempts:
+            message.next_attempt_time = None  # type: ignore
+            self.app.logger.error(f'Gave up sending email {message.id} to {message.to}: {error!r}')  # noqa: G004
+        else:
+            delay: float = self.retry_delay * 2 ** (message.attempts - 1) * random.uniform(0.8, 1.2)  # type: ignore
+            message.next_attempt_time = utcnow() + timedelta(seconds=delay)  # type: ignore
+        db.session.commit()
+
+    def send_batch(self) -> tuple[int, int]:
+        """
+        Claim one batch of due messages and send them through a single SMTP connection.
+
+        Returns
+        -------
+        tuple[int, int]
+            The quantity of sent and failed messages, both 0 if no message is due or the circuit breaker is open.
+        """
+        if self.breaker.is_open:
+            return 0, 0
+        pending: list[OutboxMessage] = self._claim()
+        if not pending:
+            return 0, 0
+        sent: int = 0
+        failed: int = 0
+        try:
+            with mail.get_connection() as connection:
+                while pending:
+                    message: OutboxMessage = pending[0]
+                    email = EmailMessage(message.subject, body=message.body, to=(message.to,), connection=connection)
+                    email.content_subtype = 'html'
+                    try:
+                        email.send()
+                    except _MESSAGE_ERRORS as error:
+                        self._fail(message, error)
+                        failed += 1
+                    else:
+                        message.attempts += 1  # type: ignore
+                        message.sent_time = utcnow()  # type: ignore
+                        message.next_attempt_time = None  # type: ignore
+                        # committed one by one, so a crash resends at most the message in flight
+                        db.session.commit()
+                        sent += 1
+                    pending.pop(0)
+        except (OSError, smtplib.SMTPException) as error:
+            self.breaker.record_failure()
+            self.app.logger.warning(f'SMTP server unavailable: {error!r}')  # noqa: G004
+            for message in pending:
+                self._fail(message, error)
+            failed += len(pending)
+        else:
+            self.breaker.record_success()
+        return sent, failed
+
+
+def register_outbox_handlers(app: Flask) -> None:
+    app.extensions['greybook_outbox'] = OutboxSender(app)
@@ -1,11 +1,125 @@
-from flask_sqlalchemy.record_queries import get_recorded_queries
+import inspect
+import random
+import re
+import time
+from collections import Counter
+from dataclasses import (
+    dataclass,
+    field,
+)
+
+from flask import (
+    Flask,
+    current_app,
+    g,
+    has_request_context,
+    request,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.wrappers.response import Response
 
+# expanded IN lists are rendered with one placeholder per value, they are collapsed so their statements have one shape
+_IN_LIST_PATTERN = re.compile(r'\(\?(?:,\s*\?)+\)|\(:\w+(?:,\s*:\w+)+\)|\(%\(\w+\)s(?:,\s*%\(\w+\)s)+\)')
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+@dataclass(slots=True)
+class QueryStats:
+    """
+    Queries executed during one request, kept in 'g.query_stats'.
+    - The count, the duration and the slow queries are recorded for every request.
+    - The statement shapes are only recorded for the sampled requests, see 'GREYBOOK_QUERY_SAMPLE_RATE'.
+    """
+
+    sampled: bool = True
+    count: int = 0
+    duration: float = 0.0
+    # statement shape -> executions
+    shapes: Counter[str] = field(default_factory=Counter)
+    # statement shape -> where it was first executed
+    locations: dict[str, str] = field(default_factory=dict)
+
+
+def statement_shape(statement: str) -> str:
+    """
+    Returns
+    -------
+    str
+        The statement with its IN lists collapsed, statements of the same shape only differ by their parameters.
+    """
+    return _IN_LIST_PATTERN.sub('(?)', statement)
+
+
+def _query_location() -> str:
+    # the innermost frame of the application and the template line being rendered, if any
+    location: str | None = None
+    frame = inspect.currentframe()
+    while frame is not None:
+        if (template := frame.f_globals.get('__jinja_template__')) is not None:
+            template_location: str = f'{template.name or "<template>"}:{template.get_corresponding_lineno(frame.f_lineno)}'
+            return f'{location} from {template_location}' if location else template_location
+        name: str = frame.f_globals.get('__name__', '')
+        if location is None and name.startswith('greybook.') and name != __name__:
+            location = f'{frame.f_code.co_filename}:{frame.f_lineno} ({frame.f_code.co_name})'
+        frame = frame.f_back
+    return location or '<unknown>'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany) -> None:
+    if context is not None:
+        context._greybook_start_time = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_query(conn, cursor, statement, parameters, context, executemany) -> None:
+    # 'g.query_stats' is only set in the requests of Greybook applications
+    stats: QueryStats | None = g.get('query_stats') if context is not None and has_request_context() else None
+    if stats is None:
+        return
+    duration: float = time.perf_counter() - context._greybook_start_time
+    stats.count += 1
+    stats.duration += duration
+    if duration >= current_app.config['GREYBOOK_SLOW_QUERY_THRESHOLD']:
+        current_app.logger.warning(f'Slow query: Duration: {duration:f}s\n Location: {_query_location()}\nQuery: {statement}\n')  # noqa: G004
+    if not stats.sampled:
+        return
+    shape: str = statement_shape(statement)
+    stats.shapes[shape] += 1
+    # the stack is only walked for the first execution of a shape
+    if shape not in stats.locations:
+        stats.locations[shape] = _query_location()
+
+
+def register_request_handlers(app: Flask) -> None:
+    # behind a reverse proxy every request comes from its address, the client address is read from the X-Forwarded-* headers it sets
+    if proxies := app.config['GREYBOOK_TRUSTED_PROXIES']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies, x_host=proxies)  # type: ignore
+
+    @app.before_request
+    def sample_queries() -> None:
+        g.query_stats = QueryStats(sampled=random.random() < app.config['GREYBOOK_QUERY_SAMPLE_RATE'])
 
-def register_request_handlers(app) -> None:
     @app.after_request
     def query_profiler(response: Response) -> Response:
-        for q in get_recorded_queries():
-            if q.duration >= app.config['GREYBOOK_SLOW_QUERY_THRESHOLD']:
-                app.logger.warning('Slow query: Duration: ' f'{q.duration:f}s\n Context: {q.context}\nQuery: {q.statement}\n')  # type: ignore # noqa: G004
+        stats: QueryStats = g.get('query_stats') or QueryStats()
+        app.logger.info(f'{request.method} {request.path}: {stats.count} queries in {stats.duration * 1000:.1f}ms')  # noqa: G004
+        for shape, executions in stats.shapes.items():
+            if executions > app.config['GREYBOOK_REPEATED_QUERY_THRESHOLD']:
+                app.logger.warning(f'Probable N+1 query in {request.endpoint}: executed {executions} times, first from {stats.locations[shape]}\nQuery: {shape}')  # noqa: G004
+        if app.debug:
+            response.headers['X-Query-Count'] = str(stats.count)
+            response.headers['X-Query-Time'] = f'{stats.duration * 1000:.1f}ms'
+
+        budget: int | None = app.config['GREYBOOK_QUERY_BUDGETS'].get(request.endpoint)
+        if budget is not None and stats.count > budget:
+            message: str = f'{request.endpoint} executed {stats.count} queries, over its budget of {budget}.'
+            if app.testing:
+                raise QueryBudgetExceeded(message)
+            app.logger.warning(message)
         return response
@@ -1,38 +1,78 @@
-from typing import (
-    Any,
-    Sequence,
-)
+import os
+from dataclasses import dataclass
+from typing import Any
 
 from flask_login import current_user
-from sqlalchemy import (
-    func,
-    select,
-)
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import select
+from sqlalchemy.orm import Session
 
 from ..models import (
     Admin,
     Category,
-    Comment,
+    Counter,
     Link,
+    Post,
+)
+from .caching import (
+    VersionedCache,
+    watch,
 )
 from .extensions import db
 
+TEMPLATE_CONTEXT_NAMESPACE = 'template_context'
+
+# posts are watched because the cached categories carry their post counts
+watch(Admin, Category, Link, Post, namespace=TEMPLATE_CONTEXT_NAMESPACE)
+
+
+@dataclass(frozen=True, slots=True)
+class TemplateContext:
+    admin: Admin | None
+    categories: list[Category]
+    links: list[Link]
+
+
+def load_template_context(session: Session) -> TemplateContext:
+    """
+    Load the global template context from the database.
+
+    Parameters
+    ----------
+    session : Session
+        Session used to run the queries.
+
+    Returns
+    -------
+    TemplateContext
+        Detached admin, categories and links.
+    """
+    return TemplateContext(
+        admin=session.scalar(select(Admin)),
+        categories=list(session.scalars(select(Category).order_by(Category.name))),
+        links=list(session.scalars(select(Link).order_by(Link.name))),
+    )
+
 
 def register_template_handlers(app) -> None:
+    if (template_cache_dir := app.config['GREYBOOK_TEMPLATE_CACHE_DIR']) is not None:
+        os.makedirs(template_cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(template_cache_dir)
+
+    template_context_cache = VersionedCache(TEMPLATE_CONTEXT_NAMESPACE, load_template_context)
+
     @app.context_processor
     def make_template_context() -> dict[str, Any]:
-        admin: Admin | None = db.session.scalar(select(Admin))
-        categories: Sequence[Category] = db.session.scalars(select(Category).order_by(Category.name)).all()
-        links: Sequence[Link] = db.session.scalars(select(Link).order_by(Link.name)).all()
-
-        if current_user.is_authenticated:
-            unread_comments = db.session.scalars(select(func.count(Comment.id)).filter_by(reviewed=False)).one()
-        else:
-            unread_comments = None
+        context: TemplateContext = template_context_cache.get()
+        # cached objects are attached to the request session without reloading them, so lazy relationships still work
+        # the logged-in admin is already loaded by 'load_user'
+        admin: Admin | None = current_user._get_current_object() if current_user.is_authenticated else db.session.merge(context.admin, load=False) if context.admin is not None else None  # type: ignore
+        categories: list[Category] = [db.session.merge(category, load=False) for category in context.categories]
+        links: list[Link] = [db.session.merge(link, load=False) for link in context.links]
 
         return dict(
             admin=admin,
             categories=categories,
             links=links,
-            unread_comments=unread_comments,
+            unread_comments=Counter.get_value(Counter.UNREAD_COMMENTS) if current_user.is_authenticated else None,
         )
@@ -1,36 +1,45 @@
-from threading import Thread
+from datetime import timedelta
 
 from flask import (
-    Flask,
     current_app,
     url_for,
 )
-from flask_mailman import EmailMessage
+from markupsafe import escape
+from sqlalchemy import (
+    func,
+    select,
+)
 
+from .core.extensions import db
+from .core.outbox import (
+    queue_digest,
+    queue_mail,
+)
 from .models import (
     Comment,
+    OutboxMessage,
     Post,
 )
 
+_NEW_COMMENTS_DIGEST = 'new_comments'
 
-def _send_async_mail(app: Flask, message: EmailMessage) -> None:
-    """
-    Tread target function to send email asynchronously.
 
-    Parameters
-    ----------
-    app : Flask
-        Flask application instance.
-    message : EmailMessage
-        Email message to be sent.
-    """
-    with app.app_context():
-        message.send()
+def _can_send(subject: str, body: str, to: str | None) -> bool:
+    if current_app.debug:
+        current_app.logger.debug('Skip sending email in debug mode.')
+        current_app.logger.debug(f'To: {to}')  # noqa: G004
+        current_app.logger.debug(f'Subject: {subject}')  # noqa: G004
+        current_app.logger.debug(f'Body: {body}')  # noqa: G004
+        return False
+    if not to:
+        current_app.logger.warning(f'Skip sending email without recipient: {subject}')  # noqa: G004
+        return False
+    return True
 
 
-def send_mail(subject: str, body: str, to: str) -> None | Thread:
+def send_mail(subject: str, body: str, to: str) -> None | OutboxMessage:
     """
-    Send email asynchronously using a thread.
+    Queue an email in the outbox, it is sent once the current transaction is committed.
 
     Parameters
     ----------
@@ -43,32 +52,27 @@ def send_mail(subject: str, body: str, to: str) -> None | Thread:
 
     Returns
     -------
-    None | Thread
-        Thread object if current_app.debug is False, otherwise None.
+    None | OutboxMessage
+        Queued message, None in debug mode or without recipient.
     """
-    if current_app.debug:
-        current_app.logger.debug('Skip sending email in debug mode.')
-        current_app.logger.debug(f'To: {to}')  # noqa: G004
-        current_app.logger.debug(f'Subject: {subject}')  # noqa: G004
-        current_app.logger.debug(f'Body: {body}')  # noqa: G004
+    if not _can_send(subject, body, to):
         return
-    app: Flask = current_app._get_current_object()  # type: ignore
-    message = EmailMessage(subject, body=body, to=(to,))
-    message.content_subtype = 'html'
-    thr = Thread(target=_send_async_mail, args=(app, message))
-    thr.start()
-    return thr
+    return queue_mail(subject, body, to)
 
 
 def send_new_comment_email(post: Post) -> None:
     """
     Send email to admin when a new comment is added to a post.
+    - In digest mode, the notification is merged into the pending digest email instead.
 
     Parameters
     ----------
     post : Post
         Post instance.
     """
+    if current_app.config['GREYBOOK_COMMENT_NOTIFICATION'] == 'digest':
+        send_new_comments_digest()
+        return
     post_url: str = url_for('blog.show_post', post_id=post.id, _external=True) + '#comments'
     send_mail(
         subject='New comment',
@@ -77,6 +81,27 @@ def send_new_comment_email(post: Post) -> None:
     )
 
 
+def send_new_comments_digest() -> None | OutboxMessage:
+    """
+    Queue or update the digest email listing the posts with new comments.
+    - The digest is sent 'GREYBOOK_DIGEST_WINDOW' seconds after the first comment it lists, later comments are added to it until then.
+
+    Returns
+    -------
+    None | OutboxMessage
+        Digest message, None in debug mode or without recipient.
+    """
+    to: str | None = current_app.config['GREYBOOK_ADMIN_EMAIL']
+    if not _can_send('New comments', '', to):
+        return
+    message: OutboxMessage = queue_digest(_NEW_COMMENTS_DIGEST, 'New comments', to, timedelta(seconds=current_app.config['GREYBOOK_DIGEST_WINDOW']))  # type: ignore
+    new_comments = db.session.execute(select(Post.id, Post.title, func.count(Comment.id)).join(Post.comments).where(Comment.created_time >= message.created_time, Comment.from_admin.is_(False)).group_by(Post.id, Post.title).order_by(func.count(Comment.id).desc())).all()
+    items: str = ''.join(f'<li><a href="{url_for("blog.show_post", post_id=post_id, _external=True)}#comments">{escape(title)}</a>: {count} new comment{"s" if count > 1 else ""}</li>' for post_id, title, count in new_comments)
+    review_url: str = url_for('admin.manage_comments', filter='unread', _external=True)
+    message.body = f'<p>New comments in {len(new_comments)} posts:</p> <ul>{items}</ul> <p><a href="{review_url}">Review the unread comments</a></p> <p><small style="color: #868e96">Do not reply this email.</small></p>'  # type: ignore
+    return message
+
+
 def send_new_reply_email(comment: Comment) -> None:
     """
     Send email to the user who left the comment when a new reply is added to it.
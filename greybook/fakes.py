@@ -1,10 +1,22 @@
+import multiprocessing
 import random
-from datetime import datetime
+import time
+from collections.abc import (
+    Callable,
+    Iterator,
+)
+from concurrent.futures import ProcessPoolExecutor
+from datetime import (
+    datetime,
+    timedelta,
+)
+from typing import Any
 
 from faker import Faker
 from sqlalchemy import (
-    func,
+    insert,
     select,
+    text,
 )
 
 from .core.extensions import db
@@ -14,9 +26,129 @@ from .models import (
     Comment,
     Link,
     Post,
+    comment_path,
+    refresh_comment_counters,
 )
+from .search import rebuild_search_index
+from .utils import summarize_html
+
+# posts are spread evenly over this period in id order, comments and replies follow their post
+_START = datetime(2020, 1, 1)
+_END = datetime(2024, 1, 1)
+
+# comments are left by a pool of returning commenters, which is also much faster than generating an identity per comment
+_COMMENTERS = 2000
+
+# one Faker per process, reseeded for every chunk; without weighting, Faker picks words several times faster
+_fake: Faker | None = None
+# seed -> (name, email, site, ip) of the commenters, built once per process
+_commenters: dict[int, list[tuple[str, str, str, str]]] = {}
+
+
+def _seeded(seed: int, kind: str, chunk: int) -> tuple[Faker, random.Random]:
+    # every chunk has its own seed, so the data does not depend on the chunk order or the quantity of worker processes
+    global _fake
+    if _fake is None:
+        _fake = Faker(use_weighting=False)
+    _fake.seed_instance(f'{seed}:{kind}:{chunk}')
+    return _fake, random.Random(f'{seed}:{kind}:{chunk}')
+
+
+def _commenters_of(seed: int) -> list[tuple[str, str, str, str]]:
+    if seed not in _commenters:
+        fake, _ = _seeded(seed, 'commenter', 0)
+        _commenters[seed] = [(fake.name()[:30], fake.email(), fake.url(), fake.ipv4_public()) for _ in range(_COMMENTERS)]
+    return _commenters[seed]
+
+
+def _post_time(post_id: int, posts: int) -> datetime:
+    return _START + (_END - _START) * post_id / (posts + 1)
+
+
+def _post_rows(seed: int, chunk: int, first_id: int, count: int, posts: int, categories: int) -> list[dict]:
+    fake, rng = _seeded(seed, 'post', chunk)
+    rows: list[dict] = []
+    for id in range(first_id, first_id + count):
+        body: str = ''.join(f'<p>{paragraph}</p>' for paragraph in fake.paragraphs(rng.randint(3, 12)))
+        excerpt, word_count, reading_time = summarize_html(body)
+        created_time: datetime = _post_time(id, posts)
+        rows.append(
+            dict(
+                id=id,
+                title=fake.sentence(nb_words=6)[:60],
+                body=body,
+                excerpt=excerpt,
+                word_count=word_count,
+                reading_time=reading_time,
+                created_time=created_time,
+                updated_time=created_time + timedelta(minutes=rng.randint(0, 30 * 24 * 60)),
+                no_comment=False,
+                category_id=rng.randint(1, categories),
+            )
+        )
+    return rows
+
+
+def _comment_rows(seed: int, chunk: int, first_id: int, count: int, posts: int, replied_ids: int) -> list[dict]:
+    # replies get a parent among the first 'replied_ids' comments, their post and times are set once the parent is read
+    commenters: list[tuple[str, str, str, str]] = _commenters_of(seed)
+    fake, rng = _seeded(seed, 'reply' if replied_ids else 'comment', chunk)
+    rows: list[dict] = []
+    for id in range(first_id, first_id + count):
+        author, email, site, ip = rng.choice(commenters)
+        from_admin: bool = rng.random() < 0.05
+        reviewed: bool = from_admin or bool(replied_ids) or rng.random() < 0.9
+        post_id: int = rng.randint(1, posts)
+        created_time: datetime = _post_time(post_id, posts) + timedelta(minutes=rng.randint(1, 60 * 24 * 60))
+        rows.append(
+            dict(
+                id=id,
+                author=author,
+                email=email,
+                site=site,
+                body=fake.sentence(nb_words=rng.randint(5, 40)),
+                created_time=created_time,
+                updated_time=created_time,
+                reviewed=reviewed,
+                reviewed_time=created_time + timedelta(minutes=rng.randint(1, 3 * 24 * 60)) if reviewed and not from_admin else None,
+                from_admin=from_admin,
+                spam=not reviewed and rng.random() < 0.3,
+                ip=None if from_admin else ip,
+                path=comment_path(id),
+                depth=0,
+                replied_id=rng.randint(1, replied_ids) if replied_ids else None,
+                post_id=post_id,
+            )
+        )
+    return rows
+
+
+def _chunks(total: int, chunk_size: int, first_id: int = 1) -> Iterator[tuple[int, int, int]]:
+    for chunk, offset in enumerate(range(0, total, chunk_size)):
+        yield chunk, first_id + offset, min(chunk_size, total - offset)
+
+
+def _generate(function: Callable[..., list[dict]], specs: list[tuple], workers: int) -> Iterator[list[dict]]:
+    # the Faker work runs in the worker processes, the inserts stay in this process, in chunk order
+    # the rows are inserted into the tables with executemany, compiling a multi-row VALUES or going through the ORM is several times slower
+    if not workers:
+        yield from (function(*spec) for spec in specs)
+        return
+    # spawned, forking would copy the locks held by the logging and outbox threads of the application
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        yield from executor.map(function, *zip(*specs))
+
 
-fake = Faker()
+def sync_id_sequences() -> None:
+    """
+    Move the id sequences of PostgreSQL after the ids inserted explicitly, other databases use the largest id.
+    """
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return
+    for model in (Category, Post, Comment):
+        table: str = model.__tablename__  # type: ignore
+        db.session.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), coalesce(max(id), 1)) FROM {table}"))
+    db.session.commit()
 
 
 def fake_admin() -> None:
@@ -32,82 +164,129 @@ def fake_admin() -> None:
     db.session.commit()
 
 
-def fake_categories(count: int = 10) -> None:
-    category = Category(name='Default')  # type: ignore
-    db.session.add(category)
-    words: list[str] = []
-    for _ in range(count):
-        while (word := fake.word().title()) in words:
-            pass
-        words.append(word)
-    for word in words:
-        category = Category(name=word)  # type: ignore
-        db.session.add(category)
+def fake_categories(count: int = 10, seed: int = 0) -> int:
+    """
+    Returns
+    -------
+    int
+        The quantity of categories, the 'Default' category included.
+    """
+    fake, _ = _seeded(seed, 'category', 0)
+    names: list[str] = ['Default']
+    while len(names) < count + 1:
+        name: str = fake.word().title()
+        names.append(name if name not in names else f'{name} {len(names)}')
+    db.session.execute(insert(Category.__table__), [dict(id=id, name=name) for id, name in enumerate(names, start=1)])
     db.session.commit()
+    return len(names)
 
 
-def fake_posts(count: int = 50) -> None:
-    category_count: int = db.session.scalars(select(func.count(Category.id))).one()
-    for _ in range(count):
-        category: Category = db.session.get(Category, random.randint(1, category_count))  # type: ignore
-        created_time: datetime = fake.date_time_between_dates(datetime_start=datetime(2020, 1, 1), datetime_end=datetime(2024, 1, 1))
-        updated_time: datetime = fake.date_time_between_dates(datetime_start=created_time, datetime_end=datetime(2024, 2, 1))
-        post = Post(
-            title=fake.sentence(),
-            body=fake.text(2000),
-            category=category,
-            created_time=created_time,
-            updated_time=updated_time,
-        )  # type: ignore
-        db.session.add(post)
-    db.session.commit()
+def fake_posts(count: int = 50, categories: int = 11, seed: int = 0, chunk_size: int = 1000, workers: int = 0) -> int:
+    """
+    Insert posts with ids 1 to 'count', one bulk statement per chunk.
+    - The Post mapper events are not fired, run 'rebuild_search_index' afterwards.
 
+    Parameters
+    ----------
+    count : int, optional
+        Quantity of posts, by default 50.
+    categories : int, optional
+        Quantity of categories the posts are spread over, by default 11.
+    seed : int, optional
+        Seed of the generated data, by default 0.
+    chunk_size : int, optional
+        Quantity of posts generated and inserted at a time, by default 1000.
+    workers : int, optional
+        Quantity of processes generating the chunks, by default 0 generates them in this process.
 
-def fake_comments(count: int = 200) -> None:
-    post_count: int = db.session.scalars(select(func.count(Post.id))).one()
-    for _ in range(count):
-        post: Post = db.session.get(Post, random.randint(1, post_count))  # type: ignore
-        created_time: datetime = fake.date_time_between_dates(datetime_start=post.created_time, datetime_end=datetime(2024, 3, 1))
-        updated_time: datetime = fake.date_time_between_dates(datetime_start=created_time, datetime_end=datetime(2024, 4, 1))
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            created_time=created_time,
-            updated_time=updated_time,
-            reviewed=bool(random.randrange(0, 10)),
-            from_admin=not bool(random.randrange(0, 20)),
-            post=post,
-        )
-        if not comment.from_admin and comment.reviewed:  # type: ignore
-            reviewed_time: datetime = fake.date_time_between_dates(datetime_start=updated_time, datetime_end=datetime(2024, 4, 10))
-            comment.reviewed_time = reviewed_time  # type: ignore
-        db.session.add(comment)
-    db.session.commit()
+    Returns
+    -------
+    int
+        The quantity of inserted posts.
+    """
+    specs: list[tuple] = [(seed, chunk, first_id, size, count, categories) for chunk, first_id, size in _chunks(count, chunk_size)]
+    for rows in _generate(_post_rows, specs, workers):
+        db.session.execute(insert(Post.__table__), rows)
+        db.session.commit()
+    return count
 
 
-def fake_replies(count: int = 50) -> None:
-    comment_count: int = db.session.scalars(select(func.count(Comment.id))).one()
-    for _ in range(count):
-        replied: Comment = db.session.get(Comment, random.randint(1, comment_count))  # type: ignore
-        created_time: datetime = fake.date_time_between_dates(datetime_start=replied.created_time, datetime_end=datetime(2024, 4, 15))
-        updated_time: datetime = fake.date_time_between_dates(datetime_start=created_time, datetime_end=datetime(2024, 4, 20))
-        reply = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            created_time=created_time,
-            updated_time=updated_time,
-            reviewed=True,
-            reviewed_time=updated_time,
-            from_admin=not bool(random.randrange(0, 20)),
-            replied=replied,
-            post=replied.post,
-        )
-        db.session.add(reply)
-    db.session.commit()
+def fake_comments(count: int = 200, posts: int = 50, seed: int = 0, chunk_size: int = 1000, workers: int = 0) -> int:
+    """
+    Insert top-level comments with ids 1 to 'count', one bulk statement per chunk.
+    - The Comment mapper events are not fired, run 'refresh_comment_counters' and 'rebuild_search_index' afterwards.
+
+    Parameters
+    ----------
+    count : int, optional
+        Quantity of comments, by default 200.
+    posts : int, optional
+        Quantity of posts the comments are spread over, by default 50.
+    seed : int, optional
+        Seed of the generated data, by default 0.
+    chunk_size : int, optional
+        Quantity of comments generated and inserted at a time, by default 1000.
+    workers : int, optional
+        Quantity of processes generating the chunks, by default 0 generates them in this process.
+
+    Returns
+    -------
+    int
+        The quantity of inserted comments.
+    """
+    specs: list[tuple] = [(seed, chunk, first_id, size, posts, 0) for chunk, first_id, size in _chunks(count, chunk_size)]
+    for rows in _generate(_comment_rows, specs, workers):
+        db.session.execute(insert(Comment.__table__), rows)
+        db.session.commit()
+    return count
+
+
+def fake_replies(count: int = 50, comments: int = 200, posts: int = 50, seed: int = 0, chunk_size: int = 1000, workers: int = 0) -> int:
+    """
+    Insert replies after the 'comments' first comments, one bulk statement per chunk.
+    - A reply answers a comment or a reply of a previous chunk, the parents of a chunk are read with one query.
+    - The Comment mapper events are not fired, run 'refresh_comment_counters' and 'rebuild_search_index' afterwards.
+
+    Parameters
+    ----------
+    count : int, optional
+        Quantity of replies, by default 50.
+    comments : int, optional
+        Quantity of comments already inserted, by default 200.
+    posts : int, optional
+        Quantity of posts, by default 50.
+    seed : int, optional
+        Seed of the generated data, by default 0.
+    chunk_size : int, optional
+        Quantity of replies generated and inserted at a time, by default 1000.
+    workers : int, optional
+        Quantity of processes generating the chunks, by default 0 generates them in this process.
+
+    Returns
+    -------
+    int
+        The quantity of inserted replies.
+    """
+    if not comments:
+        return 0
+    specs: list[tuple] = [(seed, chunk, first_id, size, posts, first_id - 1) for chunk, first_id, size in _chunks(count, chunk_size, comments + 1)]
+    for rows in _generate(_comment_rows, specs, workers):
+        parents = {row.id: row for row in db.session.execute(select(Comment.id, Comment.post_id, Comment.created_time, Comment.path, Comment.depth).where(Comment.id.in_({row['replied_id'] for row in rows})))}
+        for row in rows:
+            parent = parents[row['replied_id']]
+            # the times were drawn after a random post, they are moved after the parent
+            shift: timedelta = parent.created_time - _post_time(row['post_id'], posts)
+            row.update(
+                post_id=parent.post_id,
+                created_time=row['created_time'] + shift,
+                updated_time=row['updated_time'] + shift,
+                reviewed_time=row['reviewed_time'] + shift if row['reviewed_time'] is not None else None,
+                path=comment_path(row['id'], parent.path),
+                depth=parent.depth + 1,
+            )
+        db.session.execute(insert(Comment.__table__), rows)
+        db.session.commit()
+    return count
 
 
 def fake_links() -> None:
@@ -118,3 +297,51 @@ def fake_links() -> None:
     google = Link(name='Stack Overflow', url='https://stackoverflow.com/users/5511849/grey-li')  # type: ignore
     db.session.add_all([helloflask, github, twitter, linkedin, google])
     db.session.commit()
+
+
+def fake_dataset(category: int = 10, post: int = 50, comment: int = 200, reply: int = 50, seed: int = 0, chunk_size: int = 1000, workers: int = 0, echo: Callable[[str], Any] = print) -> None:
+    """
+    Recreate the database with fake data, the same seed and quantities always give the same data.
+
+    Parameters
+    ----------
+    category, post, comment, reply : int, optional
+        Quantities of categories, posts, top-level comments and replies.
+    seed : int, optional
+        Seed of the generated data, by default 0.
+    chunk_size : int, optional
+        Quantity of rows generated and inserted at a time, by default 1000.
+    workers : int, optional
+        Quantity of processes generating the rows, by default 0 generates them in this process.
+    echo : Callable[[str], Any], optional
+        Called with the progress messages, by default print.
+    """
+
+    def timed(name: str, generate: Callable[[], int]) -> int:
+        start: float = time.perf_counter()
+        count: int = generate()
+        seconds: float = time.perf_counter() - start
+        echo(f'Generated {count} {name} in {seconds:.2f}s ({count / seconds if seconds else 0:.0f} rows/s).')
+        return count
+
+    db.drop_all()
+    db.create_all()
+    echo('Initialized the database...')
+
+    fake_admin()
+    echo('Generated the administrator.')
+
+    categories: int = timed('categories', lambda: fake_categories(category, seed))
+    posts: int = timed('posts', lambda: fake_posts(post, categories, seed, chunk_size, workers))
+    comments: int = timed('comments', lambda: fake_comments(comment, posts, seed, chunk_size, workers) if posts else 0)
+    timed('replies', lambda: fake_replies(reply, comments, posts, seed, chunk_size, workers))
+    sync_id_sequences()
+
+    fake_links()
+    echo('Generated links.')
+
+    # the rows were inserted with bulk statements, which skip the mapper events maintaining the counters and the search index
+    refresh_comment_counters(db.session.connection())
+    db.session.commit()
+    indexed_posts, indexed_comments = rebuild_search_index(chunk_size)
+    echo(f'Indexed {indexed_posts} posts and {indexed_comments} comments.')
@@ -0,0 +1,276 @@
+import hashlib
+import mimetypes
+import multiprocessing
+import os
+import re
+import tempfile
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+)
+from logging import Logger
+
+from PIL import (
+    Image,
+    ImageOps,
+    UnidentifiedImageError,
+)
+from flask import (
+    Response,
+    abort,
+    current_app,
+    send_from_directory,
+)
+from markupsafe import escape
+from werkzeug.datastructures.file_storage import FileStorage
+from werkzeug.security import safe_join
+
+# uploaded images are named after their content and size, so identical uploads share one file and the size is known without opening it
+_UPLOAD_NAME_PATTERN = re.compile(r'^[0-9a-f]{32}_(?P<width>\d+)x(?P<height>\d+)\.\w+$')
+# variants are named after their original, e.g. '<digest>_1600x1200.jpg.480w.webp'
+_VARIANT_NAME_PATTERN = re.compile(r'^(?P<original>[0-9a-f]{32}_\d+x\d+\.\w+)\.\d+w\.\w+$')
+_IMG_TAG_PATTERN = re.compile(r'<img\b[^>]*>')
+_SRC_PATTERN = re.compile(r'\bsrc="(?P<prefix>[^"]*?/uploads/)(?P<filename>[^"?#]+)"')
+# attributes written by 'add_responsive_attributes', removed first so the rewrite can be applied again to an edited body
+_RESPONSIVE_ATTRIBUTE_PATTERN = re.compile(r'\s(?:srcset|sizes|loading|decoding|width|height)="[^"]*"')
+_EXIF_ORIENTATION = 0x0112
+_CHUNK_SIZE = 64 * 1024
+_executor: ProcessPoolExecutor | None = None
+_IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def original_filename(filename: str) -> str:
+    """
+    Get the filename of the original upload of a resized variant.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of an uploaded image or of one of its variants.
+
+    Returns
+    -------
+    str
+        The filename of the original upload, the filename itself if it is not a variant.
+    """
+    match = _VARIANT_NAME_PATTERN.match(filename)
+    return match['original'] if match else filename
+
+
+def is_content_addressed(filename: str) -> bool:
+    """
+    Returns
+    -------
+    bool
+        True if the file was named after its content by 'save_upload', so it never changes under its URL.
+    """
+    return bool(_UPLOAD_NAME_PATTERN.match(filename) or _VARIANT_NAME_PATTERN.match(filename))
+
+
+def variant_filenames(filename: str) -> list[tuple[int, str]]:
+    """
+    List the resized variants of an uploaded image, narrower than the original.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the original upload.
+
+    Returns
+    -------
+    list[tuple[int, str]]
+        The width and filename of every variant, empty if the file was not named by 'save_upload' or is a GIF.
+    """
+    match = _UPLOAD_NAME_PATTERN.match(filename)
+    # GIFs may be animated, resizing them would keep only the first frame
+    if match is None or filename.endswith('.gif'):
+        return []
+    extension: str = current_app.config['GREYBOOK_IMAGE_VARIANT_FORMAT']
+    return [(width, f'{filename}.{width}w.{extension}') for width in current_app.config['GREYBOOK_IMAGE_WIDTHS'] if width < int(match['width'])]
+
+
+def _image_size(path: str) -> tuple[int, int]:
+    # only the header is read, and the size is given as displayed once the EXIF orientation is applied
+    with Image.open(path) as image:
+        width, height = image.size
+        if image.getexif().get(_EXIF_ORIENTATION) in (5, 6, 7, 8):
+            width, height = height, width
+    return width, height
+
+
+def save_upload(file: FileStorage, upload_path: str) -> str | None:
+    """
+    Stream an uploaded image to the upload folder, storing identical content once, and start generating its variants.
+
+    Parameters
+    ----------
+    file : FileStorage
+        The uploaded file.
+    upload_path : str
+        The upload folder.
+
+    Returns
+    -------
+    str | None
+        The filename of the stored image, None if the file is not an image.
+    """
+    extension: str = os.path.splitext(file.filename or '')[1].lower()
+    digest = hashlib.sha256()
+    temporary = tempfile.NamedTemporaryFile(dir=upload_path, prefix='.upload-', delete=False)
+    try:
+        with temporary:
+            while chunk := file.stream.read(_CHUNK_SIZE):
+                digest.update(chunk)
+                temporary.write(chunk)
+        try:
+            width, height = _image_size(temporary.name)
+        except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+            return None
+
+        filename: str = f'{digest.hexdigest()[:32]}_{width}x{height}{extension}'
+        path: str = os.path.join(upload_path, filename)
+        if os.path.exists(path):
+            # the file may be unreferenced and old, it must not be collected by 'flask uploads gc' before the post using it is saved
+            os.utime(path)
+        else:
+            os.replace(temporary.name, path)
+    finally:
+        if os.path.exists(temporary.name):
+            os.remove(temporary.name)
+    # the variants of a deduplicated upload are kept like it, and generated again if they were collected or their generation failed
+    variants: list[tuple[int, str]] = []
+    for variant_width, variant in variant_filenames(filename):
+        variant_path: str = os.path.join(upload_path, variant)
+        if os.path.exists(variant_path):
+            os.utime(variant_path)
+        else:
+            variants.append((variant_width, variant_path))
+    if variants:
+        _submit(generate_variants, path, variants)
+    return filename
+
+
+def _submit(function, *args) -> None:
+    global _executor
+    workers: int = current_app.config['GREYBOOK_IMAGE_WORKERS']
+    if not workers:
+        function(*args)
+        return
+    if _executor is None:
+        # started from a request thread, forking would copy the locks held by the logging, outbox and database threads
+        _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    logger: Logger = current_app.logger
+    # the callback runs in a thread of the executor, outside of the application context
+    _executor.submit(function, *args).add_done_callback(lambda future: _log_failure(future, logger, function.__name__))
+
+
+def _log_failure(future: Future, logger: Logger, name: str) -> None:
+    if not future.cancelled() and (exception := future.exception()) is not None:
+        logger.error(f'{name} failed in the image process pool', exc_info=exception)  # noqa: G004
+
+
+def generate_variants(path: str, variants: list[tuple[int, str]]) -> None:
+    """
+    Write resized copies of an image, run in the image process pool.
+
+    Parameters
+    ----------
+    path : str
+        Path of the original image.
+    variants : list[tuple[int, str]]
+        The width and path of every copy, the format is given by the file extension.
+    """
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode == 'P':
+            image = image.convert('RGBA')
+        for width, variant_path in variants:
+            height: int = round(image.height * width / image.width)
+            resized: Image.Image = image.resize((width, height), Image.Resampling.LANCZOS)
+            if variant_path.endswith(('.jpg', '.jpeg')) and resized.mode != 'RGB':
+                resized = resized.convert('RGB')
+            directory, name = os.path.split(variant_path)
+            temporary: str = os.path.join(directory, f'.{name}')
+            resized.save(temporary, format=Image.registered_extensions()[os.path.splitext(name)[1]], quality=80)
+            os.replace(temporary, variant_path)
+
+
+def _responsive_img(tag: str) -> str:
+    match = _SRC_PATTERN.search(tag)
+    name_match = _UPLOAD_NAME_PATTERN.match(match['filename']) if match else None
+    if match is None or name_match is None:
+        return tag
+    tag = _RESPONSIVE_ATTRIBUTE_PATTERN.sub('', tag)
+    width, height = int(name_match['width']), int(name_match['height'])
+    attributes: str = f' width="{width}" height="{height}" loading="lazy" decoding="async"'
+    variants: list[tuple[int, str]] = variant_filenames(match['filename'])
+    if variants:
+        candidates: list[str] = [f'{match["prefix"]}{variant} {variant_width}w' for variant_width, variant in variants]
+        candidates.append(f'{match["prefix"]}{match["filename"]} {width}w')
+        attributes += f' srcset="{escape(", ".join(candidates))}" sizes="(max-width: {width}px) 100vw, {width}px"'
+    end: int = len(tag) - 2 if tag.endswith('/>') else len(tag) - 1
+    return tag[:end].rstrip() + attributes + (' />' if tag.endswith('/>') else '>')
+
+
+def add_responsive_attributes(html: str) -> str:
+    """
+    Add 'srcset', lazy loading and the intrinsic size to the uploaded images of an HTML fragment.
+
+    Parameters
+    ----------
+    html : str
+        The HTML fragment.
+
+    Returns
+    -------
+    str
+        The HTML fragment with the <img> tags of uploaded images rewritten.
+    """
+    return _IMG_TAG_PATTERN.sub(lambda match: _responsive_img(match[0]), html)
+
+
+def send_upload(filename: str) -> Response:
+    """
+    Serve an uploaded image, or let the front proxy stream it if 'GREYBOOK_UPLOAD_OFFLOAD' is set.
+    - Content-addressed files are cached forever by browsers, others are revalidated after 'GREYBOOK_UPLOAD_MAX_AGE' seconds.
+    - A variant still being generated is replaced by its original, which is not cached as the variant.
+    - Without offloading, conditional and Range requests are answered by Werkzeug.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the file in the upload folder.
+
+    Returns
+    -------
+    Response
+        The file, or an empty response whose 'X-Accel-Redirect' or 'X-Sendfile' header tells the proxy which file to send.
+    """
+    upload_path: str = current_app.config['GREYBOOK_UPLOAD_PATH']
+    path: str | None = safe_join(upload_path, filename)
+    if path is None:
+        abort(404)
+    substituted: bool = False
+    if not os.path.isfile(path) and (original := original_filename(filename)) != filename:
+        filename, path, substituted = original, os.path.join(upload_path, original), True
+
+    max_age: int = _IMMUTABLE_MAX_AGE if is_content_addressed(filename) and not substituted else current_app.config['GREYBOOK_UPLOAD_MAX_AGE']
+    offload: str | None = current_app.config['GREYBOOK_UPLOAD_OFFLOAD']
+    if offload is None:
+        response: Response = send_from_directory(upload_path, filename, max_age=max_age)
+    else:
+        if not os.path.isfile(path):
+            abort(404)
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        match offload:
+            case 'x-accel-redirect':
+                response.headers['X-Accel-Redirect'] = current_app.config['GREYBOOK_UPLOAD_ACCEL_PREFIX'] + filename
+            case 'x-sendfile':
+                response.headers['X-Sendfile'] = os.path.abspath(path)
+            case _:
+                raise ValueError(f'Invalid upload offload mode: {offload}')
+        response.cache_control.max_age = max_age
+    response.cache_control.public = True
+    if max_age == _IMMUTABLE_MAX_AGE:
+        response.cache_control.immutable = True
+    return response
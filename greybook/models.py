@@ -1,5 +1,5 @@
 import os
-import re
+from collections.abc import Iterable
 from datetime import (
     UTC,
     datetime,
@@ -18,20 +18,40 @@ from flask_login import UserMixin
 from sqlalchemy import (
     Boolean,
     Column,
+    Connection,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
     Text,
+    and_,
+    bindparam,
+    delete,
+    event,
+    func,
+    insert,
+    inspect,
+    select,
+    update,
 )
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import (
+    Mapper,
+    column_property,
+    relationship,
+    validates,
+)
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.relationships import _RelationshipDeclared
 from werkzeug.security import (
     check_password_hash,
     generate_password_hash,
 )
 
-from .core.extensions import db
+from .core.extensions import (
+    db,
+    forget_user,
+)
 from .forms import (
     CategoryForm,
     CommentForm,
@@ -39,6 +59,11 @@ from .forms import (
     LoginForm,
     PostForm,
 )
+from .images import add_responsive_attributes
+from .utils import (
+    find_uploaded_images,
+    summarize_html,
+)
 
 
 def utcnow() -> datetime:
@@ -62,6 +87,8 @@ class Admin(UserMixin, db.Model):
     custom_footer = Column(Text)
     custom_css = Column(Text)
     custom_js = Column(Text)
+    # part of the session user id, changing the password makes the existing sessions invalid
+    session_version = Column(Integer, default=1, server_default='1', nullable=False)
 
     @property
     def password(self) -> NoReturn:
@@ -70,6 +97,11 @@ class Admin(UserMixin, db.Model):
     @password.setter
     def password(self, password: str) -> None:
         self.password_hash = generate_password_hash(password)
+        if self.id is not None:
+            self.session_version = (self.session_version or 1) + 1
+
+    def get_id(self) -> str:
+        return f'{self.id}:{self.session_version or 1}'
 
     def check_password(self, password: str) -> bool:
         return check_password_hash(self.password_hash, password)  # type: ignore
@@ -78,6 +110,12 @@ class Admin(UserMixin, db.Model):
         return self.username == form.username.data and self.check_password(form.password.data)  # type: ignore
 
 
+@event.listens_for(Admin, 'after_update')
+def _forget_updated_admin(mapper: Mapper, connection: Connection, target: Admin) -> None:
+    # other processes keep their cached admin until it expires
+    forget_user()
+
+
 class Category(db.Model):
     id = Column(Integer, primary_key=True)
     name = Column(String(30), unique=True, nullable=False)
@@ -113,30 +151,70 @@ class Category(db.Model):
         """
         if self.id == 1:  # type: ignore
             return False
-        default_category: Category | None = db.session.get(Category, 1)
-        for post in self.posts:
-            post.category = default_category
-        db.session.delete(self)
+        Category.merge([self.id], 1)  # type: ignore
         db.session.commit()
         return True
 
+    @classmethod
+    def merge(cls, category_ids: Iterable[int], target_id: int) -> tuple[int, int]:
+        """
+        Move the posts of categories to the target category and delete them, with one UPDATE and one DELETE whatever the quantity of posts.
+        - The default category (id=1) and the target category are never deleted.
+        - The changes are not committed.
+
+        Parameters
+        ----------
+        category_ids : Iterable[int]
+            Ids of the merged categories.
+        target_id : int
+            Id of the category receiving the posts.
+
+        Returns
+        -------
+        tuple[int, int]
+            The quantity of moved posts and of deleted categories.
+        """
+        merged_ids: list[int] = [category_id for category_id in category_ids if category_id not in (1, target_id)]
+        if not merged_ids:
+            return 0, 0
+        moved = db.session.execute(update(Post).where(Post.category_id.in_(merged_ids)).values(category_id=target_id))
+        deleted = db.session.execute(delete(cls).where(cls.id.in_(merged_ids)))
+        return moved.rowcount, deleted.rowcount  # type: ignore
+
 
 class Post(db.Model):
     id = Column(Integer, primary_key=True)
     title = Column(String(60), nullable=False)
     body = Column(Text)
+    # plain text summary of the body, computed when the body is set, rebuild them with 'flask backfill-post-summaries'
+    excerpt = Column(Text, default='', server_default='', nullable=False)
+    word_count = Column(Integer, default=0, server_default='0', nullable=False)
+    reading_time = Column(Integer, default=1, server_default='1', nullable=False)
     created_time = Column(DateTime, default=utcnow, index=True)
     updated_time = Column(DateTime, default=utcnow, index=True)
     no_comment = Column(Boolean, default=False)
+    # denormalized counters maintained by the Comment mapper events, rebuild them with 'flask rebuild-counters'
+    comment_count = Column(Integer, default=0, server_default='0', nullable=False)
+    reviewed_comment_count = Column(Integer, default=0, server_default='0', nullable=False)
 
     category_id = Column(Integer, ForeignKey('category.id'))
 
     category = relationship(Category, back_populates='posts')
     comments = relationship('Comment', back_populates='post', cascade='all, delete-orphan')
+    images = relationship('PostImage', back_populates='post', cascade='all, delete-orphan')
 
-    @property
-    def reviewed_comments_counts(self) -> int:
-        return sum(comment.reviewed for comment in self.comments)
+    @validates('body')
+    def _summarize_body(self, key: str, body: str | None) -> str | None:
+        """
+        Store the excerpt, word count and reading time whenever the body is set, so listings never need to load the body.
+        - The uploaded images of the body are registered too, so the files are never found by parsing bodies.
+        - The <img> tags of uploaded images get 'srcset' and lazy loading, so readers download a variant fitting their screen.
+        """
+        body = add_responsive_attributes(body) if body else body
+        self.excerpt, self.word_count, self.reading_time = summarize_html(body or '')
+        current: dict[str, PostImage] = {image.filename: image for image in self.images}  # type: ignore
+        self.images = [current.get(filename) or PostImage(filename=filename) for filename in find_uploaded_images(body or '')]  # type: ignore
+        return body
 
     @classmethod
     def from_form(cls, form: PostForm) -> Self:
@@ -163,25 +241,37 @@ class Post(db.Model):
 
     def delete(self) -> None:
         """
-        Delete the post, its comments, and its images from the file system.
+        Delete the post and its comments.
+        - The image files are left to 'flask uploads gc', which removes them once no post uses them.
         - After deleted the post, no need to use 'db.session.commit()' to update the database.
         """
-        upload_path: str = current_app.config['GREYBOOK_UPLOAD_PATH']
-        upload_url: str = url_for('blog.get_image', filename='')
-        images: str = re.findall(rf'<img.*?src="{upload_url}(.*?)"', self.body)  # type: ignore
-        for image in images:
-            file_path: str = os.path.join(upload_path, image)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-
         db.session.delete(self)
         db.session.commit()
 
 
+class PostImage(db.Model):
+    """
+    Uploaded image used by a post, registered when the post body is set.
+    - Indexed by filename, so the garbage collection of the upload folder knows whether a file is used with one lookup.
+    """
+
+    post_id = Column(Integer, ForeignKey('post.id'), primary_key=True)
+    filename = Column(String(255), primary_key=True, index=True)
+
+    post = relationship(Post, back_populates='images')
+
+
+# counted in the same SELECT that loads the category, so templates never need to load 'Category.posts'
+Category.post_count = column_property(select(func.count(Post.id)).where(Post.category_id == Category.id).correlate_except(Post).scalar_subquery())
+
+
 class Comment(db.Model):
+    # threaded listings of a post are read in path order
+    __table_args__ = (Index('ix_comment_post_id_path', 'post_id', 'path'),)
+
     id = Column(Integer, primary_key=True)
     author = Column(String(30))
-    email = Column(String(254))
+    email = Column(String(254), index=True)
     site = Column(String(255))
     body = Column(Text)
     created_time = Column(DateTime, default=utcnow, index=True)
@@ -189,6 +279,13 @@ class Comment(db.Model):
     reviewed = Column(Boolean, default=False)
     reviewed_time = Column(DateTime, default=utcnow, index=True)
     from_admin = Column(Boolean, default=False)
+    # spam is hidden like unreviewed comments, but not counted as unread
+    spam = Column(Boolean, default=False, server_default='0', nullable=False)
+    ip = Column(String(45), index=True)
+    # materialized path of the reply chain, the zero-padded ids of the ancestors and the comment, e.g. '0000000003/0000000007/'
+    # set after the insert and never changed, rebuild them with 'flask rebuild-comment-paths'
+    path = Column(String(1000))
+    depth = Column(Integer, default=0, server_default='0', nullable=False)
 
     replied_id = Column(Integer, ForeignKey('comment.id'))
     post_id = Column(Integer, ForeignKey('post.id'))
@@ -220,10 +317,129 @@ class Comment(db.Model):
 
     def review(self) -> None:
         """
-        Mark the comment as reviewed.
+        Mark the comment as reviewed, and not spam.
         """
         self.reviewed = True
         self.reviewed_time = utcnow()
+        self.spam = False
+
+
+# condition of the comments counted by Counter.UNREAD_COMMENTS
+unread_comments = and_(Comment.reviewed.is_not(True), Comment.spam.is_not(True))
+
+
+def _is_unread(reviewed: bool | None, spam: bool | None) -> bool:
+    return not reviewed and not spam
+
+
+def _change_comment_counters(connection: Connection, post_id: int | None, total: int, reviewed: int, unread: int) -> None:
+    if post_id is not None and (total or reviewed):
+        connection.execute(update(Post).where(Post.id == post_id).values(comment_count=Post.comment_count + total, reviewed_comment_count=Post.reviewed_comment_count + reviewed))
+    if unread:
+        Counter.add(connection, Counter.UNREAD_COMMENTS, unread)
+
+
+def comment_path(comment_id: int, parent_path: str | None = None) -> str:
+    """
+    Returns
+    -------
+    str
+        The materialized path of a comment, sorting after its parent and before the later replies of the parent.
+    """
+    return f'{parent_path or ""}{comment_id:010d}/'
+
+
+@event.listens_for(Comment, 'after_insert')
+def _set_comment_path(mapper: Mapper, connection: Connection, target: Comment) -> None:
+    parent_path: str | None = None
+    depth: int = 0
+    if target.replied_id is not None:
+        # the parent is read from the session when it is loaded, so replying never lazy loads it
+        parent: Comment | None = target.__dict__.get('replied')
+        if parent is not None and parent.path is not None:
+            parent_path, depth = parent.path, parent.depth + 1  # type: ignore
+        else:
+            row = connection.execute(select(Comment.path, Comment.depth).where(Comment.id == target.replied_id)).one()
+            parent_path, depth = row.path, row.depth + 1
+    path: str = comment_path(target.id, parent_path)  # type: ignore
+    connection.execute(update(Comment.__table__).where(Comment.__table__.c.id == target.id).values(path=path, depth=depth))
+    set_committed_value(target, 'path', path)
+    set_committed_value(target, 'depth', depth)
+
+
+@event.listens_for(Comment, 'after_insert')
+def _count_inserted_comment(mapper: Mapper, connection: Connection, target: Comment) -> None:
+    _change_comment_counters(connection, target.post_id, 1, int(bool(target.reviewed)), int(_is_unread(target.reviewed, target.spam)))  # type: ignore
+
+
+@event.listens_for(Comment, 'after_update')
+def _count_updated_comment(mapper: Mapper, connection: Connection, target: Comment) -> None:
+    state = inspect(target)
+    reviewed_history, spam_history = state.attrs.reviewed.history, state.attrs.spam.history
+    if not reviewed_history.has_changes() and not spam_history.has_changes():
+        return
+    was_reviewed: bool = bool(reviewed_history.deleted[0]) if reviewed_history.deleted else bool(target.reviewed)
+    was_spam: bool = bool(spam_history.deleted[0]) if spam_history.deleted else bool(target.spam)
+    reviewed: int = int(bool(target.reviewed)) - int(was_reviewed)
+    unread: int = int(_is_unread(target.reviewed, target.spam)) - int(_is_unread(was_reviewed, was_spam))  # type: ignore
+    _change_comment_counters(connection, target.post_id, 0, reviewed, unread)  # type: ignore
+
+
+@event.listens_for(Comment, 'after_delete')
+def _count_deleted_comment(mapper: Mapper, connection: Connection, target: Comment) -> None:
+    _change_comment_counters(connection, target.post_id, -1, -int(bool(target.reviewed)), -int(_is_unread(target.reviewed, target.spam)))  # type: ignore
+
+
+def refresh_comment_counters(connection: Connection, post_ids: Iterable[int] | None = None) -> None:
+    """
+    Recompute the comment counters from the comment table with set-based statements.
+    - Use it after bulk statements, which do not fire the Comment mapper events.
+
+    Parameters
+    ----------
+    connection : Connection
+        Connection of the transaction that changed the comments.
+    post_ids : Iterable[int] | None, optional
+        Only refresh these posts, by default all posts are refreshed.
+    """
+    statement = update(Post).values(
+        comment_count=select(func.count(Comment.id)).where(Comment.post_id == Post.id).scalar_subquery(),
+        reviewed_comment_count=select(func.count(Comment.id)).where(Comment.post_id == Post.id, Comment.reviewed.is_(True)).scalar_subquery(),
+    )
+    if post_ids is not None:
+        statement = statement.where(Post.id.in_(list(post_ids)))
+    connection.execute(statement)
+    Counter.set(connection, Counter.UNREAD_COMMENTS, connection.scalar(select(func.count(Comment.id)).where(unread_comments)) or 0)
+
+
+def rebuild_comment_paths(connection: Connection, chunk_size: int = 1000) -> int:
+    """
+    Recompute the materialized paths of all comments.
+    - Use it after bulk inserts, which do not fire the Comment mapper events.
+
+    Parameters
+    ----------
+    connection : Connection
+        Connection of the transaction.
+    chunk_size : int, optional
+        Quantity of comments updated per statement, by default 1000.
+
+    Returns
+    -------
+    int
+        The quantity of comments.
+    """
+    paths: dict[int, tuple[str, int]] = {}
+    # a reply is always newer than its parent, so in id order every parent path is known before its replies
+    for id, replied_id in connection.execute(select(Comment.id, Comment.replied_id).order_by(Comment.id)):
+        parent: tuple[str, int] | None = paths.get(replied_id)
+        paths[id] = (comment_path(id, parent[0]), parent[1] + 1) if parent else (comment_path(id), 0)
+    table = Comment.__table__
+    statement = update(table).where(table.c.id == bindparam('comment_id')).values(path=bindparam('new_path'), depth=bindparam('new_depth'))
+    rows: list[dict] = [dict(comment_id=id, new_path=path, new_depth=depth) for id, (path, depth) in paths.items()]
+    for start in range(0, len(rows), chunk_size):
+        connection.execute(statement, rows[start : start + chunk_size])
+    return len(rows)
 
 
 class Link(db.Model):
@@ -250,3 +466,68 @@ class Link(db.Model):
         self.name = form.name.data
         self.url = form.url.data
         db.session.commit()
+
+
+class CacheVersion(db.Model):
+    """
+    Shared version counter of a cache namespace.
+    - Every worker process reads the counter to know whether its cached copy is still valid.
+    """
+
+    namespace = Column(String(30), primary_key=True)
+    version = Column(Integer, default=0, nullable=False)
+
+
+class Counter(db.Model):
+    """
+    Denormalized global counter.
+    - Written through the connection of the current flush, so it is committed or rolled back together with the rows it counts.
+    """
+
+    UNREAD_COMMENTS = 'unread_comments'
+    # set to 1 once 'flask uploads index' registered the images of every post, the uploads gc refuses to run before
+    POST_IMAGES_INDEXED = 'post_images_indexed'
+
+    name = Column(String(30), primary_key=True)
+    value = Column(Integer, default=0, nullable=False)
+
+    @classmethod
+    def add(cls, connection: Connection, name: str, delta: int) -> None:
+        result = connection.execute(update(cls).where(cls.name == name).values(value=cls.value + delta))
+        if not result.rowcount:
+            connection.execute(insert(cls).values(name=name, value=delta))
+
+    @classmethod
+    def set(cls, connection: Connection, name: str, value: int) -> None:
+        result = connection.execute(update(cls).where(cls.name == name).values(value=value))
+        if not result.rowcount:
+            connection.execute(insert(cls).values(name=name, value=value))
+
+    @classmethod
+    def get_value(cls, name: str) -> int:
+        """
+        Returns
+        -------
+        int
+            The value of the counter, 0 if it has never been written.
+        """
+        return db.session.scalar(select(cls.value).where(cls.name == name)) or 0
+
+
+class OutboxMessage(db.Model):
+    """
+    Email waiting to be sent, written in the transaction of the change it notifies about.
+    - 'next_attempt_time' is None once the message is sent or given up, so only pending messages are due.
+    """
+
+    id = Column(Integer, primary_key=True)
+    subject = Column(String(255), nullable=False)
+    body = Column(Text, nullable=False)
+    to = Column(String(254), nullable=False)
+    created_time = Column(DateTime, default=utcnow)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_time = Column(DateTime, default=utcnow, index=True)
+    sent_time = Column(DateTime)
+    last_error = Column(Text)
+    # set on digest messages, which gather notifications until they are due
+    digest_key = Column(String(30), index=True)
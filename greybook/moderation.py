@@ -0,0 +1,111 @@
+from typing import Literal
+
+from sqlalchemy import (
+    ColumnElement,
+    Connection,
+    and_,
+    delete,
+    false,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy.orm import aliased
+
+from .core.extensions import db
+from .models import (
+    Comment,
+    refresh_comment_counters,
+    unread_comments,
+    utcnow,
+)
+from .search import (
+    index_comments,
+    unindex_comments,
+)
+
+type ModerationAction = Literal['approve', 'spam', 'delete']
+type ModerationScope = Literal['selected', 'unread', 'email', 'ip']
+
+MODERATION_ACTIONS: tuple[ModerationAction, ...] = ('approve', 'spam', 'delete')
+
+
+def comment_condition(scope: ModerationScope, ids: list[int] | None = None, value: str | None = None) -> ColumnElement[bool]:
+    """
+    Build the condition selecting the comments of a bulk moderation.
+
+    Parameters
+    ----------
+    scope : ModerationScope
+        'selected' for the given ids, 'unread' for every unread comment, 'email' or 'ip' for every comment from the given value.
+    ids : list[int] | None, optional
+        Ids of the selected comments.
+    value : str | None, optional
+        Email or IP address of the comments.
+
+    Returns
+    -------
+    ColumnElement[bool]
+        The condition, matching no comment if the ids or the value are missing.
+    """
+    match scope:
+        case 'selected':
+            return Comment.id.in_(ids or [])
+        case 'unread':
+            return unread_comments
+        case 'email' | 'ip' if not value:
+            # 'Comment.email == None' would match the comments without an email
+            return false()
+        case 'email':
+            return and_(Comment.email == value, Comment.from_admin.is_not(True))
+        case 'ip':
+            return and_(Comment.ip == value, Comment.from_admin.is_not(True))
+        case _:
+            raise ValueError(f'Invalid moderation scope: {scope}')
+
+
+def moderate_comments(action: ModerationAction, condition: ColumnElement[bool]) -> int:
+    """
+    Approve, mark as spam or delete comments with one set-based statement, whatever their quantity.
+    - The bulk statements skip the Comment mapper events, so the counters and the search index are maintained here.
+    - Deleting a comment deletes its replies, at any depth, like deleting it alone does.
+    - The changes are not committed.
+
+    Parameters
+    ----------
+    action : ModerationAction
+        The moderation to apply.
+    condition : ColumnElement[bool]
+        Condition selecting the comments, see 'comment_condition'.
+
+    Returns
+    -------
+    int
+        The quantity of changed comments.
+    """
+    connection: Connection = db.session.connection()
+    post_ids: list[int] = list(db.session.scalars(select(Comment.post_id).where(condition).distinct()))
+    reply_count: int = 0
+    match action:
+        case 'approve':
+            condition = and_(condition, Comment.reviewed.is_not(True))
+            index_comments(connection, condition)
+            statement = update(Comment).where(condition).values(reviewed=True, reviewed_time=utcnow(), spam=False)
+        case 'spam':
+            condition = and_(condition, Comment.spam.is_not(True))
+            unindex_comments(connection, condition)
+            statement = update(Comment).where(condition).values(reviewed=False, spam=True)
+        case 'delete':
+            # the replies of a comment are the comments whose path extends its path, they are deleted first: SQLite reads the
+            # subquery of a delete lazily, once the comments they reply to are gone their paths would no longer match
+            reply = aliased(Comment)
+            deleted_paths = select(Comment.path).where(condition).correlate(None).subquery()
+            replies = Comment.id.in_(select(reply.id).join(deleted_paths, and_(reply.path.startswith(deleted_paths.c.path), reply.path != deleted_paths.c.path)))
+            unindex_comments(connection, or_(condition, replies))
+            reply_count = db.session.execute(delete(Comment).where(replies), execution_options={'synchronize_session': False}).rowcount  # type: ignore
+            statement = delete(Comment).where(condition)
+        case _:
+            raise ValueError(f'Invalid moderation action: {action}')
+    result = db.session.execute(statement, execution_options={'synchronize_session': False})
+    refresh_comment_counters(connection, post_ids)
+    return result.rowcount + reply_count  # type: ignore
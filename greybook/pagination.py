@@ -0,0 +1,179 @@
+from datetime import datetime
+from typing import Any
+
+from flask import (
+    abort,
+    current_app,
+    redirect,
+    request,
+    url_for,
+)
+from flask_sqlalchemy.pagination import SelectPagination
+from itsdangerous import (
+    BadData,
+    URLSafeSerializer,
+)
+from sqlalchemy import (
+    Select,
+    func,
+    literal_column,
+    select,
+    tuple_,
+)
+
+from .core.extensions import db
+
+
+def _serializer() -> URLSafeSerializer:
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='greybook-cursor')
+
+
+def encode_cursor(item: Any, backwards: bool = False) -> str:
+    """
+    Encode the keyset position of an item into an opaque cursor token.
+
+    Parameters
+    ----------
+    item : Any
+        A Post or Comment, positioned by its (created_time, id) key.
+    backwards : bool, optional
+        True if the cursor points to the newer items before the item, by default False.
+
+    Returns
+    -------
+    str
+        The cursor token.
+    """
+    return _serializer().dumps([item.created_time.isoformat(), item.id, backwards])  # type: ignore
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int, bool]:
+    """
+    Decode a cursor token, aborting with 400 if it is invalid.
+
+    Returns
+    -------
+    tuple[datetime, int, bool]
+        The created time and id of the item, and whether the cursor goes backwards.
+    """
+    try:
+        created_time, id, backwards = _serializer().loads(cursor)
+        return datetime.fromisoformat(created_time), int(id), bool(backwards)
+    except (BadData, TypeError, ValueError):
+        abort(400, description='Invalid cursor.')
+
+
+def _url_with(**params: Any) -> str:
+    args: dict[str, Any] = {key: value for key, value in request.args.items() if key not in ('page', 'cursor')}
+    return url_for(request.endpoint, **(request.view_args or {}), **args, **params)  # type: ignore
+
+
+class NumberedPagination(SelectPagination):
+    """
+    OFFSET pagination of the first numbered pages, compatible with the Bootstrap-Flask pagination macros.
+    - The count query stops after the numbered pages, so 'total' is at most 'max_pages * per_page'.
+    - If more items exist after the last numbered page, 'next_cursor' continues the listing with keyset pagination.
+    """
+
+    cursor: None = None
+
+    def __init__(self, statement: Select, page: int, per_page: int, max_pages: int, error_out: bool = True) -> None:
+        self.max_pages: int = max_pages
+        self.has_more: bool = False
+        super().__init__(select=statement, session=db.session, page=page, per_page=per_page, max_per_page=None, error_out=error_out)
+        self.next_cursor: str | None = encode_cursor(self.items[-1]) if self.has_more and self.page >= self.pages and self.items else None
+
+    def _query_count(self) -> int:
+        limit: int = self.max_pages * self.per_page
+        # no column is selected, so the count never reads large columns such as the post body
+        statement: Select = self._query_args['select'].with_only_columns(literal_column('1'), maintain_column_froms=True).order_by(None).limit(limit + 1)
+        total: int = db.session.scalar(select(func.count()).select_from(statement.subquery())) or 0
+        self.has_more = total > limit
+        return min(total, limit)
+
+    @property
+    def next_url(self) -> str | None:
+        return _url_with(cursor=self.next_cursor) if self.next_cursor else None
+
+
+class KeysetPagination:
+    """
+    Cursor pagination over the (created_time, id) key, newest first.
+    - Every page is one indexed range query, whatever its depth, and no count query is issued.
+    """
+
+    def __init__(self, statement: Select, model: Any, cursor: str, per_page: int) -> None:
+        created_time, id, backwards = decode_cursor(cursor)
+        key = tuple_(model.created_time, model.id)
+        position = tuple_(created_time, id)
+        if backwards:
+            statement = statement.where(key > position).order_by(None).order_by(model.created_time.asc(), model.id.asc())
+        else:
+            statement = statement.where(key < position).order_by(None).order_by(model.created_time.desc(), model.id.desc())
+        items: list[Any] = list(db.session.scalars(statement.limit(per_page + 1)).unique())
+        more: bool = len(items) > per_page
+        items = items[:per_page]
+        if backwards:
+            items.reverse()
+
+        self.cursor: str = cursor
+        self.per_page: int = per_page
+        self.items: list[Any] = items
+        self.has_prev: bool = more if backwards else True
+        self.has_next: bool = True if backwards else more
+        self.prev_cursor: str | None = encode_cursor(items[0], backwards=True) if self.has_prev and items else None
+        self.next_cursor: str | None = encode_cursor(items[-1]) if self.has_next and items else None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    @property
+    def first_url(self) -> str:
+        return _url_with()
+
+    @property
+    def prev_url(self) -> str | None:
+        # the newest items are shown on the numbered first page
+        return _url_with(cursor=self.prev_cursor) if self.prev_cursor else self.first_url
+
+    @property
+    def next_url(self) -> str | None:
+        return _url_with(cursor=self.next_cursor) if self.next_cursor else None
+
+
+def paginate_by_time(statement: Select, model: Any, page: int, cursor: str | None, per_page: int, error_out: bool = True) -> NumberedPagination | KeysetPagination:
+    """
+    Paginate a listing newest first, with numbered pages for the first 'GREYBOOK_NUMBERED_PAGES' pages and cursors beyond them.
+    - A numbered page beyond them, e.g. an old or crawled link, is redirected to the cursor of the same position.
+
+    Parameters
+    ----------
+    statement : Select
+        Unordered statement selecting the model.
+    model : Any
+        Model with 'created_time' and 'id' columns.
+    page : int
+        Requested page number, ignored if a cursor is given.
+    cursor : str | None
+        Cursor token of the 'cursor' query argument.
+    per_page : int
+        Number of items per page.
+    error_out : bool, optional
+        Abort with 404 if a numbered page out of range is requested, by default True.
+
+    Returns
+    -------
+    NumberedPagination | KeysetPagination
+        The pagination of the requested page.
+    """
+    if cursor:
+        return KeysetPagination(statement, model, cursor, per_page)
+    max_pages: int = current_app.config['GREYBOOK_NUMBERED_PAGES']
+    statement = statement.order_by(model.created_time.desc(), model.id.desc())
+    if page > max_pages:
+        # the cursor of the last item before the page, found with a single offset query
+        previous: Any = db.session.scalars(statement.offset((page - 1) * per_page - 1).limit(1)).unique().first()
+        if previous is None:
+            abort(404)
+        abort(redirect(_url_with(cursor=encode_cursor(previous))))
+    return NumberedPagination(statement, page=page, per_page=per_page, max_pages=max_pages, error_out=error_out)
@@ -0,0 +1,45 @@
+from typing import Literal
+
+from sqlalchemy import Select
+from sqlalchemy.orm import (
+    defer,
+    joinedload,
+)
+from sqlalchemy.sql.base import ExecutableOption
+
+from .models import (
+    Category,
+    Comment,
+    Post,
+)
+
+type LoaderProfile = Literal['post_listing', 'comment_thread', 'comment_moderation']
+
+# Loader options of the listing views, so every relationship a template touches is loaded with a fixed number of queries.
+LOADER_PROFILES: dict[LoaderProfile, tuple[ExecutableOption, ...]] = {
+    # blog.index, blog.show_category and admin.manage_posts: each row shows its category name and the stored excerpt instead of the body
+    'post_listing': (joinedload(Post.category).load_only(Category.id, Category.name), defer(Post.body)),
+    # blog.show_post: each reply quotes the author and body of the comment it replies to, joined so the page is one query
+    'comment_thread': (joinedload(Comment.replied).load_only(Comment.id, Comment.author, Comment.body),),
+    # admin.manage_comments: each row links to its post, whose body is never displayed
+    'comment_moderation': (joinedload(Comment.post).load_only(Post.id, Post.title),),
+}
+
+
+def with_profile(statement: Select, profile: LoaderProfile) -> Select:
+    """
+    Apply the loader options of a profile to a statement.
+
+    Parameters
+    ----------
+    statement : Select
+        Statement selecting the entity of the profile.
+    profile : LoaderProfile
+        Name of the profile.
+
+    Returns
+    -------
+    Select
+        The statement with the loader options applied.
+    """
+    return statement.options(*LOADER_PROFILES[profile])
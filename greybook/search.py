@@ -0,0 +1,243 @@
+import re
+from dataclasses import dataclass
+
+from markupsafe import (
+    Markup,
+    escape,
+)
+from sqlalchemy import (
+    DDL,
+    ColumnElement,
+    Connection,
+    column,
+    delete,
+    event,
+    func,
+    insert,
+    inspect,
+    literal,
+    select,
+    table,
+    text,
+)
+from sqlalchemy.orm import Mapper
+
+from .core.extensions import db
+from .models import (
+    Comment,
+    Post,
+)
+from .utils import html_to_text
+
+# Posts and reviewed comments share one FTS5 table, so they are ranked together.
+# Post rows use the rowid 2 * post.id and comment rows 2 * comment.id + 1, so every row is updated through the rowid.
+_create_search_index = DDL("CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(title, body, post_id UNINDEXED, tokenize='porter unicode61')")
+_drop_search_index = DDL('DROP TABLE IF EXISTS search_index')
+event.listen(db.metadata, 'after_create', _create_search_index.execute_if(dialect='sqlite'))
+event.listen(db.metadata, 'after_drop', _drop_search_index.execute_if(dialect='sqlite'))
+
+_search_index = table('search_index', column('rowid'), column('title'), column('body'), column('post_id'))
+_INSERT = text('INSERT INTO search_index (rowid, title, body, post_id) VALUES (:rowid, :title, :body, :post_id)')
+_DELETE = text('DELETE FROM search_index WHERE rowid = :rowid')
+_SEARCH = text('SELECT rowid, post_id, highlight(search_index, 0, :open, :close) AS title, snippet(search_index, 1, :open, :close, :ellipsis, 32) AS snippet FROM search_index WHERE search_index MATCH :query ORDER BY bm25(search_index, 10.0, 1.0) LIMIT :limit OFFSET :offset')
+# highlight markers, replaced with <mark> tags after the indexed text is escaped
+_OPEN, _CLOSE = '\x02', '\x03'
+
+
+def _post_row(post_id: int, title: str, body: str | None) -> dict:
+    return dict(rowid=post_id * 2, title=title, body=html_to_text(body or ''), post_id=post_id)
+
+
+def _comment_row(comment_id: int, post_id: int, body: str | None) -> dict:
+    return dict(rowid=comment_id * 2 + 1, title='', body=body or '', post_id=post_id)
+
+
+@event.listens_for(Post, 'after_insert')
+def _index_inserted_post(mapper: Mapper, connection: Connection, target: Post) -> None:
+    if connection.dialect.name == 'sqlite':
+        connection.execute(_INSERT, _post_row(target.id, target.title, target.body))  # type: ignore
+
+
+@event.listens_for(Post, 'after_update')
+def _index_updated_post(mapper: Mapper, connection: Connection, target: Post) -> None:
+    state = inspect(target)
+    if connection.dialect.name == 'sqlite' and (state.attrs.title.history.has_changes() or state.attrs.body.history.has_changes()):
+        connection.execute(_DELETE, dict(rowid=target.id * 2))  # type: ignore
+        connection.execute(_INSERT, _post_row(target.id, target.title, target.body))  # type: ignore
+
+
+@event.listens_for(Post, 'after_delete')
+def _unindex_deleted_post(mapper: Mapper, connection: Connection, target: Post) -> None:
+    if connection.dialect.name == 'sqlite':
+        connection.execute(_DELETE, dict(rowid=target.id * 2))  # type: ignore
+
+
+@event.listens_for(Comment, 'after_insert')
+def _index_inserted_comment(mapper: Mapper, connection: Connection, target: Comment) -> None:
+    if connection.dialect.name == 'sqlite' and target.reviewed:
+        connection.execute(_INSERT, _comment_row(target.id, target.post_id, target.body))  # type: ignore
+
+
+@event.listens_for(Comment, 'after_update')
+def _index_updated_comment(mapper: Mapper, connection: Connection, target: Comment) -> None:
+    state = inspect(target)
+    if connection.dialect.name == 'sqlite' and (state.attrs.reviewed.history.has_changes() or state.attrs.body.history.has_changes()):
+        connection.execute(_DELETE, dict(rowid=target.id * 2 + 1))  # type: ignore
+        if target.reviewed:
+            connection.execute(_INSERT, _comment_row(target.id, target.post_id, target.body))  # type: ignore
+
+
+@event.listens_for(Comment, 'after_delete')
+def _unindex_deleted_comment(mapper: Mapper, connection: Connection, target: Comment) -> None:
+    if connection.dialect.name == 'sqlite':
+        connection.execute(_DELETE, dict(rowid=target.id * 2 + 1))  # type: ignore
+
+
+def index_comments(connection: Connection, condition: ColumnElement[bool]) -> None:
+    """
+    Add comments about to be approved by a bulk statement, which does not fire the Comment mapper events.
+
+    Parameters
+    ----------
+    connection : Connection
+        Connection of the transaction of the bulk statement.
+    condition : ColumnElement[bool]
+        Condition selecting the comments, evaluated before the bulk statement.
+    """
+    if connection.dialect.name == 'sqlite':
+        unindex_comments(connection, condition)
+        connection.execute(insert(_search_index).from_select(['rowid', 'title', 'body', 'post_id'], select(Comment.id * 2 + 1, literal(''), func.coalesce(Comment.body, ''), Comment.post_id).where(condition)))
+
+
+def unindex_comments(connection: Connection, condition: ColumnElement[bool]) -> None:
+    """
+    Remove comments about to be hidden or deleted by a bulk statement, which does not fire the Comment mapper events.
+
+    Parameters
+    ----------
+    connection : Connection
+        Connection of the transaction of the bulk statement.
+    condition : ColumnElement[bool]
+        Condition selecting the comments, evaluated before the bulk statement.
+    """
+    if connection.dialect.name == 'sqlite':
+        connection.execute(delete(_search_index).where(_search_index.c.rowid.in_(select(Comment.id * 2 + 1).where(condition))))
+
+
+def rebuild_search_index(chunk_size: int = 1000) -> tuple[int, int]:
+    """
+    Rebuild the search index from the post and comment tables, committing after every chunk.
+
+    Parameters
+    ----------
+    chunk_size : int, optional
+        Quantity of rows indexed at a time, by default 1000.
+
+    Returns
+    -------
+    tuple[int, int]
+        The quantity of indexed posts and comments.
+    """
+    db.session.execute(_create_search_index)
+    db.session.execute(text('DELETE FROM search_index'))
+    db.session.commit()
+
+    counts: list[int] = []
+    for statement, to_row in (
+        (select(Post.id, Post.title, Post.body), _post_row),
+        (select(Comment.id, Comment.post_id, Comment.body).where(Comment.reviewed.is_(True)), _comment_row),
+    ):
+        model = statement.selected_columns[0].table
+        last_id: int = 0
+        count: int = 0
+        while rows := db.session.execute(statement.where(model.c.id > last_id).order_by(model.c.id).limit(chunk_size)).all():
+            db.session.execute(_INSERT, [to_row(*row) for row in rows])
+            db.session.commit()
+            last_id = rows[-1][0]
+            count += len(rows)
+        counts.append(count)
+
+    db.session.execute(text("INSERT INTO search_index (search_index) VALUES ('optimize')"))
+    db.session.commit()
+    return counts[0], counts[1]
+
+
+@dataclass(frozen=True, slots=True)
+class SearchResult:
+    post_id: int
+    # None if the match is the post itself
+    comment_id: int | None
+    post_title: str
+    title: Markup
+    snippet: Markup
+
+
+@dataclass(frozen=True, slots=True)
+class SearchResults:
+    """
+    One page of search results, compatible with the Bootstrap-Flask 'render_pager' macro.
+    """
+
+    items: list[SearchResult]
+    page: int
+    has_next: bool
+
+    @property
+    def has_prev(self) -> bool:
+        return self.page > 1
+
+    @property
+    def prev_num(self) -> int:
+        return self.page - 1
+
+    @property
+    def next_num(self) -> int:
+        return self.page + 1
+
+
+def _highlighted(value: str) -> Markup:
+    return Markup(str(escape(value)).replace(_OPEN, '<mark>').replace(_CLOSE, '</mark>'))
+
+
+def _match_query(query: str) -> str:
+    # every word is quoted, so user input never reaches the FTS5 query syntax, and the last one matches as a prefix
+    terms: list[str] = re.findall(r'\w+', query)
+    return ' '.join(f'"{term}"' for term in terms) + ('*' if terms else '')
+
+
+def search(query: str, page: int = 1, per_page: int = 20) -> SearchResults:
+    """
+    Search posts and reviewed comments, best matches first.
+
+    Parameters
+    ----------
+    query : str
+        Words to search for, all of them must match.
+    page : int, optional
+        Page of results, by default 1.
+    per_page : int, optional
+        Quantity of results per page, by default 20.
+
+    Returns
+    -------
+    SearchResults
+        The matches of the page, with the matching words highlighted.
+    """
+    match_query: str = _match_query(query)
+    page = max(page, 1)
+    if not match_query:
+        return SearchResults(items=[], page=page, has_next=False)
+
+    rows = db.session.execute(_SEARCH, dict(query=match_query, open=_OPEN, close=_CLOSE, ellipsis='…', limit=per_page + 1, offset=(page - 1) * per_page)).all()
+    post_titles: dict[int, str] = dict(db.session.execute(select(Post.id, Post.title).where(Post.id.in_({row.post_id for row in rows}))).all())  # type: ignore
+    items: list[SearchResult] = [
+        SearchResult(
+            post_id=row.post_id,
+            comment_id=row.rowid // 2 if row.rowid % 2 else None,
+            post_title=post_titles.get(row.post_id, ''),
+            title=_highlighted(row.title),
+            snippet=_highlighted(row.snippet),
+        )
+        for row in rows[:per_page]
+    ]
+    return SearchResults(items=items, page=page, has_next=len(rows) > per_page)
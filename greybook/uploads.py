@@ -0,0 +1,109 @@
+import os
+import time
+from collections.abc import Iterator
+from itertools import batched
+
+from sqlalchemy import select
+
+from .core.extensions import db
+from .images import original_filename
+from .models import (
+    Counter,
+    Post,
+    PostImage,
+)
+from .utils import find_uploaded_images
+
+
+def index_post_images(chunk_size: int = 500) -> int:
+    """
+    Register the uploaded images of every post, committing after every chunk.
+    - Only needed for posts saved before the registry existed, saving a post registers its images.
+    - Marks the registry as complete once every post is done, see 'registry_is_missing'.
+
+    Parameters
+    ----------
+    chunk_size : int, optional
+        Quantity of posts loaded at a time, by default 500.
+
+    Returns
+    -------
+    int
+        The quantity of registered images.
+    """
+    last_id: int = 0
+    count: int = 0
+    while rows := db.session.execute(select(Post.id, Post.body).where(Post.id > last_id).order_by(Post.id).limit(chunk_size)).all():
+        post_ids: list[int] = [post_id for post_id, _ in rows]
+        registered: set[tuple[int, str]] = {(row.post_id, row.filename) for row in db.session.execute(select(PostImage.post_id, PostImage.filename).where(PostImage.post_id.in_(post_ids)))}
+        for post_id, body in rows:
+            for filename in find_uploaded_images(body or ''):
+                if (post_id, filename) not in registered:
+                    db.session.add(PostImage(post_id=post_id, filename=filename))  # type: ignore
+                    count += 1
+        db.session.commit()
+        last_id = rows[-1][0]
+    Counter.set(db.session.connection(), Counter.POST_IMAGES_INDEXED, 1)
+    db.session.commit()
+    return count
+
+
+def _uploaded_files(upload_path: str) -> Iterator[os.DirEntry]:
+    with os.scandir(upload_path) as entries:
+        for entry in entries:
+            if entry.is_file():
+                yield entry
+
+
+def registry_is_missing() -> bool:
+    """
+    Returns
+    -------
+    bool
+        True if the images of the existing posts have never been indexed, so the garbage collection could remove used files.
+        The posts saved since the registry exists register their images, so the registry not being empty proves nothing.
+    """
+    return not Counter.get_value(Counter.POST_IMAGES_INDEXED)
+
+
+def collect_unused_uploads(upload_path: str, grace_period: float, batch_size: int = 500, dry_run: bool = False) -> tuple[int, list[str]]:
+    """
+    Remove the files of the upload folder that no post uses.
+
+    Parameters
+    ----------
+    upload_path : str
+        The upload folder.
+    grace_period : float
+        Files modified less than this many seconds ago are kept, so images uploaded for a post being written survive.
+    batch_size : int, optional
+        Quantity of filenames looked up in the registry at a time, by default 500.
+    dry_run : bool, optional
+        Only report the unused files, by default False.
+
+    Returns
+    -------
+    tuple[int, list[str]]
+        The quantity of scanned files and the filenames of the removed ones.
+    """
+    deadline: float = time.time() - grace_period
+    scanned: int = 0
+    removed: list[str] = []
+    for batch in batched(_uploaded_files(upload_path), batch_size):
+        scanned += len(batch)
+        candidates: dict[str, os.DirEntry] = {entry.name: entry for entry in batch if entry.stat().st_mtime < deadline}
+        if not candidates:
+            continue
+        # resized variants are kept as long as their original is used
+        originals: dict[str, str] = {filename: original_filename(filename) for filename in candidates}
+        used: set[str] = set(db.session.scalars(select(PostImage.filename).where(PostImage.filename.in_(set(originals.values())))))
+        for filename, entry in candidates.items():
+            if originals[filename] in used:
+                continue
+            if not dry_run:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+            removed.append(filename)
+    return scanned, removed
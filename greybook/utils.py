@@ -1,4 +1,6 @@
+import math
 import os
+import re
 import uuid
 from urllib.parse import (
     ParseResult,
@@ -12,6 +14,7 @@ from flask import (
     request,
     url_for,
 )
+from markupsafe import Markup
 from werkzeug.wrappers.response import Response
 
 
@@ -91,3 +94,68 @@ def random_filename(old_filename: str) -> str:
     """
     ext = os.path.splitext(old_filename)[1]
     return f'{uuid.uuid4().hex}{ext}'
+
+
+# images uploaded with 'admin.upload_image' are served by 'blog.get_image' under /uploads/
+_UPLOADED_IMAGE_PATTERN = re.compile(r'<img\b[^>]*?\bsrc="[^"]*?/uploads/([^"?#]+)"')
+
+
+def find_uploaded_images(html: str) -> list[str]:
+    """
+    Find the uploaded images used by an HTML fragment.
+
+    Parameters
+    ----------
+    html : str
+        The HTML fragment.
+
+    Returns
+    -------
+    list[str]
+        Filenames of the images in the upload folder, without duplicates, in order of appearance.
+    """
+    return list(dict.fromkeys(_UPLOADED_IMAGE_PATTERN.findall(html)))
+
+
+def html_to_text(html: str) -> str:
+    """
+    Strip the tags of an HTML fragment, unescaping entities and normalizing whitespace.
+
+    Parameters
+    ----------
+    html : str
+        The HTML fragment.
+
+    Returns
+    -------
+    str
+        The plain text.
+    """
+    return Markup(html).striptags()
+
+
+def summarize_html(html: str, excerpt_length: int = 255, words_per_minute: int = 200) -> tuple[str, int, int]:
+    """
+    Summarize an HTML post body as plain text.
+    - The excerpt matches what the 'striptags|truncate' template filters produced from the body.
+
+    Parameters
+    ----------
+    html : str
+        The HTML body.
+    excerpt_length : int, optional
+        Maximum length of the excerpt, by default 255.
+    words_per_minute : int, optional
+        Reading speed used to estimate the reading time, by default 200.
+
+    Returns
+    -------
+    tuple[str, int, int]
+        The excerpt, the word count and the reading time in minutes.
+    """
+    text: str = html_to_text(html)
+    excerpt: str = text
+    if len(text) > excerpt_length + 5:
+        excerpt = text[: excerpt_length - 3].rsplit(' ', 1)[0] + '...'
+    word_count: int = len(text.split())
+    return excerpt, word_count, max(1, math.ceil(word_count / words_per_minute))
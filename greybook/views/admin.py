@@ -1,7 +1,6 @@
-import os
-
 from flask import (
     Blueprint,
+    abort,
     current_app,
     flash,
     redirect,
@@ -17,7 +16,6 @@ from flask_login import (
     current_user,
     login_required,
 )
-from flask_sqlalchemy.pagination import Pagination
 from sqlalchemy import (
     Select,
     select,
@@ -32,15 +30,31 @@ from ..forms import (
     PostForm,
     SettingForm,
 )
+from ..images import save_upload
 from ..models import (
     Category,
     Comment,
     Link,
     Post,
+    unread_comments,
+)
+from ..moderation import (
+    MODERATION_ACTIONS,
+    comment_condition,
+    moderate_comments,
+)
+from ..pagination import (
+    KeysetPagination,
+    NumberedPagination,
+    paginate_by_time,
+)
+from ..queries import with_profile
+from ..search import (
+    SearchResults,
+    search as search_posts,
 )
 from ..utils import (
     allowed_file,
-    random_filename,
     redirect_back,
 )
 
@@ -92,14 +106,17 @@ def settings() -> Response | str:
 @bp_admin.route('/post/manage')
 def manage_posts() -> Response | str:
     page: int = request.args.get('page', 1, type=int)
-    pagination: Pagination = db.paginate(
-        select(Post).order_by(Post.created_time.desc()),
-        page=page,
-        per_page=current_app.config['GREYBOOK_MANAGE_POST_PER_PAGE'],
+    cursor: str | None = request.args.get('cursor')
+    pagination: NumberedPagination | KeysetPagination = paginate_by_time(
+        with_profile(select(Post), 'post_listing'),
+        Post,
+        page,
+        cursor,
+        current_app.config['GREYBOOK_MANAGE_POST_PER_PAGE'],
         error_out=False,
     )
-    if page > pagination.pages:
-        return redirect(url_for('.manage_post', page=pagination.pages))
+    if pagination.cursor is None and page > pagination.pages:
+        return redirect(url_for('.manage_posts', page=pagination.pages))
 
     posts: list[Post] = pagination.items
     return render_template('admin/manage_post.html', page=page, pagination=pagination, posts=posts)
@@ -159,29 +176,46 @@ def set_comment(post_id: int) -> Response:
 # post end
 
 
+# search start
+@bp_admin.route('/search')
+def search() -> str:
+    q: str = request.args.get('q', '').strip()
+    page: int = request.args.get('page', 1, type=int)
+    per_page: int = current_app.config['GREYBOOK_SEARCH_RESULTS_PER_PAGE']
+    results: SearchResults | None = search_posts(q, page, per_page) if q else None
+    return render_template('admin/search.html', q=q, results=results)
+
+
 # comment start
 @bp_admin.route('/comment/manage')
 def manage_comments() -> Response | str:
     filter_rule: str = request.args.get('filter', 'all')  # 'all', 'unread', 'admin'
     page: int = request.args.get('page', 1, type=int)
+    cursor: str | None = request.args.get('cursor')
     per_page: int = current_app.config['GREYBOOK_COMMENT_PER_PAGE']
 
     match filter_rule:
         case 'unread':
-            filtered_comments: Select[tuple[Comment]] = select(Comment).filter_by(reviewed=False)
+            filtered_comments: Select[tuple[Comment]] = select(Comment).where(unread_comments)
+        case 'spam':
+            filtered_comments = select(Comment).filter_by(spam=True)
         case 'admin':
             filtered_comments = select(Comment).filter_by(from_admin=True)
+        case 'email' | 'ip':
+            filtered_comments = select(Comment).where(comment_condition(filter_rule, value=request.args.get('value')))
         case _:
             filtered_comments = select(Comment)
 
-    pagination: Pagination = db.paginate(
-        filtered_comments.order_by(Comment.created_time.desc()),
-        page=page,
-        per_page=per_page,
+    pagination: NumberedPagination | KeysetPagination = paginate_by_time(
+        with_profile(filtered_comments, 'comment_moderation'),
+        Comment,
+        page,
+        cursor,
+        per_page,
         error_out=False,
     )
-    if page > pagination.pages:
-        return redirect(url_for('.manage_comments', page=pagination.pages, filter=filter_rule))
+    if pagination.cursor is None and page > pagination.pages:
+        return redirect(url_for('.manage_comments', page=pagination.pages, filter=filter_rule, value=request.args.get('value')))
 
     comments: list[Comment] = pagination.items
     return render_template('admin/manage_comment.html', comments=comments, pagination=pagination)
@@ -198,13 +232,29 @@ def approve_comment(comment_id: int) -> Response:
 
 @bp_admin.route('/comment/approve', methods=['POST'])
 def approve_all_comments() -> Response:
-    for comment in db.session.scalars(select(Comment).filter_by(reviewed=False)):
-        comment.review()
+    moderate_comments('approve', unread_comments)
     db.session.commit()
     flash('All comments published.', 'success')
     return redirect_back()
 
 
+@bp_admin.route('/comment/bulk', methods=['POST'])
+def moderate_comments_in_bulk() -> Response:
+    """
+    Apply one moderation action to the selected comments, or to every comment of a scope, with a single statement.
+    """
+    action: str | None = request.form.get('action')
+    scope: str = request.form.get('scope', 'selected')
+    if action not in MODERATION_ACTIONS or scope not in ('selected', 'unread', 'email', 'ip'):
+        abort(400, description='Invalid moderation.')
+    condition = comment_condition(scope, ids=request.form.getlist('ids', type=int), value=request.form.get('value'))  # type: ignore
+    count: int = moderate_comments(action, condition)  # type: ignore
+    db.session.commit()
+    done: str = {'approve': 'published', 'spam': 'marked as spam', 'delete': 'deleted'}[action]  # type: ignore
+    flash(f'{count} comments {done}.', 'success')
+    return redirect_back()
+
+
 @bp_admin.route('/comment/<int:comment_id>/delete', methods=['POST'])
 def delete_comment(comment_id: int) -> Response:
     comment: Comment = db.get_or_404(Comment, comment_id)
@@ -265,6 +315,19 @@ def delete_category(category_id: int) -> Response:
     return redirect(url_for('blog.index'))
 
 
+@bp_admin.route('/category/merge', methods=['POST'])
+def merge_categories() -> Response:
+    target: Category = db.get_or_404(Category, request.form.get('target', type=int))
+    moved, merged = Category.merge(request.form.getlist('ids', type=int), target.id)  # type: ignore
+    if not merged:
+        flash('Select the categories to merge, the default category can not be merged.', 'warning')
+        return redirect(url_for('.manage_categories'))
+
+    db.session.commit()
+    flash(f'Merged {merged} categories into {target.name}, moved {moved} posts.', 'success')
+    return redirect(url_for('.manage_categories'))
+
+
 # category end
 
 
@@ -321,8 +384,9 @@ def upload_image() -> Response:
     if not allowed_file(file.filename):  # type: ignore
         return upload_fail('Image only!')
 
-    filename: str = random_filename(file.filename)  # type: ignore
-    file.save(os.path.join(current_app.config['GREYBOOK_UPLOAD_PATH'], filename))
+    filename: str | None = save_upload(file, current_app.config['GREYBOOK_UPLOAD_PATH'])
+    if filename is None:
+        return upload_fail('Image only!')
     return upload_success(
         url_for('blog.get_image', filename=filename),
         filename,
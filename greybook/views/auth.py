@@ -15,7 +15,10 @@ from flask_login import (
 from sqlalchemy import select
 from werkzeug.wrappers.response import Response
 
-from ..core.extensions import db
+from ..core.extensions import (
+    db,
+    forget_user,
+)
 from ..forms import LoginForm
 from ..models import Admin
 from ..utils import redirect_back
@@ -49,6 +52,7 @@ def login() -> Response | str:
 @bp_auth.route('/logout')
 @login_required
 def logout() -> Response:
+    forget_user(current_user.get_id())
     logout_user()
     flash('You have been logged out.', 'info')
     return redirect_back()
@@ -7,7 +7,6 @@ from flask import (
     redirect,
     render_template,
     request,
-    send_from_directory,
     url_for,
 )
 from flask_login import current_user
@@ -16,6 +15,7 @@ from sqlalchemy import select
 from sqlalchemy.orm import with_parent
 from werkzeug.wrappers.response import Response
 
+from ..core.caching import cache_page
 from ..core.extensions import db
 from ..emails import (
     send_new_comment_email,
@@ -25,50 +25,65 @@ from ..forms import (
     AdminCommentForm,
     CommentForm,
 )
+from ..images import send_upload
 from ..models import (
     Category,
     Comment,
     Link,
     Post,
 )
+from ..pagination import (
+    KeysetPagination,
+    NumberedPagination,
+    paginate_by_time,
+)
+from ..queries import with_profile
+from ..search import (
+    SearchResults,
+    search as search_posts,
+)
 from ..utils import redirect_back
 
 bp_blog = Blueprint('blog', __name__)
 
 
 @bp_blog.route('/')
+@cache_page(args={'page': int, 'cursor': str})
 def index() -> str:
     page: int = request.args.get('page', 1, type=int)
+    cursor: str | None = request.args.get('cursor')
     per_page: int = current_app.config['GREYBOOK_POSTS_PER_PAGE']
-    pagination: Pagination = db.paginate(
-        select(Post).order_by(Post.created_time.desc()),
-        page=page,
-        per_page=per_page,
-    )
+    pagination: NumberedPagination | KeysetPagination = paginate_by_time(with_profile(select(Post), 'post_listing'), Post, page, cursor, per_page)
     posts: list[Post] = pagination.items
     return render_template('blog/index.html', pagination=pagination, posts=posts)
 
 
 @bp_blog.route('/about')
+@cache_page
 def about():
     return render_template('blog/about.html')
 
 
 @bp_blog.route('/category/<int:category_id>')
+@cache_page(args={'page': int, 'cursor': str})
 def show_category(category_id: int) -> str:
     category: Category = db.get_or_404(Category, category_id)
     page: int = request.args.get('page', 1, type=int)
-    per_page: int = current_app.config['GREYBOOK_POST_PER_PAGE']
-    pagination: Pagination = db.paginate(
-        select(Post).filter(with_parent(category, Category.posts)).order_by(Post.created_time.desc()),
-        page=page,
-        per_page=per_page,
+    cursor: str | None = request.args.get('cursor')
+    per_page: int = current_app.config['GREYBOOK_POSTS_PER_PAGE']
+    pagination: NumberedPagination | KeysetPagination = paginate_by_time(
+        with_profile(select(Post), 'post_listing').filter(with_parent(category, Category.posts)),
+        Post,
+        page,
+        cursor,
+        per_page,
     )
     posts: list[Post] = pagination.items
     return render_template('blog/category.html', category=category, pagination=pagination, posts=posts)
 
 
 @bp_blog.route('/post/<int:post_id>', methods=['GET', 'POST'])
+@cache_page(args={'page': int})
 def show_post(post_id: int) -> Response | str:
     post: Post = db.get_or_404(Post, post_id)
 
@@ -81,24 +96,30 @@ def show_post(post_id: int) -> Response | str:
 
     if form.validate_on_submit():
         comment: Comment = Comment.from_form(form, from_admin=from_admin, post_id=post_id)
+        if not from_admin:
+            comment.ip = request.remote_addr  # type: ignore
         replied_id: str | None = request.args.get('reply')
         if replied_id:
             replied_comment: Comment = db.get_or_404(Comment, replied_id)
             comment.replied = replied_comment
             send_new_reply_email(replied_comment)
         db.session.add(comment)
+        if not current_user.is_authenticated:
+            send_new_comment_email(post)  # send notification email to admin
+        # the notifications are queued in the outbox and committed together with the comment
         db.session.commit()
         if current_user.is_authenticated:  # send message based on authentication status
             flash('Comment published.', 'success')
         else:
             flash('Thanks, your comment will be published after reviewed.', 'info')
-            send_new_comment_email(post)  # send notification email to admin
         return redirect(url_for('.show_post', post_id=post_id))
 
     page: int = request.args.get('page', 1, type=int)
     per_page: int = current_app.config['GREYBOOK_COMMENT_PER_PAGE']
+    # threaded pages list every reply under its parent, ordered by the materialized reply path
+    order_by = Comment.path.asc() if current_app.config['GREYBOOK_COMMENT_THREADED'] else Comment.created_time.asc()
     pagination: Pagination = db.paginate(
-        select(Comment).filter(with_parent(post, Post.comments)).filter_by(reviewed=True).order_by(Comment.created_time.asc()),
+        with_profile(select(Comment), 'comment_thread').filter(with_parent(post, Post.comments)).filter_by(reviewed=True).order_by(order_by),
         page=page,
         per_page=per_page,
     )
@@ -107,6 +128,16 @@ def show_post(post_id: int) -> Response | str:
     return render_template('blog/post.html', post=post, pagination=pagination, form=form, comments=comments)
 
 
+# not page cached, every query would be its own entry
+@bp_blog.route('/search')
+def search() -> str:
+    q: str = request.args.get('q', '').strip()
+    page: int = request.args.get('page', 1, type=int)
+    per_page: int = current_app.config['GREYBOOK_SEARCH_RESULTS_PER_PAGE']
+    results: SearchResults | None = search_posts(q, page, per_page) if q else None
+    return render_template('blog/search.html', q=q, results=results)
+
+
 @bp_blog.route('/reply/comment/<int:comment_id>')
 def reply_comment(comment_id: int) -> Response:
     comment: Comment = db.get_or_404(Comment, comment_id)
@@ -137,4 +168,4 @@ def change_theme(theme_name: str) -> Response:
 
 @bp_blog.route('/uploads/<path:filename>')
 def get_image(filename) -> Response:
-    return send_from_directory(current_app.config['GREYBOOK_UPLOAD_PATH'], filename)
+    return send_upload(filename)
@@ -0,0 +1,1088 @@
+import html
+import io
+import json
+import os
+import re
+import socket
+from datetime import (
+    UTC,
+    datetime,
+)
+
+import pytest
+from PIL import Image
+from aiosmtpd.controller import Controller
+from flask_mailman import Mail
+from itsdangerous import URLSafeTimedSerializer
+from jinja2 import Environment
+from sqlalchemy import (
+    delete,
+    event,
+    func,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.engine import Engine
+
+from greybook import create_app
+from greybook.config import (
+    ProductionConfig,
+    TestingConfig,
+)
+from greybook.core.caching import (
+    PAGES_NAMESPACE,
+    CachedPage,
+    PageCache,
+    VersionedCache,
+    get_version,
+)
+from greybook.core.extensions import db
+from greybook.models import (
+    Admin,
+    Category,
+    Comment,
+    Counter,
+    Link,
+    OutboxMessage,
+    Post,
+    PostImage,
+)
+
+
+@pytest.fixture
+def app():
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        admin = Admin(username='admin', blog_title='Greybook', blog_sub_title='Sub', name='Grey', about='About me.')  # type: ignore
+        admin.password = '123'
+        db.session.add_all([admin, Category(name='Default'), Link(name='HelloFlask', url='https://helloflask.com')])  # type: ignore
+        db.session.commit()
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def queries(app):
+    """
+    Statements executed by the engine, cleared by the test before the request it measures.
+    """
+    statements: list[str] = []
+    with app.app_context():
+        engine = db.engine
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    yield statements
+    event.remove(engine, 'before_cursor_execute', record)
+
+
+def add_posts(app, count: int, category_name: str) -> None:
+    with app.app_context():
+        category = Category(name=category_name)  # type: ignore
+        db.session.add(category)
+        db.session.add_all([Post(title=f'Post {i}', body='<p>body</p>' * 100, category=category) for i in range(count)])  # type: ignore
+        db.session.commit()
+
+
+def login(client) -> None:
+    client.post('/auth/login', data=dict(username='admin', password='123'))
+
+
+def test_versioned_cache_invalidation(app):
+    loads: list[int] = []
+
+    def loader(session) -> list[str]:
+        loads.append(1)
+        return list(session.scalars(select(Link.name).order_by(Link.id)))
+
+    cache = VersionedCache(PAGES_NAMESPACE, loader)
+    with app.app_context():
+        version: int = get_version(db.session, PAGES_NAMESPACE)
+        assert cache.get() == ['HelloFlask'] and len(loads) == 1
+        assert cache.get() == ['HelloFlask'] and len(loads) == 1
+
+        db.session.add(Link(name='GitHub', url='https://github.com'))  # type: ignore
+        db.session.flush()
+        assert get_version(db.session, PAGES_NAMESPACE) == version + 1
+        db.session.commit()
+        assert cache.get() == ['HelloFlask', 'GitHub'] and len(loads) == 2
+        assert cache.get() == ['HelloFlask', 'GitHub'] and len(loads) == 2
+
+        db.session.execute(update(Link).where(Link.name == 'GitHub').values(name='Codeberg'))
+        db.session.rollback()
+        assert get_version(db.session, PAGES_NAMESPACE) == version + 1
+        assert cache.get() == ['HelloFlask', 'GitHub'] and len(loads) == 2
+
+        db.session.execute(update(Link).where(Link.name == 'GitHub').values(name='Codeberg'))
+        db.session.commit()
+        assert cache.get() == ['HelloFlask', 'Codeberg'] and len(loads) == 3
+
+
+def test_sidebar_post_counts(app, client):
+    add_posts(app, 3, 'Flask')
+    data = client.get('/about').get_data(as_text=True)
+    assert 'Flask' in data
+    assert '> 3</span>' in data
+
+
+def test_sidebar_query_count_does_not_depend_on_posts(app, client, queries):
+    add_posts(app, 1, 'Flask')
+    queries.clear()
+    client.get('/about')
+    few_posts: int = len(queries)
+
+    add_posts(app, 50, 'Python')
+    queries.clear()
+    client.get('/about')
+    many_posts: int = len(queries)
+
+    assert few_posts == many_posts
+
+
+def test_template_context_is_cached(app, client, queries):
+    app.extensions.pop('greybook_page_cache')
+    client.get('/about')
+    queries.clear()
+    client.get('/about')
+    assert len(queries) == 1
+
+    with app.app_context():
+        db.session.add(Link(name='GitHub', url='https://github.com'))  # type: ignore
+        db.session.commit()
+    assert 'GitHub' in client.get('/about').get_data(as_text=True)
+
+
+def test_unread_comments_badge(app, client):
+    add_posts(app, 1, 'Flask')
+    with app.app_context():
+        db.session.add(Comment(author='Someone', email='someone@example.com', body='Hi', post_id=1))  # type: ignore
+        db.session.commit()
+    login(client)
+    data = client.get('/about').get_data(as_text=True)
+    assert '<span class="badge text-bg-success rounded-pill">1</span>' in data
+
+
+def test_comment_counters(app, client):
+    add_posts(app, 1, 'Flask')
+    client.post('/post/1', data=dict(author='Someone', email='someone@example.com', body='First'))
+    client.post('/post/1', data=dict(author='Someone', email='someone@example.com', body='Second'))
+    with app.app_context():
+        post = db.session.get(Post, 1)
+        assert (post.comment_count, post.reviewed_comment_count) == (2, 0)
+        assert Counter.get_value(Counter.UNREAD_COMMENTS) == 2
+
+    login(client)
+    client.post('/admin/comment/1/approve')
+    client.post('/admin/comment/2/delete')
+    client.post('/post/1', data=dict(body='From admin'))
+    with app.app_context():
+        post = db.session.get(Post, 1)
+        assert (post.comment_count, post.reviewed_comment_count) == (2, 2)
+        assert Counter.get_value(Counter.UNREAD_COMMENTS) == 0
+
+
+def test_rebuild_counters_command(app):
+    add_posts(app, 1, 'Flask')
+    with app.app_context():
+        db.session.add(Comment(author='Someone', email='someone@example.com', body='Hi', post_id=1))  # type: ignore
+        db.session.commit()
+        db.session.execute(update(Post).values(comment_count=0))
+        db.session.execute(update(Counter).values(value=5))
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['rebuild-counters'])
+    assert 'Rebuilt the comment counters.' in result.output
+    with app.app_context():
+        assert db.session.get(Post, 1).comment_count == 1
+        assert Counter.get_value(Counter.UNREAD_COMMENTS) == 1
+
+
+def seed_listings(app, count: int) -> None:
+    """
+    Every post has its own category and comment, and every reply on the first post quotes a comment of another post.
+    """
+    with app.app_context():
+        first_post: Post | None = db.session.get(Post, 1)
+        if first_post is None:
+            first_post = Post(title='First', body='<p>body</p>', category=Category(name='First'))  # type: ignore
+            db.session.add(first_post)
+            db.session.flush()
+        start: int = db.session.scalar(select(func.count(Category.id)))  # type: ignore
+        for i in range(start, start + count):
+            post = Post(title=f'Post {i}', body='<p>body</p>', category=Category(name=f'Category {i}'))  # type: ignore
+            parent = Comment(author='Someone', email='someone@example.com', body=f'Parent {i}', reviewed=True, post=post)  # type: ignore
+            reply = Comment(author='Someone', email='someone@example.com', body=f'Reply {i}', reviewed=True, replied=parent, post=first_post)  # type: ignore
+            db.session.add_all([post, parent, reply])
+        db.session.commit()
+
+
+def count_queries(client, queries: list[str], url: str) -> int:
+    client.get(url)  # warm up the template context cache
+    queries.clear()
+    assert client.get(url).status_code == 200
+    return len(queries)
+
+
+@pytest.mark.parametrize('url', ['/', '/category/2', '/post/1', '/admin/post/manage', '/admin/comment/manage'])
+def test_listing_query_count_does_not_depend_on_page_size(app, client, queries, url):
+    login(client)
+    seed_listings(app, 1)
+    small_page: int = count_queries(client, queries, url)
+
+    seed_listings(app, 20)
+    full_page: int = count_queries(client, queries, url)
+
+    assert small_page == full_page
+
+
+def test_keyset_pagination_after_numbered_pages(app, client, queries):
+    app.config.update(GREYBOOK_POSTS_PER_PAGE=3, GREYBOOK_NUMBERED_PAGES=2)
+    with app.app_context():
+        category = db.session.get(Category, 1)
+        db.session.add_all([Post(title=f'Post {i:02d}', body='<p>body</p>', category=category, created_time=datetime(2024, 1, 1 + i)) for i in range(10)])  # type: ignore
+        db.session.commit()
+
+    def titles(data: str) -> list[str]:
+        return re.findall(r'> (Post \d+) </a>', data)
+
+    def older_url(data: str) -> str | None:
+        match = re.search(r'href="([^"]*cursor=[^"]*)">Older', data)
+        return html.unescape(match.group(1)) if match else None
+
+    seen: list[str] = titles(client.get('/').get_data(as_text=True))
+    data: str = client.get('/?page=2').get_data(as_text=True)
+    seen += titles(data)
+    url: str | None = older_url(data)
+    assert url is not None
+    response = client.get('/?page=3')
+    assert response.status_code == 302
+    assert titles(client.get(response.location).get_data(as_text=True)) == ['Post 03', 'Post 02', 'Post 01']
+    assert client.get('/?page=5').status_code == 404
+
+    while url:
+        queries.clear()
+        data = client.get(url).get_data(as_text=True)
+        assert not any('count(*)' in statement for statement in queries)
+        seen += titles(data)
+        url = older_url(data)
+
+    assert seen == [f'Post {i:02d}' for i in reversed(range(10))]
+
+    newer_url: str = html.unescape(re.findall(r'href="([^"]*cursor=[^"]*)"><span aria-hidden="true">&larr;</span> Newer', data)[0])
+    assert titles(client.get(newer_url).get_data(as_text=True)) == ['Post 03', 'Post 02', 'Post 01']
+    assert client.get('/?cursor=invalid').status_code == 400
+
+
+def test_page_cache_conditional_get(app, client):
+    response = client.get('/about')
+    assert response.headers['X-Greybook-Cache'] == 'MISS'
+    etag: str = response.headers['ETag']
+    assert response.last_modified is None  # no posts yet
+    assert 'Cookie' in response.headers['Vary']
+
+    response = client.get('/about')
+    assert response.headers['X-Greybook-Cache'] == 'HIT'
+    assert response.headers['ETag'] == etag
+
+    response = client.get('/about', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    client.set_cookie('theme', 'perfect_blue')
+    assert client.get('/about').headers['X-Greybook-Cache'] == 'MISS'
+
+
+def test_page_cache_invalidated_by_writes(app, client):
+    add_posts(app, 1, 'Flask')
+    etag: str = client.get('/').headers['ETag']
+    assert client.get('/').headers['X-Greybook-Cache'] == 'HIT'
+
+    with app.app_context():
+        db.session.get(Post, 1).title = 'Updated Title'  # type: ignore
+        db.session.commit()
+    response = client.get('/')
+    assert response.headers['X-Greybook-Cache'] == 'MISS'
+    assert response.headers['ETag'] != etag
+    assert 'Updated Title' in response.get_data(as_text=True)
+    assert response.last_modified is not None
+
+
+def test_page_cache_skips_admin_and_flashes(app, client):
+    add_posts(app, 1, 'Flask')
+    response = client.post('/post/1', data=dict(author='Someone', email='someone@example.com', body='Hi'), follow_redirects=True)
+    assert 'X-Greybook-Cache' not in response.headers
+    assert 'Thanks, your comment will be published after reviewed.' in response.get_data(as_text=True)
+
+    login(client)
+    assert 'X-Greybook-Cache' not in client.get('/post/1').headers
+
+
+def test_page_cache_replaces_csrf_token(app):
+    app.config['WTF_CSRF_ENABLED'] = True
+    add_posts(app, 1, 'Flask')
+    first, second = app.test_client(), app.test_client()
+    first.get('/post/1')
+    response = second.get('/post/1')
+    assert response.headers['X-Greybook-Cache'] == 'HIT'
+    assert 'ETag' not in response.headers
+    with second.session_transaction() as session:
+        raw_token: str = session['csrf_token']
+    token: str = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', response.get_data(as_text=True)).group(1)  # type: ignore
+    with app.app_context():
+        assert URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='wtf-csrf-token').loads(token) == raw_token
+
+
+def test_page_cache_disk_tier_is_shared(tmp_path):
+    page = CachedPage(version=3, body=b'<p>page</p>', mimetype='text/html', etag='abc', last_modified=datetime(2024, 1, 1))
+    PageCache(10, str(tmp_path)).set('default:/?', page)
+    other_worker = PageCache(10, str(tmp_path))
+    assert other_worker.get('default:/?', 3) == page
+    assert other_worker.get('default:/?', 4) is None
+    (entry,) = (tmp_path / '3').iterdir()
+    assert json.loads(entry.read_bytes().partition(b'\n')[0])['etag'] == 'abc'
+
+    (tmp_path / 'legacy-entry').write_bytes(b'pickled')
+    cache = PageCache(10, str(tmp_path), max_disk_entries=2)
+    for i in range(3):
+        cache.set(f'default:/post/{i}?', CachedPage(version=4, body=b'<p>new</p>', mimetype='text/html', etag=None, last_modified=None))
+    assert [path.name for path in tmp_path.iterdir()] == ['4'] and len(list((tmp_path / '4').iterdir())) == 2
+    # a worker still rendering an older version does not bring it back
+    cache.set('default:/?', page)
+    assert [path.name for path in tmp_path.iterdir()] == ['4']
+
+
+def test_page_cache_keys_on_allowed_arguments(app, client):
+    add_posts(app, 1, 'Flask')
+    assert client.get('/?page=1').headers['X-Greybook-Cache'] == 'MISS'
+    assert client.get('/?page=01').headers['X-Greybook-Cache'] == 'HIT'
+    assert 'X-Greybook-Cache' not in client.get('/?x=1').headers
+    assert 'X-Greybook-Cache' not in client.get('/?page=1&page=2').headers
+    assert 'X-Greybook-Cache' not in client.get('/post/1?reply=1&author=Someone').headers
+
+
+def test_page_cache_ignores_unreviewed_comments(app, client):
+    add_posts(app, 1, 'Flask')
+    client.get('/post/1')
+    for i in range(3):
+        app.test_client().post('/post/1', data=dict(author='Spammer', email='spam@example.com', body=f'Spam {i}'))
+    assert client.get('/post/1').headers['X-Greybook-Cache'] == 'HIT'
+
+    login(admin := app.test_client())
+    admin.post('/admin/comment/1/approve')
+    response = client.get('/post/1')
+    assert response.headers['X-Greybook-Cache'] == 'MISS' and 'Spam 0' in response.get_data(as_text=True)
+    admin.post('/post/1', data=dict(body='From admin'))
+    assert client.get('/post/1').headers['X-Greybook-Cache'] == 'MISS'
+
+
+def test_post_summary_is_stored(app, client, queries):
+    body: str = '<p>' + ' '.join(['word'] * 450) + '</p>'
+    with app.app_context():
+        post = Post(title='Long', body=body, category_id=1)  # type: ignore
+        db.session.add(post)
+        db.session.commit()
+        assert post.excerpt == Environment().from_string('{{ body|striptags|truncate }}').render(body=body)
+        assert (post.word_count, post.reading_time) == (450, 3)
+
+    queries.clear()
+    data: str = client.get('/').get_data(as_text=True)
+    assert 'word word...' in data
+    assert not any('post.body' in statement for statement in queries)
+
+
+def test_backfill_post_summaries_command(app):
+    add_posts(app, 3, 'Flask')
+    with app.app_context():
+        db.session.execute(update(Post).values(excerpt='', word_count=0))
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['backfill-post-summaries', '--chunk-size', '2'])
+    assert 'Backfilled 3 post summaries.' in result.output
+    with app.app_context():
+        assert all(post.excerpt and post.word_count for post in db.session.scalars(select(Post)))
+
+
+def test_search_posts_and_reviewed_comments(app, client):
+    with app.app_context():
+        post = Post(title='Flask tips', body='<p>Routing with <b>blueprints</b> & <script>x</script>.</p>', category_id=1)  # type: ignore
+        db.session.add_all([
+            post,
+            Comment(author='Someone', email='someone@example.com', body='Blueprints saved my project', reviewed=True, post=post),  # type: ignore
+            Comment(author='Spammer', email='spam@example.com', body='Cheap blueprints', reviewed=False, post=post),  # type: ignore
+        ])
+        db.session.commit()
+
+    data: str = client.get('/search?q=blueprint').get_data(as_text=True)
+    assert '<mark>blueprints</mark> &amp;' in data
+    assert 'Comment on Flask tips' in data
+    assert 'Cheap' not in data
+    assert '<script>x' not in data
+
+    with app.app_context():
+        db.session.get(Post, 1).body = '<p>Nothing here.</p>'  # type: ignore
+        db.session.get(Comment, 2).reviewed = True  # type: ignore
+        db.session.commit()
+    data = client.get('/search?q=blueprint').get_data(as_text=True)
+    assert 'Routing' not in data
+    assert 'Cheap' in data
+    assert client.get('/search?q="*').status_code == 200
+    assert 'X-Greybook-Cache' not in client.get('/search?q=blueprint').headers
+
+    login(client)
+    assert '/admin/post/1/edit' in client.get('/admin/search?q=flask').get_data(as_text=True)
+
+
+def test_rebuild_search_index_command(app, client):
+    add_posts(app, 3, 'Flask')
+    with app.app_context():
+        db.session.add(Comment(author='Someone', email='someone@example.com', body='Hi', reviewed=True, post_id=1))  # type: ignore
+        db.session.commit()
+        db.session.execute(text('DELETE FROM search_index'))
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['rebuild-search-index', '--chunk-size', '2'])
+    assert 'Indexed 3 posts and 1 comments.' in result.output
+    assert '<mark>Post</mark> 2' in client.get('/search?q=post').get_data(as_text=True)
+
+
+class SMTPRecorder:
+    """
+    aiosmtpd handler keeping the received messages and the SMTP sessions they came through.
+    """
+
+    def __init__(self) -> None:
+        self.messages: list[bytes] = []
+        self.sessions: set[int] = set()
+
+    async def handle_DATA(self, server, session, envelope) -> str:
+        self.messages.append(envelope.content)
+        self.sessions.add(id(session))
+        return '250 OK'
+
+
+@pytest.fixture
+def unused_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def use_smtp(app, port: int) -> None:
+    app.extensions['mailman'] = Mail.init_mail(dict(MAIL_BACKEND='smtp', MAIL_SERVER='127.0.0.1', MAIL_PORT=port, MAIL_DEFAULT_SENDER='greybook@example.com'))
+
+
+def test_comment_notification_is_queued_in_outbox(app, client):
+    add_posts(app, 1, 'Flask')
+    app.config['GREYBOOK_ADMIN_EMAIL'] = 'admin@example.com'
+    client.post('/post/1', data=dict(author='Someone', email='someone@example.com', body='Hi'))
+    with app.app_context():
+        message = db.session.scalar(select(OutboxMessage))
+        assert message.to == 'admin@example.com'
+        assert message.sent_time is None
+
+
+def test_outbox_drain_reuses_smtp_connection(app, unused_port):
+    recorder = SMTPRecorder()
+    controller = Controller(recorder, hostname='127.0.0.1', port=unused_port)
+    controller.start()
+    try:
+        use_smtp(app, unused_port)
+        with app.app_context():
+            db.session.add_all([OutboxMessage(subject=f'Hello {i}', body='<p>Hi</p>', to=f'user{i}@example.com') for i in range(3)])  # type: ignore
+            db.session.commit()
+        result = app.test_cli_runner().invoke(args=['outbox', 'drain'])
+    finally:
+        controller.stop()
+
+    assert 'Sent 3 emails, 0 failed.' in result.output
+    assert len(recorder.messages) == 3
+    assert len(recorder.sessions) == 1
+    with app.app_context():
+        assert all(message.sent_time and message.next_attempt_time is None for message in db.session.scalars(select(OutboxMessage)))
+
+
+def test_outbox_retries_and_opens_circuit_breaker(app, unused_port):
+    use_smtp(app, unused_port)
+    sender = app.extensions['greybook_outbox']
+    sender.breaker.threshold = 1
+    with app.app_context():
+        db.session.add(OutboxMessage(subject='Hello', body='<p>Hi</p>', to='user@example.com'))  # type: ignore
+        db.session.commit()
+        assert sender.drain() == (0, 1)
+        message = db.session.get(OutboxMessage, 1)
+        assert (message.attempts, message.sent_time) == (1, None)
+        assert 'ConnectionRefusedError' in message.last_error
+        assert message.next_attempt_time > datetime.now(UTC).replace(tzinfo=None)
+        assert sender.breaker.is_open
+
+        message.next_attempt_time = datetime(2000, 1, 1)  # type: ignore
+        db.session.commit()
+        assert sender.send_batch() == (0, 0)
+
+
+def test_comment_notifications_digest(app, client):
+    app.config.update(GREYBOOK_ADMIN_EMAIL='admin@example.com', GREYBOOK_COMMENT_NOTIFICATION='digest')
+    add_posts(app, 2, 'Flask')
+    for post_id in (1, 1, 2):
+        client.post(f'/post/{post_id}', data=dict(author='Someone', email='someone@example.com', body='Hi'))
+
+    with app.app_context():
+        message = db.session.scalar(select(OutboxMessage))
+        assert db.session.scalar(select(func.count(OutboxMessage.id))) == 1
+        assert message.next_attempt_time > datetime.now(UTC).replace(tzinfo=None)
+        assert 'New comments in 2 posts' in message.body
+        assert 'Post 0</a>: 2 new comments' in message.body
+        assert 'Post 1</a>: 1 new comment<' in message.body
+
+
+def test_post_images_are_registered(app):
+    with app.app_context():
+        post = Post(title='Images', body='<p><img src="/uploads/a.png"><img alt="" src="/uploads/b.png"><img src="/uploads/a.png"></p>', category_id=1)  # type: ignore
+        db.session.add(post)
+        db.session.commit()
+        assert sorted(image.filename for image in post.images) == ['a.png', 'b.png']
+
+        post.body = '<p><img src="/uploads/b.png"><img src="https://example.com/c.png"></p>'
+        db.session.commit()
+        assert db.session.scalars(select(PostImage.filename)).all() == ['b.png']
+
+        post.delete()
+        assert db.session.scalar(select(func.count()).select_from(PostImage)) == 0
+
+
+def test_uploads_gc_command(app, tmp_path):
+    app.config['GREYBOOK_UPLOAD_PATH'] = str(tmp_path)
+    for filename in ('used.png', 'unused.png', 'fresh.png'):
+        (tmp_path / filename).write_bytes(b'image')
+    for filename in ('used.png', 'unused.png'):
+        os.utime(tmp_path / filename, (0, 0))
+    with app.app_context():
+        db.session.add(Post(title='Images', body='<img src="/uploads/used.png">', category_id=1))  # type: ignore
+        db.session.commit()
+        db.session.execute(delete(PostImage))
+        # a post saved after the deploy registers its images, the older ones are still missing from the registry
+        db.session.add(Post(title='New', body='<img src="/uploads/fresh.png">', category_id=1))  # type: ignore
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    assert "run 'flask uploads index' first" in runner.invoke(args=['uploads', 'gc']).output
+    assert (tmp_path / 'used.png').exists()
+    assert 'Registered 1 post images.' in runner.invoke(args=['uploads', 'index']).output
+
+    assert 'Found 1 unused files of 3.' in runner.invoke(args=['uploads', 'gc', '--dry-run']).output
+    assert (tmp_path / 'unused.png').exists()
+    result = runner.invoke(args=['uploads', 'gc', '--batch-size', '2'])
+    assert 'Removed 1 unused files of 3.' in result.output
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['fresh.png', 'used.png']
+
+
+def png(width: int, height: int, color: str = 'red') -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def test_upload_is_deduplicated_and_resized(app, client, tmp_path, monkeypatch):
+    app.config['GREYBOOK_UPLOAD_PATH'] = str(tmp_path)
+    login(client)
+    urls: list[str] = [client.post('/admin/upload', data=dict(upload=(io.BytesIO(png(1000, 500)), 'photo.PNG'))).get_json()['url'] for _ in range(2)]
+    assert urls[0] == urls[1]
+    filename: str = urls[0].rsplit('/', 1)[1]
+    assert filename.endswith('_1000x500.png')
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted([filename, f'{filename}.480w.webp', f'{filename}.960w.webp'])
+    with Image.open(tmp_path / f'{filename}.480w.webp') as variant:
+        assert variant.size == (480, 240)
+
+    response = client.post('/admin/upload', data=dict(upload=(io.BytesIO(b'not an image'), 'fake.png')))
+    assert 'Image only!' in response.get_data(as_text=True)
+    assert len(list(tmp_path.iterdir())) == 3
+
+    os.remove(tmp_path / f'{filename}.960w.webp')
+    assert client.get(f'/uploads/{filename}.960w.webp').data == png(1000, 500)
+
+    # uploading it again keeps it from the uploads gc and regenerates the missing variant
+    os.utime(tmp_path / filename, (0, 0))
+    client.post('/admin/upload', data=dict(upload=(io.BytesIO(png(1000, 500)), 'photo.png')))
+    assert os.path.getmtime(tmp_path / filename) > 0 and (tmp_path / f'{filename}.960w.webp').exists()
+
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 1000)
+    response = client.post('/admin/upload', data=dict(upload=(io.BytesIO(png(100, 100, 'blue')), 'bomb.png')))
+    assert response.status_code == 200 and 'Image only!' in response.get_data(as_text=True)
+    assert len(list(tmp_path.iterdir())) == 3
+
+
+def test_image_pool_failures_are_logged(app, caplog):
+    from concurrent.futures import Future
+
+    from greybook.images import _log_failure
+
+    future: Future = Future()
+    future.set_exception(OSError('disk full'))
+    _log_failure(future, app.logger, 'generate_variants')
+    assert 'generate_variants failed in the image process pool' in caplog.text and 'disk full' in caplog.text
+
+
+def test_image_pool_is_spawned(app, monkeypatch, tmp_path):
+    from PIL import Image
+
+    from greybook import images
+
+    Image.new('RGB', (100, 50)).save(tmp_path / 'photo.png')
+    app.config['GREYBOOK_IMAGE_WORKERS'] = 1
+    monkeypatch.setattr(images, '_executor', None)
+    with app.app_context():
+        images._submit(images.generate_variants, str(tmp_path / 'photo.png'), [(40, str(tmp_path / 'photo.png.40w.webp'))])
+    executor = images._executor
+    executor.shutdown()  # type: ignore
+    assert executor._mp_context.get_start_method() == 'spawn'  # type: ignore
+    with Image.open(tmp_path / 'photo.png.40w.webp') as variant:
+        assert variant.size == (40, 20)
+
+
+def test_post_images_get_srcset(app):
+    with app.app_context():
+        post = Post(title='Images', body='<p><img alt="photo" src="/uploads/0123456789abcdef0123456789abcdef_1000x500.png" /><img src="https://example.com/a.png"></p>', category_id=1)  # type: ignore
+        assert post.body == (
+            '<p><img alt="photo" src="/uploads/0123456789abcdef0123456789abcdef_1000x500.png" width="1000" height="500" loading="lazy" decoding="async"'
+            ' srcset="/uploads/0123456789abcdef0123456789abcdef_1000x500.png.480w.webp 480w, /uploads/0123456789abcdef0123456789abcdef_1000x500.png.960w.webp 960w, /uploads/0123456789abcdef0123456789abcdef_1000x500.png 1000w"'
+            ' sizes="(max-width: 1000px) 100vw, 1000px" /><img src="https://example.com/a.png"></p>'
+        )
+        body: str = post.body  # type: ignore
+        post.body = body
+        assert post.body == body
+        assert [image.filename for image in post.images] == ['0123456789abcdef0123456789abcdef_1000x500.png']
+
+
+def test_uploads_are_cacheable_and_offloadable(app, client, tmp_path):
+    app.config['GREYBOOK_UPLOAD_PATH'] = str(tmp_path)
+    filename: str = '0123456789abcdef0123456789abcdef_1000x500.png'
+    (tmp_path / filename).write_bytes(png(1000, 500))
+    (tmp_path / 'legacy.png').write_bytes(b'legacy')
+
+    response = client.get(f'/uploads/{filename}')
+    assert response.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+    response = client.get(f'/uploads/{filename}', headers={'Range': 'bytes=0-3'})
+    assert (response.status_code, response.data) == (206, b'\x89PNG')
+    assert 'immutable' not in client.get('/uploads/legacy.png').headers['Cache-Control']
+    assert 'immutable' not in client.get(f'/uploads/{filename}.480w.webp').headers['Cache-Control']
+    assert client.get('/uploads/missing.png').status_code == 404
+
+    app.config.update(GREYBOOK_UPLOAD_OFFLOAD='x-accel-redirect')
+    response = client.get(f'/uploads/{filename}')
+    assert (response.data, response.mimetype) == (b'', 'image/png')
+    assert response.headers['X-Accel-Redirect'] == f'/_uploads/{filename}'
+    assert 'immutable' in response.headers['Cache-Control']
+    app.config.update(GREYBOOK_UPLOAD_OFFLOAD='x-sendfile')
+    assert client.get('/uploads/legacy.png').headers['X-Sendfile'] == str(tmp_path / 'legacy.png')
+    assert client.get('/uploads/../secret').status_code == 404
+
+
+def test_comment_paths_and_threaded_display(app, client, queries):
+    app.config['GREYBOOK_COMMENT_THREADED'] = True
+    add_posts(app, 1, 'Flask')
+    client.post('/post/1', data=dict(author='A', email='a@example.com', body='Root one'))
+    client.post('/post/1', data=dict(author='B', email='b@example.com', body='Root two'))
+    login(client)
+    client.post('/admin/comment/approve')
+    client.post('/post/1?reply=1', data=dict(body='Reply to one'))
+    client.post('/post/1?reply=3', data=dict(body='Reply to reply'))
+    with app.app_context():
+        assert [(comment.path, comment.depth) for comment in db.session.scalars(select(Comment).order_by(Comment.id))] == [
+            ('0000000001/', 0),
+            ('0000000002/', 0),
+            ('0000000001/0000000003/', 1),
+            ('0000000001/0000000003/0000000004/', 2),
+        ]
+
+    client.get('/auth/logout')
+    queries.clear()
+    data: str = client.get('/post/1').get_data(as_text=True)
+    assert list(re.findall(r'<p class="mb-1">(.*?)</p>', data)) == ['Root one', 'Reply to one', 'Reply to reply', 'Root two']
+    assert len([statement for statement in queries if 'FROM comment' in statement and 'count(*)' not in statement]) == 1
+
+    with app.app_context():
+        db.session.execute(update(Comment).values(path=None, depth=0))
+        db.session.commit()
+    assert 'Rebuilt the paths of 4 comments.' in app.test_cli_runner().invoke(args=['rebuild-comment-paths']).output
+    with app.app_context():
+        assert db.session.get(Comment, 4).path == '0000000001/0000000003/0000000004/'
+
+
+def test_bulk_comment_moderation(app, client, queries):
+    add_posts(app, 2, 'Flask')
+    for i in range(6):
+        client.post(f'/post/{i % 2 + 1}', data=dict(author='Spammer', email='spam@example.com', body=f'Cheap pills {i}'), environ_base={'REMOTE_ADDR': '10.0.0.1'})
+    client.post('/post/1', data=dict(author='Reader', email='reader@example.com', body='Lovely post'), environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    login(client)
+
+    queries.clear()
+    response = client.post('/admin/comment/bulk', data=dict(action='spam', scope='email', value='spam@example.com'), follow_redirects=True)
+    assert '6 comments marked as spam.' in response.get_data(as_text=True)
+    assert not any(statement.startswith('SELECT comment.id, comment.author') for statement in queries)
+    with app.app_context():
+        assert Counter.get_value(Counter.UNREAD_COMMENTS) == 1
+    assert 'Cheap pills 0' in client.get('/admin/comment/manage?filter=spam').get_data(as_text=True)
+    assert 'Cheap pills' not in client.get('/admin/comment/manage?filter=unread').get_data(as_text=True)
+
+    client.post('/admin/comment/bulk', data=dict(action='approve', scope='selected', ids=[7, 1]))
+    with app.app_context():
+        assert [(post.comment_count, post.reviewed_comment_count) for post in db.session.scalars(select(Post).order_by(Post.id))] == [(4, 2), (3, 0)]
+        assert Counter.get_value(Counter.UNREAD_COMMENTS) == 0
+    client.get('/auth/logout')
+    assert 'Lovely' in client.get('/search?q=lovely').get_data(as_text=True)
+    login(client)
+
+    response = client.post('/admin/comment/bulk', data=dict(action='delete', scope='ip', value='10.0.0.1'), follow_redirects=True)
+    assert '6 comments deleted.' in response.get_data(as_text=True)
+    with app.app_context():
+        assert db.session.scalars(select(Comment.body)).all() == ['Lovely post']
+        assert [post.comment_count for post in db.session.scalars(select(Post).order_by(Post.id))] == [1, 0]
+    client.get('/auth/logout')
+    assert 'Cheap pills 0' not in client.get('/search?q=cheap').get_data(as_text=True)
+    login(client)
+    assert client.post('/admin/comment/bulk', data=dict(action='drop')).status_code == 400
+
+
+def test_bulk_delete_removes_replies_and_needs_a_value(app, client):
+    add_posts(app, 1, 'Flask')
+    client.post('/post/1', data=dict(author='Spammer', email='spam@example.com', body='Spam'), environ_base={'REMOTE_ADDR': '10.0.0.1'})
+    client.post('/post/1?reply=1', data=dict(author='Reader', email='reader@example.com', body='Reply'), environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    client.post('/post/1?reply=2', data=dict(author='Other', email='other@example.com', body='Reply to reply'), environ_base={'REMOTE_ADDR': '10.0.0.3'})
+    client.post('/post/1', data=dict(author='Other', email='other@example.com', body='No email'), environ_base={'REMOTE_ADDR': '10.0.0.3'})
+    login(client)
+    with app.app_context():
+        db.session.execute(update(Comment).where(Comment.id == 4).values(email=None))
+        db.session.commit()
+
+    for scope in ('email', 'ip'):
+        response = client.post('/admin/comment/bulk', data=dict(action='delete', scope=scope, value=''), follow_redirects=True)
+        assert '0 comments deleted.' in response.get_data(as_text=True)
+    assert '0 comments deleted.' in client.post('/admin/comment/bulk', data=dict(action='delete', scope='email'), follow_redirects=True).get_data(as_text=True)
+
+    response = client.post('/admin/comment/bulk', data=dict(action='delete', scope='ip', value='10.0.0.1'), follow_redirects=True)
+    assert '3 comments deleted.' in response.get_data(as_text=True)
+    with app.app_context():
+        assert db.session.scalars(select(Comment.body)).all() == ['No email']
+        assert db.session.get(Post, 1).comment_count == 1
+
+
+def test_client_address_behind_a_proxy(monkeypatch):
+    monkeypatch.setattr(TestingConfig, 'GREYBOOK_TRUSTED_PROXIES', 1)
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([Category(name='Default'), Post(title='Post', body='Body', category_id=1)])  # type: ignore
+        db.session.commit()
+        app.test_client().post('/post/1', data=dict(author='Reader', email='reader@example.com', body='Hi'), headers={'X-Forwarded-For': '203.0.113.7'}, environ_base={'REMOTE_ADDR': '127.0.0.1'})
+        assert db.session.scalar(select(Comment.ip)) == '203.0.113.7'
+        db.session.remove()
+        db.drop_all()
+
+
+def test_category_delete_and_merge_are_set_based(app, client, queries):
+    for name in ('Flask', 'Python', 'Django'):
+        add_posts(app, 3, name)
+    login(client)
+
+    queries.clear()
+    client.post('/admin/category/2/delete')
+    assert not any('post.body' in statement for statement in queries)
+    with app.app_context():
+        assert db.session.get(Category, 1).post_count == 3
+
+    response = client.post('/admin/category/merge', data=dict(ids=[1, 3, 4], target=4), follow_redirects=True)
+    assert 'Merged 1 categories into Django, moved 3 posts.' in response.get_data(as_text=True)
+    with app.app_context():
+        assert [(category.name, category.post_count) for category in db.session.scalars(select(Category).order_by(Category.id))] == [('Default', 3), ('Django', 6)]
+    assert 'can not be merged' in client.post('/admin/category/merge', data=dict(ids=[1], target=4), follow_redirects=True).get_data(as_text=True)
+
+
+def test_query_stats_and_budgets(app, client, caplog):
+    from flask import render_template_string
+
+    from greybook.core.request import QueryBudgetExceeded
+
+    @app.route('/n-plus-one')
+    def n_plus_one():
+        return render_template_string('{% for post in posts %}\n{{ post.comments|length }}\n{% endfor %}', posts=db.session.scalars(select(Post)).all())
+
+    add_posts(app, 5, 'Flask')
+    app.config.update(GREYBOOK_REPEATED_QUERY_THRESHOLD=3, DEBUG=True)
+    response = client.get('/n-plus-one')
+    assert int(response.headers['X-Query-Count']) >= 6
+    assert response.headers['X-Query-Time'].endswith('ms')
+    assert 'Probable N+1 query in n_plus_one: executed 5 times, first from <template>:2' in caplog.text
+
+    app.config.update(DEBUG=False, GREYBOOK_PAGE_CACHE=False, GREYBOOK_QUERY_BUDGETS={'blog.index': 2})
+    with pytest.raises(QueryBudgetExceeded, match='blog.index executed'):
+        client.get('/')
+    app.config.update(TESTING=False, GREYBOOK_QUERY_BUDGETS={'blog.index': 0})
+    assert client.get('/').status_code == 200
+    assert 'over its budget of 0' in caplog.text
+
+
+def test_sampled_queries_and_metrics(app, client, caplog):
+    add_posts(app, 3, 'Flask')
+    app.config.update(GREYBOOK_QUERY_SAMPLE_RATE=0, GREYBOOK_REPEATED_QUERY_THRESHOLD=0, GREYBOOK_QUERY_BUDGETS={})
+    response = client.get('/')
+    assert 'Probable N+1' not in caplog.text
+    assert re.fullmatch(r'db;dur=[\d.]+;desc="\d+ queries", render;dur=[\d.]+, total;dur=[\d.]+', response.headers['Server-Timing'])
+
+    metrics = client.get('/metrics').get_data(as_text=True)
+    assert '# TYPE greybook_request_duration_seconds histogram' in metrics
+    assert 'greybook_request_duration_seconds_count{endpoint="blog.index"} 1' in metrics
+    assert 'greybook_request_queries_bucket{endpoint="blog.index",le="+Inf"} 1' in metrics
+    assert 'greybook_template_render_seconds_count{template="blog/index.html"} 1' in metrics
+
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.7'}).status_code == 404
+    assert client.get('/metrics', headers={'X-Forwarded-For': '203.0.113.7'}).status_code == 404
+    login(client)
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.7'}).status_code == 200
+
+    assert not ProductionConfig.GREYBOOK_SERVER_TIMING
+    app.config['GREYBOOK_SERVER_TIMING'] = False
+    assert 'Server-Timing' not in client.get('/').headers
+
+
+def test_logged_in_admin_is_cached(app, client, queries):
+    login(client)
+    client.get('/admin/category/manage')
+    queries.clear()
+    response = client.get('/admin/category/manage')
+    assert response.status_code == 200
+    assert not any('FROM admin' in statement for statement in queries)
+    assert 'Greybook' in response.get_data(as_text=True)
+
+    client.post('/admin/settings', data=dict(name='Grey', blog_title='Renamed', blog_sub_title='Sub', about='About me.'))
+    assert 'Renamed' in client.get('/admin/category/manage').get_data(as_text=True)
+
+    with app.app_context():
+        admin = db.session.scalar(select(Admin))
+        admin.password = '456'
+        db.session.commit()
+    assert client.get('/admin/category/manage').status_code == 302
+
+
+def test_cold_start_skips_dev_only_extensions(app, tmp_path, monkeypatch):
+    assert 'migrate' not in app.extensions and 'debugtoolbar' not in app.extensions
+    assert list(app.extensions['greybook_startup'])[:2] == ['register_blueprints', 'register_extensions']
+    assert app.jinja_env.bytecode_cache is None
+
+    monkeypatch.setattr(TestingConfig, 'GREYBOOK_TEMPLATE_CACHE_DIR', str(tmp_path))
+    result = create_app('testing').test_cli_runner().invoke(args=['compile-templates'])
+    assert f'into {tmp_path}.' in result.output
+    assert len(os.listdir(tmp_path)) == int(result.output.split()[1]) > 0
+
+
+def test_logging_goes_through_a_queue(app, monkeypatch, tmp_path):
+    from logging import (
+        ERROR,
+        LogRecord,
+    )
+    from logging.handlers import QueueHandler
+
+    from greybook.core import logging as greybook_logging
+    from greybook.core.logging import (
+        ErrorMailFilter,
+        JsonFormatter,
+        RequestContextFilter,
+        RequestQueueHandler,
+        register_logging,
+    )
+
+    assert not [handler for handler in app.logger.handlers if isinstance(handler, QueueHandler)]
+    monkeypatch.setattr(greybook_logging, 'basedir', str(tmp_path))
+    app.testing = False
+    register_logging(app)
+    queue_handlers = [handler for handler in app.logger.handlers if isinstance(handler, QueueHandler)]
+    assert [type(handler) for handler in queue_handlers] == [RequestQueueHandler]
+    assert queue_handlers[0].listener._thread.is_alive()
+    app.logger.warning('Logged from the test')
+    app.testing = True
+    register_logging(app)
+    assert not queue_handlers[0].listener._thread
+    assert 'Logged from the test' in (tmp_path / 'logs' / 'greybook.log').read_text()
+
+    def error(line: int) -> LogRecord:
+        try:
+            if line == 1:
+                raise KeyError('missing')
+            raise IndexError('list index out of range')
+        except LookupError as exception:
+            record = LogRecord('greybook', ERROR, __file__, 1, 'Exception on %s', ('/post/1',), (type(exception), exception, exception.__traceback__))
+        with app.test_request_context('/post/1'):
+            RequestContextFilter().filter(record)
+        return RequestQueueHandler(None).prepare(record)  # type: ignore
+
+    entry = json.loads(JsonFormatter().format(error(1)))
+    assert entry['message'] == 'Exception on /post/1'
+    assert entry['url'] == 'http://localhost/post/1'
+    assert "KeyError: 'missing'" in entry['exception']
+
+    mail_filter = ErrorMailFilter(interval=60, limit=2)
+    assert [mail_filter.filter(error(1)) for _ in range(3)] == [True, False, False]
+    assert mail_filter.filter(error(2))
+    assert not mail_filter.filter(error(3))  # over the limit of emails per interval
+    mail_filter._last_sent = {fingerprint: sent - 60 for fingerprint, sent in mail_filter._last_sent.items()}
+    mail_filter._sent_times.clear()
+    record = error(1)
+    assert mail_filter.filter(record) and record.suppressed == 2
+
+
+def test_fake_data_is_bulk_and_reproducible(app):
+    def generate(*options: str) -> list:
+        result = app.test_cli_runner().invoke(args=['fake', '--category', '3', '--post', '12', '--comment', '40', '--reply', '15', '--chunk-size', '7', *options])
+        assert 'Generated 40 comments in' in result.output and 'rows/s' in result.output
+        with app.app_context():
+            db.session.remove()
+            return [
+                db.session.execute(select(Post.id, Post.title, Post.created_time, Post.category_id, Post.comment_count, Post.reviewed_comment_count).order_by(Post.id)).all(),
+                db.session.execute(select(Comment.id, Comment.author, Comment.body, Comment.post_id, Comment.replied_id, Comment.path, Comment.created_time).order_by(Comment.id)).all(),
+            ]
+
+    posts, comments = generate('--seed', '7')
+    assert [posts, comments] == generate('--seed', '7', '--workers', '2')
+    assert [posts, comments] != generate('--seed', '8')
+
+    by_id = {comment.id: comment for comment in comments}
+    assert len(comments) == 55 and sum(post.comment_count for post in posts) == 55
+    for comment in comments[40:]:
+        parent = by_id[comment.replied_id]
+        assert comment.post_id == parent.post_id and comment.created_time > parent.created_time
+        assert comment.path.startswith(parent.path)
+    with app.app_context():
+        assert db.session.scalar(text('SELECT count(*) FROM search_index')) > 12
+        assert Counter.get_value(Counter.UNREAD_COMMENTS) == db.session.scalar(select(func.count(Comment.id)).where(Comment.reviewed.is_(False), Comment.spam.is_(False)))
+
+
+def test_endpoint_benchmark(tmp_path, monkeypatch):
+    from greybook import bench
+
+    monkeypatch.setitem(bench.DATASETS, 'tiny', dict(category=3, post=12, comment=60, reply=10))
+    messages: list[str] = []
+    generated = bench.create_bench_app()
+    assert 'greybook_page_cache' not in generated.extensions
+    bench.load_dataset(generated, 'tiny', 3, str(tmp_path), echo=messages.append)
+    assert (tmp_path / 'tiny-3.db').exists() and not (tmp_path / 'tiny-3.db.tmp').exists()
+
+    restored = bench.create_bench_app()
+    bench.load_dataset(restored, 'tiny', 3, str(tmp_path), echo=messages.append)
+    assert messages[-1].startswith('Loaded the tiny dataset')
+    with generated.app_context():
+        expected = db.session.execute(select(Comment.id, Comment.body, Comment.path).order_by(Comment.id)).all()
+    with restored.app_context():
+        assert db.session.execute(select(Comment.id, Comment.body, Comment.path).order_by(Comment.id)).all() == expected
+
+    results = bench.results_document('tiny', 3, bench.benchmark_endpoints(restored, requests=3, warmup=1))
+    assert list(results['endpoints']) == ['index', 'deep_page', 'deep_cursor', 'category', 'post', 'search', 'manage_comments', 'approve_comments', 'comment']
+    for result in results['endpoints'].values():
+        assert result['requests'] == 3 and 0 < result['p50_ms'] <= result['p95_ms'] <= result['p99_ms']
+        assert result['queries'] > 0 and result['peak_memory_kb'] > 0
+    with restored.app_context():
+        assert db.session.scalar(select(func.count(Comment.id)).where(Comment.author == 'Bench')) == 5
+    results = json.loads(json.dumps(results))
+
+    assert bench.compare_results(results, results) == []
+    baseline = json.loads(json.dumps(results))
+    baseline['endpoints']['post']['p95_ms'] = results['endpoints']['post']['p95_ms'] / 10 - 1
+    baseline['endpoints']['index']['queries'] = results['endpoints']['index']['queries'] - 1
+    regressions = bench.compare_results(results, baseline)
+    assert len(regressions) == 2 and regressions[0].startswith('index: ') and regressions[1].startswith('post: p95 latency')
+    with pytest.raises(ValueError):
+        bench.compare_results(results, dict(baseline, seed=4))
+
+
+def test_sqlite_pragmas_and_immediate_writes(tmp_path, monkeypatch):
+    import sqlite3
+
+    from greybook.bench import measure_sqlite_concurrency
+
+    monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_DATABASE_URI', f'sqlite:///{tmp_path / "greybook.db"}')
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        assert db.session.scalar(text('PRAGMA journal_mode')) == 'wal'
+        assert db.session.scalar(text('PRAGMA busy_timeout')) == 5000
+        assert db.session.scalar(text('PRAGMA synchronous')) == 1
+        db.session.remove()
+
+    other = sqlite3.connect(tmp_path / 'greybook.db', timeout=0, isolation_level=None)
+    for method, locked in (('GET', False), ('POST', True)):
+        with app.test_request_context(method=method), app.app_context():
+            db.session.scalar(select(func.count(Post.id)))
+            # a POST holds the write lock from its first statement, a GET only reads
+            if locked:
+                with pytest.raises(sqlite3.OperationalError):
+                    other.execute('BEGIN IMMEDIATE')
+            else:
+                other.execute('BEGIN IMMEDIATE')
+                other.execute('ROLLBACK')
+            db.session.remove()
+    other.close()
+
+    result = app.test_cli_runner().invoke(args=['optimize-db'])
+    assert result.exit_code == 0 and 'checkpointed' in result.output
+
+    tuned = measure_sqlite_concurrency(str(tmp_path / 'greybook.db'), True, TestingConfig.GREYBOOK_SQLITE_PRAGMAS, readers=2, writers=2, seconds=0.3)
+    assert tuned.reads_per_second > 0 and tuned.writes_per_second > 0 and tuned.locked_errors == 0
+
+
+def test_read_requests_use_the_read_database(tmp_path, monkeypatch):
+    from greybook.config import read_only_sqlite_uri
+    from greybook.core.database import use_database
+
+    uri = f'sqlite:///{tmp_path / "greybook.db"}'
+    assert read_only_sqlite_uri('sqlite:///:memory:') is None
+    monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_DATABASE_URI', uri)
+    monkeypatch.setattr(TestingConfig, 'GREYBOOK_READ_DATABASE_URI', read_only_sqlite_uri(uri))
+    app = create_app('testing')
+    app.add_url_rule('/read-only', 'read_only', use_database('read')(lambda: str(db.session.scalar(select(func.count(Post.id))))))
+    app.extensions.pop('greybook_page_cache', None)
+    with app.app_context():
+        db.create_all()
+        admin = Admin(username='admin', name='Admin', blog_title='Greybook', blog_sub_title='Blog', about='About')  # type: ignore
+        admin.password = 'greybook'
+        db.session.add_all([admin, Category(name='Default'), Post(title='Read', body='Routed.', category_id=1)])
+        db.session.commit()
+        read_engine = db.engines['read']
+
+    engines: list = []
+
+    def record(conn, *args) -> None:
+        engines.append('read' if conn.engine is read_engine else 'primary')
+
+    event.listen(Engine, 'before_cursor_execute', record)
+    try:
+        client = app.test_client()
+
+        def routes(method: str, url: str, **kwargs) -> set[str]:
+            engines.clear()
+            assert client.open(url, method=method, **kwargs).status_code < 400
+            return set(engines)
+
+        assert routes('GET', '/') == {'read'}
+        assert routes('GET', '/post/1') == {'read'}
+        assert routes('POST', '/post/1', data=dict(author='Reader', email='reader@example.com', body='Hello.')) == {'primary'}
+        assert routes('GET', '/read-only') == {'read'}
+        with app.app_context():
+            assert db.session.scalar(select(func.count(Comment.id))) == 1
+
+        client.post('/auth/login', data=dict(username='admin', password='greybook'))
+        assert routes('GET', '/') == {'primary'}
+        assert routes('GET', '/admin/comment/manage') == {'primary'}
+        assert routes('GET', '/read-only') == {'read'}
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record)